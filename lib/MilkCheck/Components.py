@@ -0,0 +1,378 @@
+#
+# Copyright CEA (2026)
+#
+# This file is part of MilkCheck project.
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading,  using,  modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean  that it is complicated to manipulate,  and  that  also
+# therefore means  that it is reserved for developers  and  experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and,  more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+
+'''
+This module runs independent parts of the service graph in separate
+processes. Engine events of the child processes are streamed back to the
+parent, which replays them on its own copy of the graph, so that the
+interfaces registered in the parent see a single run.
+'''
+
+import os
+import sys
+import errno
+import pickle
+import select
+import signal
+import struct
+import logging
+import traceback
+
+from ClusterShell.NodeSet import NodeSet
+
+from MilkCheck.Callback import CallbackHandler, CoreEvent, call_back_self
+from MilkCheck.Callback import EV_STARTED, EV_COMPLETE, EV_STATUS_CHANGED, \
+                               EV_DELAYED, EV_TRIGGER_DEP, EV_FINISHED
+from MilkCheck.Engine.Action import Action, action_manager_self
+from MilkCheck.Engine.Backend import BackendWorker
+from MilkCheck.Engine.BaseEntity import MilkCheckEngineError
+from MilkCheck.Engine.BaseEntity import DONE, WARNING, TIMEOUT, ERROR, \
+                                        DEP_ERROR, SKIPPED, NO_STATUS
+from MilkCheck.Engine.NodeHealth import node_health_self
+
+# From the most to the least severe
+STATUS_SEVERITY = (DEP_ERROR, ERROR, TIMEOUT, WARNING, DONE, SKIPPED,
+                   NO_STATUS)
+
+# Message sent once a child process is done
+EV_END = 'EV_END'
+# Message sent when the running actions of a child process changed
+EV_RUNNING = 'EV_RUNNING'
+
+# Event names are compared by identity, see CallbackHandler.notify()
+EVENTS = dict((name, name) for name in (EV_STARTED, EV_COMPLETE,
+                                        EV_STATUS_CHANGED, EV_DELAYED,
+                                        EV_TRIGGER_DEP, EV_END, EV_RUNNING))
+
+def iter_entities(group):
+    '''Return an iterator over services and actions contained in group'''
+    for svc in [group._source, group._sink] + list(group.iter_subservices()):
+        yield svc
+        for action in getattr(svc, '_actions', {}).values():
+            yield action
+        if hasattr(svc, '_subservices'):
+            for ent in iter_entities(svc):
+                yield ent
+
+def entity_key(ent):
+    '''Return a key identifying ent in all copies of the graph'''
+    return (isinstance(ent, Action), ent.fullname())
+
+def entity_state(ent):
+    '''Return the state of ent which is sent to the parent process'''
+    state = {'status': ent.status,
+             'target': str(ent.target) if ent.target is not None else None}
+    if isinstance(ent, Action):
+        state.update(start_time=ent.start_time, stop_time=ent.stop_time,
+                     tries=ent.tries, node_times=ent.node_times,
+                     next_delay=ent.next_delay,
+                     aborted_nodes=str(ent.aborted_nodes),
+                     pending_target=str(ent.pending_target))
+        if ent.worker:
+            backend = action_manager_self().backend
+            state['worker'] = (
+                ent.worker.command,
+                [(bytes(buf), str(nds))
+                 for buf, nds in backend.iter_buffers(ent.worker)
+                 if buf is not None],
+                [(rc, str(nds))
+                 for rc, nds in backend.iter_retcodes(ent.worker)],
+                str(backend.nodes_timeout(ent.worker)))
+    return state
+
+def apply_state(ent, state):
+    '''Update ent with the state sent by a child process'''
+    ent.status = state['status']
+    if state['target'] is not None:
+        ent.target = state['target']
+    if not isinstance(ent, Action):
+        return
+    for attr in ('start_time', 'stop_time', 'tries', 'node_times',
+                 'next_delay'):
+        setattr(ent, attr, state[attr])
+    ent.aborted_nodes = NodeSet(state['aborted_nodes'])
+    ent.pending_target = NodeSet(state['pending_target'])
+    if 'worker' in state:
+        command, buffers, retcodes, timeouts = state['worker']
+        worker = BackendWorker(ent, command, None, None)
+        for buf, nodes in buffers:
+            for node in NodeSet(nodes):
+                worker._buffers[node] = buf
+        for retcode, nodes in retcodes:
+            for node in NodeSet(nodes):
+                worker._retcodes[node] = retcode
+        worker._timeouts = list(NodeSet(timeouts))
+        ent.worker = worker
+
+
+class EventForwarder(CoreEvent):
+    '''Send engine events of a child process to the parent, through fdesc'''
+
+    def __init__(self, fdesc):
+        CoreEvent.__init__(self)
+        self.fdesc = fdesc
+        self._running = set()
+
+    def send(self, message):
+        '''Write a message to the parent'''
+        data = pickle.dumps(message, 2)
+        data = struct.pack('!I', len(data)) + data
+        while data:
+            data = data[os.write(self.fdesc, data):]
+
+    def _forward_running(self):
+        '''Send the running actions, if they changed'''
+        running = set(entity_key(task)
+                      for task in action_manager_self().running_tasks)
+        if running != self._running:
+            self._running = running
+            self.send((EV_RUNNING, sorted(running), None))
+
+    def _forward(self, ev_name, ent):
+        '''Send an event about ent'''
+        self._forward_running()
+        self.send((ev_name, entity_key(ent), entity_state(ent)))
+
+    def ev_started(self, obj):
+        self._forward(EV_STARTED, obj)
+
+    def ev_complete(self, obj):
+        self._forward(EV_COMPLETE, obj)
+
+    def ev_status_changed(self, obj):
+        self._forward(EV_STATUS_CHANGED, obj)
+
+    def ev_delayed(self, obj):
+        self._forward(EV_DELAYED, obj)
+
+    def ev_trigger_dep(self, obj_source, obj_triggered):
+        self.send((EV_TRIGGER_DEP, (entity_key(obj_source),
+                                    entity_key(obj_triggered)), None))
+
+    def ev_finished(self, obj):
+        pass
+
+
+def weak_components(manager, services):
+    '''
+    Return the weakly connected components of the graph reachable from
+    'services' (names of top-level services), as lists of those names.
+    '''
+    components = []
+    for name in services:
+        scope = manager.reachable([name])
+        merged = [name]
+        for comp in list(components):
+            if comp[1] & scope:
+                components.remove(comp)
+                merged.extend(comp[0])
+                scope |= comp[1]
+        components.append((merged, scope))
+    return [(sorted(names), scope) for names, scope in components]
+
+def split_components(components, count):
+    '''
+    Distribute components over count lists of service names, balancing
+    their number of entities.
+    '''
+    buckets = [[0, []] for _ in range(count)]
+    for names, scope in sorted(components, key=lambda comp: -len(comp[1])):
+        bucket = min(buckets, key=lambda item: item[0])
+        bucket[0] += len(scope)
+        bucket[1].extend(names)
+    return [sorted(names) for _, names in buckets if names]
+
+
+class ComponentRunner(object):
+    '''
+    Run an action on independent parts of a ServiceManager graph, each in
+    its own child process.
+    '''
+
+    def __init__(self, manager, workers):
+        self.manager = manager
+        self.workers = workers
+        self._logger = logging.getLogger('milkcheck')
+
+    def _entry_services(self):
+        '''Return the names of the services started first'''
+        spot = self.manager._source
+        if self.manager._algo_reversed:
+            spot = self.manager._sink
+        return sorted(spot.deps().keys())
+
+    def plan(self):
+        '''
+        Return the lists of services run by each process, or None if the
+        graph cannot be split.
+        '''
+        if self.workers < 2:
+            return None
+        components = weak_components(self.manager, self._entry_services())
+        if len(components) < 2:
+            return None
+        return split_components(components, self.workers)
+
+    def _child(self, services, fdesc, action):
+        '''Run action on services, in the child process'''
+        CallbackHandler._instance = None
+        forwarder = EventForwarder(fdesc)
+        call_back_self().attach(forwarder)
+        action_manager_self().fork_child()
+        self.manager.select_services(services)
+        self.manager.run(action)
+
+        states = []
+        for ent in iter_entities(self.manager):
+            if ent.status is not NO_STATUS:
+                states.append((entity_key(ent), entity_state(ent)))
+        forwarder.send((EV_END, (self.manager.status,
+                                 str(node_health_self().unreachable),
+                                 str(node_health_self().reachable),
+                                 action_manager_self().stopped), states))
+
+    def _fork(self, services, action):
+        '''Start a child process running action on services'''
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(rfd)
+            code = 0
+            try:
+                self._child(services, wfd, action)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+        os.close(wfd)
+        return pid, rfd
+
+    def run(self, action, plan):
+        '''Run action with a child process for each list of services'''
+        entities = dict((entity_key(ent), ent)
+                        for ent in iter_entities(self.manager))
+        # fdesc -> [pid, services, buffer, ended, running actions]
+        children = {}
+        for services in plan:
+            pid, fdesc = self._fork(services, action)
+            children[fdesc] = [pid, services, b'', False, set()]
+
+        statuses = []
+        try:
+            while children:
+                readable, _, _ = select.select(list(children), [], [])
+                for fdesc in readable:
+                    child = children[fdesc]
+                    try:
+                        data = os.read(fdesc, 65536)
+                    except OSError as exc:
+                        if exc.errno == errno.EINTR:
+                            continue
+                        raise
+                    child[2] += data
+                    child[2] = self._dispatch(child, entities, statuses,
+                                              children)
+                    if not data:
+                        os.close(fdesc)
+                        del children[fdesc]
+                        os.waitpid(child[0], 0)
+                        self._publish_running(children)
+                        if not child[3]:
+                            raise MilkCheckEngineError(
+                                    "Process running %s failed"
+                                    % ', '.join(child[1]))
+        finally:
+            self._kill(children)
+            action_manager_self().child_tasks = set()
+
+        for status in STATUS_SEVERITY:
+            if status in statuses:
+                self.manager.status = status
+                break
+        call_back_self().notify(self.manager, EV_FINISHED)
+
+    def _kill(self, children):
+        '''Kill and reap the child processes which are still running'''
+        for fdesc, child in list(children.items()):
+            try:
+                os.kill(child[0], signal.SIGTERM)
+            except OSError as exc:
+                if exc.errno != errno.ESRCH:
+                    raise
+            os.close(fdesc)
+            os.waitpid(child[0], 0)
+            del children[fdesc]
+
+    def _publish_running(self, children):
+        '''Show the actions running in children as running tasks'''
+        running = set()
+        for child in children.values():
+            running |= child[4]
+        action_manager_self().child_tasks = running
+
+    def _dispatch(self, child, entities, statuses, children):
+        '''Replay complete messages of buffer, return the remaining data'''
+        buf = child[2]
+        while len(buf) >= 4:
+            size = struct.unpack('!I', buf[:4])[0]
+            if len(buf) < 4 + size:
+                break
+            message = pickle.loads(buf[4:4 + size])
+            buf = buf[4 + size:]
+            ev_name, key, state = message
+            ev_name = EVENTS[ev_name]
+            if ev_name == EV_END:
+                status, unreachable, reachable, stopped = key
+                statuses.append(status)
+                if stopped:
+                    action_manager_self().stopped = stopped
+                node_health_self().unreachable.update(unreachable)
+                node_health_self().reachable.update(reachable)
+                for ent_key, ent_state in state:
+                    if ent_key in entities:
+                        apply_state(entities[ent_key], ent_state)
+                child[3] = True
+            elif ev_name == EV_RUNNING:
+                child[4] = set(entities[ent_key] for ent_key in key
+                               if ent_key in entities)
+                self._publish_running(children)
+            elif ev_name == EV_TRIGGER_DEP:
+                if key[0] in entities and key[1] in entities:
+                    call_back_self().notify((entities[key[0]],
+                                             entities[key[1]]), ev_name)
+            elif key in entities:
+                apply_state(entities[key], state)
+                call_back_self().notify(entities[key], ev_name)
+        return buf
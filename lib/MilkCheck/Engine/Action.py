@@ -36,74 +36,351 @@ It also contains the definition of a basic event handler and the
 ActionEventHandler and ActionManager.
 """
 
+import os
+import binascii
 import time
+import heapq
+import random
+import logging
 
-from ClusterShell.Worker.Popen import WorkerPopen
 from ClusterShell.Event import EventHandler
 from ClusterShell.NodeSet import NodeSet
-from ClusterShell.Task import task_self
-from ClusterShell.Worker.Exec import ExecWorker
 
 from MilkCheck.Callback import call_back_self
-from MilkCheck.Engine.BaseEntity import BaseEntity
+from MilkCheck.History import duration_history_self
+from MilkCheck.Engine.Backend import ClusterShellBackend, BackendWorker
+from MilkCheck.Engine.BaseEntity import BaseEntity, wave_size
+from MilkCheck.Engine.NodeHealth import node_health_self
 from MilkCheck.Engine.BaseEntity import DONE, TIMEOUT, ERROR, WAITING_STATUS, \
                                         NO_STATUS, DEP_ERROR, SKIPPED, WARNING
 from MilkCheck.Callback import EV_COMPLETE, EV_STARTED, EV_TRIGGER_DEP, \
                                EV_STATUS_CHANGED, EV_DELAYED, EV_FINISHED
 
 
+# Expected duration, in seconds, of actions without cost nor history
+DEFAULT_COST = 1.0
+
 class ActionManager(object):
     """
-    The action manager handle the evolution of the fanout through the current
-    running tasks. It provides two methods which allow the user to use
-    Action objects to perform task.This class is the only one where
-    clustershell is called
+    The action manager handles running actions and their fanout. Each action
+    gets its own concurrency window (its fanout). The global default fanout
+    is a window of slots shared by all workers: they wait in the manager,
+    by decreasing priority, until they fit in it. Commands are run by the
+    execution backend, ClusterShell unless another one is set.
     """
     _instance = None
 
     def __init__(self):
-        # entities handled by the manager
-        self.entities = {}
-        # Current fanout
-        self.fanout = None
-        # ClusterShell default value
-        self.default_fanout = 64
+        # Actions currently running
+        self._running = set()
+        # Actions running in child processes, see ComponentRunner
+        self.child_tasks = set()
         # Count tasks which worked
         self._tasks_done_count = 0
-        # Count tasks which are running
-        self._tasks_count = 0
-        # MasterTask
-        self._master_task = task_self()
+        # Execution backend, ClusterShell master task by default
+        self._backend = ClusterShellBackend()
+        # ClusterShell default value, also used as the global cap
+        self._default_fanout = None
+        self.default_fanout = 64
+
+        # Actions ready to be started, see flush_ready()
+        self._ready = []
+        self._flush_timer = None
+        # Workers waiting for global fanout slots, by decreasing priority
+        # (see _start_held()), and slots held by started workers
+        self._held = []
+        self._held_seq = 0
+        self._slots = {}
+        self._slots_used = 0
 
         self.dryrun = False
+        # Run ready actions with the same target in one command, see
+        # FusedCommand
+        self.fusion = False
+        # Run identical commands of ready actions once, on all their nodes
+        self.coalesce = False
+        # Abort the workers of actions which fail anyway, see
+        # ActionEventHandler.abort()
+        self.early_abort = False
+
+        # Stop the run as soon as an action fails, or at the deadline (a
+        # time), see stop()
+        self.fail_fast = False
+        self.deadline = None
+        self._deadline_timer = None
+        # Why the run was stopped, None while it goes on
+        self.stopped = None
+        # Started workers with their handler, and timers of delayed actions
+        self._workers = {}
+        self._delayed = {}
+
+    def _get_backend(self):
+        """Return the execution backend"""
+        return self._backend
+
+    def _set_backend(self, backend):
+        """Replace the execution backend, before running anything."""
+        self._backend = backend
+        backend.set_fanout(self.default_fanout)
+
+    backend = property(_get_backend, _set_backend)
+
+    def fork_child(self):
+        """Make the backend usable in a newly forked child process."""
+        self.child_tasks = set()
+        self._backend.fork_child()
+        self._backend.set_fanout(self.default_fanout)
+
+    def now(self):
+        """Return the current time, virtual one in simulation mode."""
+        return self._backend.now()
+
+    def _timer(self, fire, handler):
+        """Call handler.ev_timer() after fire seconds."""
+        return self._backend.timer(fire, handler)
+
+    def _get_default_fanout(self):
+        """Return the global fanout"""
+        return self._default_fanout
+
+    def _set_default_fanout(self, fanout):
+        """
+        Set the global fanout. It is the window shared by actions without
+        their own fanout and the upper bound of all per-action windows.
+        """
+        self._default_fanout = fanout
+        self._backend.set_fanout(fanout)
+
+    default_fanout = property(_get_default_fanout, _set_default_fanout)
+
+    def fanout_window(self, task):
+        """
+        Return the concurrency window of the task, or None if the task
+        shares the global window.
+        """
+        if not task.fanout or task.fanout < 1 or \
+           task.fanout >= self.default_fanout:
+            return None
+        return task.fanout
+
+    def perform_action(self, action, nodes=None):
+        """
+        Perform an immediate action, on its current target or only on
+        'nodes' for pipelined nodes.
 
-    def perform_action(self, action):
-        """Perform an immediate action"""
+        The action is queued and started once the current event is
+        processed, with the other actions which became ready meanwhile.
+        Actions heading the longest chains are started first.
+        """
         assert not action.to_skip(), "Action should be already SKIPPED"
 
+        self._delayed.pop(action, None)
         if not action.parent.simulate:
             self.add_task(action)
-        call_back_self().notify(action.parent, EV_STARTED)
+        action.running_workers += 1
 
-        nodes = None
-        if action.mode != 'delegate':
-            nodes = action.target
+        self._ready.append((action, nodes))
+        if self._flush_timer is None:
+            self._flush_timer = self._timer(0, ReadyQueueHandler(self))
+
+    def flush_ready(self):
+        """
+        Queue ready actions with the workers waiting for the global fanout,
+        then start those with the highest priority while they fit in it.
+        Priorities are computed now, once dependency preparation is over.
+        """
+        self._flush_timer = None
+        if self.deadline is not None and self.now() >= self.deadline:
+            self.stop("deadline reached")
+        ready = sorted(self._ready, key=lambda item: -item[0].priority())
+        self._ready = []
+        if self.stopped:
+            for action, _ in ready:
+                self._cancel(action)
+            return
+        units = self._group([[item] for item in ready], self._coalesce_key)
+        for group in self._group([[unit] for unit in units],
+                                 self._fusion_key):
+            if len(group) > 1:
+                shared = FusedCommand([unit[0][0] for unit in group])
+                self._hold_shared(shared, FusedEventHandler)
+            elif len(group[0]) > 1:
+                actions = [action for action, _ in group[0]]
+                self._hold_shared(SharedCommand(actions, actions[0].command),
+                                  CoalescedEventHandler)
+            else:
+                self._hold_action(*group[0][0])
+        self._start_held()
+
+    def _hold_action(self, action, nodes=None):
+        """Queue the worker of the action until it fits in the fanout."""
+        pipelined = nodes is not None
+        if not pipelined and action.mode != 'delegate':
+            nodes = action.wave_target()
 
         # In dry-run mode, all commands are replaced by a simple ':'
         command = ':'
         if not self.dryrun:
             command = action.command
 
-        if action.mode == 'exec':
-            wkr = ExecWorker(nodes=nodes, handler=ActionEventHandler(action),
-                             timeout=action.timeout, command=command,
-                             remote=action.remote)
-            self._master_task.schedule(wkr)
-        else:
-            self._master_task.shell(command, nodes=nodes,
-                                    timeout=action.timeout,
-                                    handler=ActionEventHandler(action),
-                                    remote=action.remote)
+        # Pipelined nodes are started one by one, they use the global window
+        fanout = None
+        if not pipelined:
+            fanout = self.fanout_window(action)
+
+        self._hold(action, [action], command, nodes, ActionEventHandler,
+                   fanout)
+
+    def _hold_shared(self, shared, handler_class):
+        """Queue the command shared by several actions, on all their nodes."""
+        nodes = None
+        for action in shared.actions:
+            if action.attempt_target() is not None:
+                nodes = NodeSet(nodes)
+                nodes.add(action.attempt_target())
+        self._hold(shared, shared.actions, shared.command, nodes,
+                   handler_class, self.fanout_window(shared.actions[0]))
+
+    def _hold(self, task, actions, command, nodes, handler_class, fanout):
+        """
+        Queue a worker to start, by the priority of its actions. It needs as
+        many global slots as it can run nodes at once: its window, or the
+        global one, bounded by its nodes.
+        """
+        count = 1
+        if nodes is not None:
+            count = len(nodes)
+        need = min(fanout or self.default_fanout, count)
+        priority = max(action.priority() for action in actions)
+        heapq.heappush(self._held, (-priority, self._held_seq,
+                                    (task, actions, command, nodes,
+                                     handler_class, fanout, need,
+                                     self.now())))
+        self._held_seq += 1
+
+    def _start_held(self):
+        """
+        Start queued workers, by decreasing priority, while the global fanout
+        has free slots. Workers are not started before those with a higher
+        priority. A worker starts once half of the slots it needs are free
+        and runs with those it got: waiting for all of them could leave slots
+        unused for long.
+        """
+        while self._held:
+            task, actions, command, nodes, handler_class, fanout, need, \
+                queued = self._held[0][2]
+            free = self.default_fanout - self._slots_used
+            if free * 2 < need:
+                break
+            heapq.heappop(self._held)
+            wait = self.now() - queued
+            if wait > 0:
+                self._backend.record_wait(None, self.default_fanout, need,
+                                          wait)
+            if free < need:
+                need = fanout = free
+            for action in actions:
+                call_back_self().notify(action.parent, EV_STARTED)
+            handler = handler_class(task)
+            worker = self._backend.schedule(task, command, nodes, handler,
+                                            fanout, self._worker_timeout(task))
+            self._workers[worker] = handler
+            # Slots held by the worker and count of its nodes not done yet
+            count = 1
+            if nodes is not None:
+                count = len(nodes)
+            self._slots[worker] = [need, count]
+            self._slots_used += need
+
+    def node_done(self, worker):
+        """
+        A node of worker ended: the worker no longer needs more slots than
+        its nodes not done yet.
+        """
+        slots = self._slots.get(worker)
+        if slots is None:
+            return
+        slots[1] -= 1
+        if slots[1] < slots[0]:
+            slots[0] -= 1
+            self._slots_used -= 1
+            self._wake()
+
+    def _wake(self):
+        """Start queued workers once the current event is processed."""
+        if self._held and self._flush_timer is None:
+            self._flush_timer = self._timer(0, ReadyQueueHandler(self))
+
+    def _worker_timeout(self, task):
+        '''
+        Return the timeout of the worker of task: the one of task, bounded
+        by the time left before the deadline. The timeout of task is not
+        changed.
+        '''
+        timeout = task.timeout
+        if self.deadline is not None:
+            left = max(self.deadline - self.now(), 0)
+            if not timeout or timeout > left:
+                timeout = left
+        return timeout
+
+    def _cancel(self, action):
+        '''
+        Close an action which was about to start: the nodes of its try are
+        aborted, as if its worker was.
+        '''
+        handler = ActionEventHandler(action)
+        handler.give_up()
+        handler.ev_close(BackendWorker(action, action.command, None, None))
+
+    def _shareable(self, action, nodes):
+        '''Tell if the command of action could run for other actions too.'''
+        return not self.dryrun and not self._backend.simulated and \
+               nodes is None and action.mode is None and not action.rolling
+
+    def _coalesce_key(self, unit):
+        '''
+        Return the key of the actions running the same command as the one of
+        unit, None if it runs alone.
+        '''
+        action, nodes = unit[0]
+        if not self.coalesce or not self._shareable(action, nodes):
+            return None
+        return (action.command, action.remote, action.timeout,
+                self.fanout_window(action), action.attempt_target() is None)
+
+    def _fusion_key(self, group):
+        '''
+        Return the key of the actions which could be fused with the one of
+        group, None if it runs alone. Coalesced actions are not fused, nor
+        actions with a timeout: it could not be enforced for each command.
+        '''
+        if len(group[0]) > 1:
+            return None
+        action, nodes = group[0][0]
+        if not self.fusion or not self._shareable(action, nodes) or \
+           not action.attempt_target() or action.timeout:
+            return None
+        return (str(action.attempt_target()), action.remote,
+                self.fanout_window(action))
+
+    def _group(self, groups, key):
+        '''
+        Merge the groups which have the same key, keeping their order. A
+        None key keeps a group alone.
+        '''
+        merged = []
+        bykey = {}
+        for group in groups:
+            gkey = key(group)
+            if gkey is None:
+                merged.append(group)
+            elif gkey in bykey:
+                bykey[gkey].extend(group)
+            else:
+                bykey[gkey] = list(group)
+                merged.append(bykey[gkey])
+        return merged
 
     def perform_delayed_action(self, action):
         """Perform a delayed action and add it to the running tasks"""
@@ -112,82 +389,103 @@ class ActionManager(object):
         if not action.parent.simulate:
             self.add_task(action)
             call_back_self().notify(action, EV_DELAYED)
-        self._master_task.timer(handler=ActionEventHandler(action),
-                                fire=action.delay)
+        self._delayed[action] = self._timer(action.next_delay,
+                                            ActionEventHandler(action))
 
     def add_task(self, task):
         """
-        Fanout goes down whether it is lower than the current
-        fanout. Each time the task is added to right category
-        if it already belongs to the category the task is not
-        added
+        Add the task to the running tasks. If it is already running
+        the task is not added
         """
         assert task, 'You cannot add a None task to the manager'
         # Task is not already running
         if not self._is_running_task(task):
-            # No fanout or invalid value, fanout gets the default value
-            fnt = task.fanout or self.default_fanout
-            # Create the category if it does not exist
-            if not fnt in self.entities:
-                self.entities[fnt] = set()
-            # New fnt is lower than the current fanout
-            if not self.fanout or fnt < self.fanout:
-                self._master_task.set_info('fanout', fnt)
-                self.fanout = fnt
-            # Finally add the task and manage counters
-            self.entities[fnt].add(task)
+            self._running.add(task)
             self._tasks_done_count += 1
-            self._tasks_count += 1
+        # The deadline is only watched while tasks are running, so that it
+        # does not keep the backend busy
+        if self.deadline is not None and self._deadline_timer is None and \
+           not self.stopped:
+            self._deadline_timer = self._timer(
+                                    max(self.deadline - self.now(), 0),
+                                    DeadlineHandler(self))
 
     def remove_task(self, task):
-        """
-        Fanout goes up whether the current task represents the lower
-        fanout available and not any task owns the same fanout
-        """
+        """Remove the task from the running tasks"""
         assert task, 'You cannot take out a None task'
         # Task given as parameter is not already running
         if self._is_running_task(task):
-            # Checkout the right value for the fanout
-            fnt = task.fanout or self.default_fanout
-            # Remove task
-            self.entities[fnt].remove(task)
+            self._running.remove(task)
             call_back_self().notify(task.parent, EV_COMPLETE)
-
-            # Category is empty so we delete it and we update
-            # the value of the current fanout
-            if len(self.entities[fnt]) == 0:
-                del self.entities[fnt]
-                if self.entities:
-                    self.fanout = sorted(self.entities.keys())[0]
-                    self._master_task.set_info('fanout', self.fanout)
-                else:
-                    self.fanout = None
-            # Current number of task is decremented
-            self._tasks_count -= 1
         if not self.tasks_count:
+            self._unwatch_deadline()
             call_back_self().notify(task.parent, EV_FINISHED)
 
+    def _unwatch_deadline(self):
+        '''Cancel the deadline timer, if any'''
+        if self._deadline_timer is not None:
+            self._backend.cancel(self._deadline_timer)
+            self._deadline_timer = None
+
+    def reset_stop(self):
+        '''
+        Forget why a previous run was stopped, before a new one. The
+        deadline and fail_fast are set again for each run.
+        '''
+        self._unwatch_deadline()
+        self.stopped = None
+
+    def deadline_reached(self):
+        '''Called by the deadline timer'''
+        self._deadline_timer = None
+        self.stop("deadline reached")
+
+    def release(self, worker):
+        '''Forget a closed worker and free its slots'''
+        self._workers.pop(worker, None)
+        slots = self._slots.pop(worker, None)
+        if slots is not None:
+            self._slots_used -= slots[0]
+            self._wake()
+
+    def stop(self, reason):
+        '''
+        Stop the run: actions are no longer started, those which should be
+        are closed with their nodes aborted, like those running now, and
+        become ERROR. The run ends with consistent statuses, their
+        dependencies are resolved as usual.
+        '''
+        if self.stopped:
+            return
+        self.stopped = reason
+        logging.getLogger('milkcheck').warning("Run stopped: %s" % reason)
+        self._unwatch_deadline()
+        for worker, handler in list(self._workers.items()):
+            handler.abort(worker)
+        held, self._held = self._held, []
+        for _, _, item in held:
+            for action in item[1]:
+                self._cancel(action)
+        # Delayed actions are started now, so they are cancelled
+        for action, timer in list(self._delayed.items()):
+            self._backend.cancel(timer)
+            action.schedule(allow_delay=False)
+
     def _is_running_task(self, task):
         """
         Allow us to determine whether a task is running or not
         """
         assert task, 'Task cannot be None'
-        if not task.fanout or task.fanout < 1:
-            return task in self.entities.get(self.default_fanout, [])
-        return task in self.entities.get(task.fanout, [])
+        return task in self._running
 
     def run(self):
         """ Run the action manager task"""
-        if not self._master_task.running():
-            self._master_task.run()
+        self._backend.run()
 
     @property
     def running_tasks(self):
-        """Return a set of running tasks"""
-        running_tasks = set()
-        for tasks in self.entities.values():
-            running_tasks.update(tasks)
-        return running_tasks
+        """Return a copy of the set of running tasks"""
+        return self._running | self.child_tasks
 
     @property
     def tasks_count(self):
@@ -195,7 +493,7 @@ class ActionManager(object):
         Make the property read only and returns the current number of
         tasks running
         """
-        return self._tasks_count
+        return len(self._running)
 
     @property
     def tasks_done_count(self):
@@ -212,6 +510,30 @@ def action_manager_self():
     return ActionManager._instance
 
 
+class DeadlineHandler(EventHandler):
+    '''Stop the run of the ActionManager at its deadline.'''
+
+    def __init__(self, manager):
+        EventHandler.__init__(self)
+        self._manager = manager
+
+    def ev_timer(self, timer):
+        '''The deadline is reached'''
+        self._manager.deadline_reached()
+
+
+class ReadyQueueHandler(EventHandler):
+    '''Start actions queued in the ActionManager.'''
+
+    def __init__(self, manager):
+        EventHandler.__init__(self)
+        self._manager = manager
+
+    def ev_timer(self, timer):
+        '''Actions ready during the previous events can be started'''
+        self._manager.flush_ready()
+
+
 class MilkCheckEventHandler(EventHandler):
     '''
     The basic event handler for MilkCheck derives the class provided
@@ -246,44 +568,128 @@ class ActionEventHandler(MilkCheckEventHandler):
     Inherit from our basic handler and specify others event raised to
     process an action.
     '''
-    
+
+    def __init__(self, action):
+        MilkCheckEventHandler.__init__(self, action)
+        # The worker is being aborted, or is closed
+        self._aborting = False
+        self._closed = False
+
+    def ev_pickup(self, worker):
+        '''Command has been started on a node'''
+        node = worker.current_node or 'localhost'
+        start = action_manager_self().now()
+        self._action.node_times[node] = [start, None, None]
+
     def ev_hup(self, worker):
         '''Update remaining target'''
-        self._action.pending_target.remove(worker.current_node)
+        node = worker.current_node
+        self._action.pending_target.remove(node)
+        times = self._action.node_times.get(node or 'localhost')
+        if times:
+            times[1:] = [action_manager_self().now(), worker.current_rc]
+        node_health_self().update(self._action, node, worker.current_rc,
+                    action_manager_self().backend.node_buffer(worker, node))
+        action_manager_self().node_done(worker)
+        # The service is done on this node, pipelined services can go on
+        if node is not None and worker.current_rc == 0 and \
+           not self._action.children:
+            self._action.parent.node_done(node)
+        # Once the action fails anyway, its other nodes are not waited for.
+        # Shared workers run other actions too, they are not aborted.
+        if worker.current_rc != 0 and self._action.count_failure() and \
+           action_manager_self().early_abort and worker.eh is self and \
+           self._action.running_workers == 1 and not self._aborting:
+            logger = logging.getLogger('milkcheck')
+            logger.warning("%s: too many failures, aborted on %s"
+                           % (self._action.fullname(),
+                              self._action.pending_target))
+            self.abort(worker)
+
+    def give_up(self):
+        '''
+        Abort the nodes of the action which are not done yet. Return False
+        if the worker is already aborted or closed.
+        '''
+        if self._aborting or self._closed:
+            return False
+        self._aborting = True
+        self._action.abort()
+        return True
+
+    def abort(self, worker):
+        '''
+        Stop the worker of the action: its nodes not done yet are aborted
+        and the action is closed as ERROR.
+        '''
+        if self.give_up():
+            action_manager_self().backend.abort(worker)
 
     def ev_close(self, worker):
         '''
         This event is raised by the master task as soon as an action is
         done. It specifies the how the action will be computed.
         '''
+        # Aborted workers may be closed twice, see ClusterShellBackend
+        if self._closed:
+            return
+        self._closed = True
+        action_manager_self().release(worker)
+
         # Assign time duration to the current action
-        self._action.stop_time = time.time()
+        self._action.stop_time = action_manager_self().now()
+
+        # Nodes which timed out could be down
+        backend = action_manager_self().backend
+        if self._action.target is not None and not backend.simulated:
+            node_health_self().timed_out(self._action,
+                                         backend.nodes_timeout(worker),
+                                         backend.timer)
+
+        # Get back the worker from ClusterShell, wait for the other ones
+        # if the action runs on pipelined nodes too.
+        if not self._action.close_worker(worker):
+            return
+
+        # Rolling actions go on with their next wave
+        if self._action.next_wave():
+            return
 
         # Remove the current action from the running task, this will trigger
         # a redefinition of the current fanout
         action_manager_self().remove_task(self._action)
 
-        # Get back the worker from ClusterShell
-        self._action.worker = worker
+        # Only pipelined nodes were run, the action is not scheduled yet
+        if self._action.tries == 0 and self._action.pipelined_nodes:
+            return
 
+        self.close_action()
+
+    def close_action(self):
+        '''Compute the action status once all its workers are closed.'''
         # Checkout actions issues
         errors = self._action.nb_errors()
         timeouts = self._action.nb_timeout()
         failed = errors + timeouts
 
-        # Classic Action was failed
-        if failed and self._action.tries <= self._action.maxretry:
-            self._action.schedule()
+        # Classic Action was failed, aborted actions are not retried
+        aborted = self._action.aborted_nodes
+        if failed and self._action.tries <= self._action.maxretry and \
+           not aborted and self._action.retry():
             return
 
         # There will be no more schedule(), save error node list for later
         # propagation if required. Local action does not filter.
         if self._action.target is not None:
             nodes = self._action.nodes_error() | self._action.nodes_timeout()
-            self._action.filter_nodes(nodes)
+            self._action.filter_nodes(nodes | aborted)
 
+        # An aborted action, or a rolling action which spent its failure
+        # budget, failed
+        if aborted:
+            self._action.update_status(ERROR)
         # timeout when more timeouts than permited
-        if timeouts > self._action.errors and errors == 0:
+        elif timeouts > self._action.errors and errors == 0:
             self._action.update_status(TIMEOUT)
         # _action.errors has a higher priority than _action.warnings
         # failed when too many errors
@@ -295,6 +701,296 @@ class ActionEventHandler(MilkCheckEventHandler):
         else:
             self._action.update_status(DONE)
 
+        manager = action_manager_self()
+        if self._action.status in (ERROR, TIMEOUT) and manager.fail_fast:
+            manager.stop("%s is %s" % (self._action.fullname(),
+                                       self._action.status))
+
+class WorkerResults(object):
+    '''
+    Results of several workers of the same action, read like those of a
+    single worker. Workers ran on distinct nodes, or are the tries of the
+    action: nodes which were tried again only keep their last result.
+    '''
+
+    def __init__(self, workers):
+        self._workers = workers
+        self.command = workers[-1].command
+        self.current_node = workers[-1].current_node
+
+    def _latest(self):
+        '''
+        Return the [retcode, timed out, buffer] results by node, from the
+        last worker which ran each node.
+        '''
+        latest = {}
+        backend = action_manager_self().backend
+        for worker in self._workers:
+            ran = {}
+            for retcode, nodes in backend.iter_retcodes(worker):
+                for node in NodeSet(nodes):
+                    ran.setdefault(node, [None, False, None])[0] = retcode
+            for node in backend.nodes_timeout(worker):
+                ran.setdefault(node, [None, False, None])[1] = True
+            for buf, nodes in backend.iter_buffers(worker):
+                for node in NodeSet(nodes):
+                    ran.setdefault(node, [None, False, None])[2] = buf
+            latest.update(ran)
+        return latest
+
+    def iter_buffers(self):
+        '''Iterate over (buffer, nodes) pairs, nodes with same output merged'''
+        merged = {}
+        for node, (_, _, buf) in self._latest().items():
+            if buf is not None:
+                merged.setdefault(bytes(buf), (buf, NodeSet()))[1].add(node)
+        return iter(merged.values())
+
+    def iter_retcodes(self):
+        '''Iterate over (retcode, nodes) pairs'''
+        merged = {}
+        for node, (retcode, _, _) in self._latest().items():
+            if retcode is not None:
+                merged.setdefault(retcode, NodeSet()).add(node)
+        return iter(merged.items())
+
+    def iter_keys_timeout(self):
+        '''Iterate over timed out nodes'''
+        return iter([node for node, (_, timedout, _) in self._latest().items()
+                     if timedout])
+
+
+class SharedCommand(object):
+    '''
+    Command run once for several actions with the same mode, remote flag
+    and timeout. Looks like an action to the execution backends.
+    '''
+
+    mode = None
+
+    def __init__(self, actions, command):
+        self.actions = actions
+        self.remote = actions[0].remote
+        self.timeout = actions[0].timeout
+        self.fanout = actions[0].fanout
+        self.command = command
+
+    def fullname(self):
+        '''Return the name of the sharing actions'''
+        return '+'.join(action.fullname() for action in self.actions)
+
+
+class FusedCommand(SharedCommand):
+    '''
+    Several actions run on their common target as one shell script. Each
+    command ends with a marker line giving its return code and the time it
+    ended, used to split the script output back into per-action results.
+    '''
+
+    MARKER = 'MILKCHECK-FUSION'
+
+    # '%' is escaped from the command patterns
+    STAMP = '$(date +%%s.%%N)'
+
+    def __init__(self, actions):
+        self.marker = '%s-%s' % (self.MARKER,
+                                 binascii.hexlify(os.urandom(6)).decode())
+        script = ['echo "%s start %s"' % (self.marker, self.STAMP)]
+        script.extend('(\n%s\n)\necho "%s $? %s"'
+                      % (action.command, self.marker, self.STAMP)
+                      for action in actions)
+        SharedCommand.__init__(self, actions, '\n'.join(script))
+
+    @staticmethod
+    def _stamp(fields):
+        '''Return the time in the marker fields, None if date lacks it'''
+        try:
+            return float(fields[0])
+        except (IndexError, ValueError):
+            return None
+
+    def split(self, buf):
+        '''
+        Split the script output of a node. Return the (output, retcode,
+        elapsed) triples of the commands which ended, elapsed being the
+        seconds from the script start to the command end (None if unknown),
+        and the output of the next command.
+        '''
+        marker = self.marker.encode()
+        results = []
+        lines = []
+        start = None
+        for line in (buf or b'').split(b'\n'):
+            pos = line.find(marker)
+            if pos < 0:
+                lines.append(line)
+                continue
+            # The output did not end with a newline
+            if pos:
+                lines.append(line[:pos])
+            fields = line[pos + len(marker):].split()
+            stamp = self._stamp(fields[1:])
+            if fields[0] == b'start':
+                start = stamp
+                continue
+            elapsed = None
+            if start is not None and stamp is not None:
+                elapsed = stamp - start
+            results.append((b'\n'.join(lines), int(fields[0]), elapsed))
+            lines = []
+        return results, b'\n'.join(lines)
+
+
+class SharedEventHandler(EventHandler):
+    '''
+    Dispatch the events of a shared command to the handlers of its actions,
+    with one worker per action holding its own results. Subclasses tell
+    what each action gets from a node in _results().
+    '''
+
+    HANDLER = ActionEventHandler
+
+    def __init__(self, shared):
+        EventHandler.__init__(self)
+        self._shared = shared
+        self._handlers = [(self.HANDLER(action),
+                           BackendWorker(action, action.command,
+                                         action.attempt_target(), None))
+                          for action in shared.actions]
+        self._closed = False
+
+    def _concerns(self, aworker, node):
+        '''Tell if node belongs to the action of aworker'''
+        return node is None or node in aworker.keys
+
+    def _results(self, node, buf, retcode):
+        '''
+        Return the (output, retcode) pair of each action on node, None for
+        actions not run on it. A None retcode is a timeout.
+        '''
+        raise NotImplementedError
+
+    def ev_start(self, worker):
+        '''Command has been started on a nodeset'''
+        for handler, aworker in self._handlers:
+            handler.ev_start(aworker)
+
+    def ev_pickup(self, worker):
+        '''Command has been started on a node'''
+        for handler, aworker in self._handlers:
+            if self._concerns(aworker, worker.current_node):
+                aworker.current_node = worker.current_node
+                handler.ev_pickup(aworker)
+
+    def _dispatch(self, node, buf, retcode):
+        '''Give each action its result on node'''
+        results = self._results(node, buf, retcode)
+        for (handler, aworker), result in zip(self._handlers, results):
+            if result is None:
+                continue
+            output, code = result
+            if output:
+                aworker._buffers[node] = output
+            if code is None:
+                aworker._timeouts.append(node)
+                continue
+            aworker.current_node = node
+            aworker.current_rc = code
+            aworker._retcodes[node] = code
+            handler.ev_hup(aworker)
+
+    def ev_hup(self, worker):
+        '''The command ended on a node'''
+        node = worker.current_node
+        action_manager_self().node_done(worker)
+        backend = action_manager_self().backend
+        self._dispatch(node, backend.node_buffer(worker, node),
+                       worker.current_rc)
+
+    def abort(self, worker):
+        '''
+        Stop the shared worker: the nodes not done yet are aborted for all
+        its actions.
+        '''
+        if self._closed:
+            return
+        for handler, _ in self._handlers:
+            handler.give_up()
+        action_manager_self().backend.abort(worker)
+
+    def ev_close(self, worker):
+        '''The command ended everywhere, close all actions'''
+        if self._closed:
+            return
+        self._closed = True
+        action_manager_self().release(worker)
+        backend = action_manager_self().backend
+        for node in backend.nodes_timeout(worker):
+            if node == 'localhost' and self._shared.actions[0].target is None:
+                node = None
+            self._dispatch(node, backend.node_buffer(worker, node), None)
+        for handler, aworker in self._handlers:
+            handler.ev_close(aworker)
+
+
+class FusedActionEventHandler(ActionEventHandler):
+    '''Handle an action run in a fused command.'''
+
+    def close_action(self):
+        '''The action lasted from its first node start to its last node end'''
+        ended = [times for times in self._action.node_times.values()
+                 if times[1] is not None]
+        if ended:
+            self._action.start_time = min(times[0] for times in ended)
+            self._action.stop_time = max(times[1] for times in ended)
+        ActionEventHandler.close_action(self)
+
+
+class FusedEventHandler(SharedEventHandler):
+    '''Split the output of a fused command between its actions.'''
+
+    HANDLER = FusedActionEventHandler
+
+    def _results(self, node, buf, retcode):
+        '''
+        Actions which did not end get the script retcode, or time out if
+        retcode is None.
+        '''
+        results, rest = self._shared.split(buf)
+        results = [(output, code) for output, code, _ in results]
+        for _ in self._handlers[len(results):]:
+            results.append((rest, retcode))
+            rest = b''
+        return results
+
+    def _dispatch(self, node, buf, retcode):
+        '''
+        Node times of the actions are those of their own command, from the
+        script timestamps, instead of the whole script ones.
+        '''
+        SharedEventHandler._dispatch(self, node, buf, retcode)
+        results, _ = self._shared.split(buf)
+        pickup = None
+        previous = 0
+        for (_, aworker), (_, _, elapsed) in zip(self._handlers, results):
+            times = aworker.action.node_times.get(node or 'localhost')
+            if elapsed is None or not times:
+                break
+            if pickup is None:
+                pickup = times[0]
+            times[:2] = [pickup + previous, pickup + elapsed]
+            previous = elapsed
+
+
+class CoalescedEventHandler(SharedEventHandler):
+    '''Give each action the results of the nodes of its own target.'''
+
+    def _results(self, node, buf, retcode):
+        '''Actions run on node all get its output and retcode'''
+        return [(buf, retcode) if self._concerns(aworker, node) else None
+                for _, aworker in self._handlers]
+
+
 class Action(BaseEntity):
     """
     This class models an action. An action is generally hooked to a service
@@ -314,6 +1010,28 @@ class Action(BaseEntity):
         # Number of action tries
         self.tries = 0
 
+        # Nodes of the next try, if not the whole target
+        self._retry_nodes = None
+
+        # Time to wait before the next try
+        self.next_delay = 0
+
+        # Nodes started before the action is scheduled, see pipeline()
+        self.pipelined_nodes = NodeSet()
+
+        # Rolling actions: nodes of the next waves of the current try, and
+        # nodes not run once the failure budget is spent or the action is
+        # aborted
+        self._waves_left = None
+        self.aborted_nodes = NodeSet()
+
+        # Failed nodes of the current try, counted as results arrive
+        self.failures = 0
+
+        # Workers of the current try: running count and closed ones
+        self.running_workers = 0
+        self._workers = []
+
         # Command lines that we would like to run
         self.command = command
 
@@ -327,6 +1045,9 @@ class Action(BaseEntity):
         # Store pending targets
         self.pending_target = NodeSet()
 
+        # Start time, stop time and retcode of the last try, by node
+        self.node_times = {}
+
     def reset(self):
         '''
         Reset values of attributes in order to used the action multiple time.
@@ -336,6 +1057,15 @@ class Action(BaseEntity):
         self.stop_time = None
         self.worker = None
         self.tries = 0
+        self._retry_nodes = None
+        self.next_delay = 0
+        self.pipelined_nodes = NodeSet()
+        self._waves_left = None
+        self.aborted_nodes = NodeSet()
+        self.failures = 0
+        self.running_workers = 0
+        self._workers = []
+        self.node_times = {}
 
     def run(self):
         '''Prepare the current action and set up the master task'''
@@ -362,9 +1092,11 @@ class Action(BaseEntity):
         # NO_STATUS and not any dep in progress for the current action
         if self.status is NO_STATUS and deps_status is not WAITING_STATUS:
 
-            # Remove nodes marked on error by our filter dependencies
+            # Remove nodes marked on error by our filter dependencies, and
+            # the nodes which were unreachable so far
             if self.target:
                 self.target -= self.parent.failed_nodes
+                self.target = node_health_self().prune(self, self.target)
 
             if self.to_skip():
                 self.update_status(SKIPPED)
@@ -408,11 +1140,7 @@ class Action(BaseEntity):
     def nodes_timeout(self):
         """Get nodeset of timeout nodes for this action."""
         if self.worker:
-            if isinstance(self.worker, WorkerPopen):
-                if self.worker.did_timeout():
-                    return NodeSet("localhost")
-            else:
-                return NodeSet.fromlist(list(self.worker.iter_keys_timeout()))
+            return action_manager_self().backend.nodes_timeout(self.worker)
         return NodeSet()
 
     def nb_timeout(self):
@@ -423,15 +1151,10 @@ class Action(BaseEntity):
         """Get nodeset of error nodes for this action."""
         error_nodes = NodeSet()
         if self.worker:
-            if isinstance(self.worker, WorkerPopen):
-                retcode = self.worker.retcode()
-                # We don't count timeout (retcode=None)
-                if retcode not in (None, 0):
-                    error_nodes = NodeSet("localhost")
-            else:
-                for retcode, nds in self.worker.iter_retcodes():
-                    if retcode != 0:
-                        error_nodes.add(nds)
+            backend = action_manager_self().backend
+            for retcode, nds in backend.iter_retcodes(self.worker):
+                if retcode != 0:
+                    error_nodes.add(nds)
         return error_nodes
 
     def nb_errors(self):
@@ -448,22 +1171,179 @@ class Action(BaseEntity):
         else:
             return None
 
+    def expected_duration(self):
+        '''
+        Return the expected duration of the action, in seconds: its cost
+        if set, else its duration in the run history.
+        '''
+        if self.cost is not None:
+            return float(self.cost)
+        duration = duration_history_self().estimate(self.fullname())
+        if duration is None:
+            return DEFAULT_COST
+        return duration
+
+    def priority(self):
+        '''
+        Return the expected duration of the longest chain of actions which
+        starts with this one.
+        '''
+        return self.expected_duration() + self.parent.downstream_priority()
+
+    def attempt_target(self):
+        '''Return the nodes on which the next try runs.'''
+        if self._retry_nodes is not None:
+            return self._retry_nodes
+        if self.pipelined_nodes and self.target is not None:
+            return self.target - self.pipelined_nodes
+        return self.target
+
+    def wave_target(self):
+        '''
+        Return the nodes on which the next try runs, or for rolling actions,
+        those of its next wave: the canary first, then batches.
+        '''
+        nodes = self.attempt_target()
+        if not self.rolling or nodes is None:
+            return nodes
+        size = self.rolling['batch']
+        if self._waves_left is None:
+            self._waves_left = NodeSet(nodes)
+            size = self.rolling.get('canary', size)
+        wave = NodeSet.fromlist(list(self._waves_left)[:wave_size(size,
+                                                                 len(nodes))])
+        self._waves_left.difference_update(wave)
+        return wave
+
+    def next_wave(self):
+        '''
+        Start the next wave of a rolling action, unless it was the last one
+        or the failure budget ('max_failures', 'errors' by default) is spent.
+        Return True if a wave was started.
+        '''
+        if not self._waves_left:
+            self._waves_left = None
+            return False
+        budget = self.rolling.get('max_failures', self.errors)
+        if self.nb_errors() + self.nb_timeout() > budget:
+            self.aborted_nodes = self._waves_left
+            self.pending_target.difference_update(self.aborted_nodes)
+            self._waves_left = None
+            logger = logging.getLogger('milkcheck')
+            logger.warning("%s: too many failures, not run on %s"
+                           % (self.fullname(), self.aborted_nodes))
+            return False
+        action_manager_self().perform_action(self)
+        return True
+
+    def count_failure(self):
+        '''
+        Count a failed node of the current try. Return True if the action
+        fails anyway: it has too many errors and no retry left.
+        '''
+        self.failures += 1
+        return self.failures > self.errors and self.tries > self.maxretry
+
+    def abort(self):
+        '''
+        Give up the nodes of the current try which are not done yet, and
+        the next waves of rolling actions.
+        '''
+        self.aborted_nodes = NodeSet(self.pending_target)
+        if self._waves_left:
+            self.aborted_nodes.add(self._waves_left)
+        if self.target is None:
+            self.aborted_nodes.add('localhost')
+        self._waves_left = None
+
+    def can_pipeline(self, node):
+        '''
+        Tell if the action could be started on node alone, before its
+        dependencies are done on all nodes.
+        '''
+        return self.status is NO_STATUS and self.tries == 0 and \
+               not self.parents and not self.delay and \
+               self.mode != 'delegate' and not self.rolling and \
+               self.target is not None and \
+               node in self.target and node not in self.pipelined_nodes and \
+               node not in self.parent.failed_nodes
+
+    def pipeline(self, nodes):
+        '''
+        Run the action on nodes right now. When the action is scheduled,
+        it only runs on the other nodes of its target, and its status is
+        computed from the results of all of them.
+        '''
+        if not self.start_time:
+            self.start_time = action_manager_self().now()
+        self.pipelined_nodes.add(nodes)
+        self.pending_target.add(nodes)
+        action_manager_self().perform_action(self, nodes)
+
+    def close_worker(self, worker):
+        '''
+        Keep the results of a closed worker, merged with those of the other
+        workers and tries of the action. Return True if no other worker of
+        the action is still running.
+        '''
+        self.running_workers -= 1
+        self.worker = worker
+        if self.pipelined_nodes or self.rolling or self.tries > 1:
+            self._workers.append(worker)
+            if len(self._workers) > 1:
+                self.worker = WorkerResults(self._workers)
+        return self.running_workers <= 0
+
+    def _schedule_delay(self):
+        '''
+        Return the time to wait before the next try: the delay, or for
+        retries, an exponential backoff with jitter if one is set.
+        '''
+        if self.tries and self.backoff:
+            wait = self.backoff * 2 ** (self.tries - 1)
+            return random.uniform(wait / 2.0, wait)
+        return self.delay
+
+    def retry(self):
+        '''
+        Schedule the action again, only on the nodes which failed. Nodes
+        which succeeded keep their result, unreachable ones are not tried
+        again. Return False if there is nothing to retry.
+        '''
+        if self.mode != 'delegate' and self.target is not None:
+            self._retry_nodes = node_health_self().prune(self,
+                                    self.nodes_error() | self.nodes_timeout())
+            if not self._retry_nodes:
+                return False
+        # Results of the previous tries are merged with the next ones
+        if not self._workers:
+            self._workers.append(self.worker)
+        self.schedule()
+        return True
+
     def schedule(self, allow_delay=True):
         '''
         Schedule the current action within the master task. The current action
         could be delayed or fired right now depending of it properties.
         '''
         if not self.start_time:
-            self.start_time = time.time()
+            self.start_time = action_manager_self().now()
 
-        self.pending_target.add(self.target)
+        self.pending_target.add(self.attempt_target())
 
-        if self.delay > 0 and allow_delay:
+        self.next_delay = self._schedule_delay()
+        if self.next_delay > 0 and allow_delay:
             # Action will be started as soon as the timer is done
             action_manager_self().perform_delayed_action(self)
         else:
             # Fire this action
             self.tries += 1
+            self.failures = 0
+            if self.pipelined_nodes and not self.attempt_target():
+                # All nodes were pipelined, wait for them if needed
+                if not self.running_workers:
+                    ActionEventHandler(self).close_action()
+                return
             action_manager_self().perform_action(self)
 
     def fromdict(self, actdict):
@@ -473,6 +1353,12 @@ class Action(BaseEntity):
         if 'cmd' in actdict:
             self.command = actdict['cmd']
 
+    def iter_templates(self):
+        """Iterate over (entity, value) pairs resolved by resolve_all()"""
+        for item in BaseEntity.iter_templates(self):
+            yield item
+        yield (self, self.command)
+
     def resolve_all(self):
         """Resolve all properties from the entity"""
         BaseEntity.resolve_all(self)
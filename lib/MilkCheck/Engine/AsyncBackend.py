@@ -0,0 +1,213 @@
+#
+# Copyright CEA (2026)
+#
+# This file is part of MilkCheck project.
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading,  using,  modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean  that it is complicated to manipulate,  and  that  also
+# therefore means  that it is reserved for developers  and  experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and,  more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+"""
+This module contains the asyncio execution backend. Nodes of an action run
+as asyncio tasks, fanout windows are semaphores and delays are sleeps, so
+that the engine can share an event loop with other asynchronous work.
+"""
+
+import os
+import signal
+import asyncio
+
+from MilkCheck.Engine.Backend import ExecutionBackend, BackendWorker, \
+                                     command_args
+
+# Commands starting with this prefix run a check coroutine, not a process
+CHECK_PREFIX = '@'
+
+async def tcp_check(node, args):
+    '''
+    Check that TCP port args[0] is open on node, without any process. The
+    command is '@tcp PORT'.
+    '''
+    try:
+        port = int(args[0])
+    except (IndexError, ValueError):
+        return 2, b'usage: @tcp PORT'
+    try:
+        _, writer = await asyncio.open_connection(node or 'localhost', port)
+    except (OSError, UnicodeError) as exc:
+        return 1, str(exc).encode()
+    writer.close()
+    return 0, b''
+
+
+class AsyncioBackend(ExecutionBackend):
+    '''
+    Run commands as asyncio tasks: processes are started with asyncio
+    subprocesses and commands like '@name ARGS' await the coroutine
+    registered as 'name' in checks, without any process. Checks are called
+    with the node (None for local commands) and the list of arguments, and
+    return a (retcode, output) tuple.
+    '''
+
+    CHECKS = {'tcp': tcp_check}
+
+    def __init__(self, manager, loop=None):
+        self.manager = manager
+        self.loop = loop or asyncio.new_event_loop()
+        self.checks = dict(self.CHECKS)
+        self._tasks = set()
+        self._semaphore = None
+        # Worker -> tasks of its nodes
+        self._nodes = {}
+
+    def fork_child(self):
+        '''Use a new event loop'''
+        self.loop = asyncio.new_event_loop()
+
+    def _spawn(self, coro):
+        '''Run coro as a task of the engine'''
+        task = self.loop.create_task(coro)
+        self._tasks.add(task)
+        return task
+
+    async def _sleep(self, delay, callback, *args):
+        '''Call callback(*args) after delay seconds'''
+        await asyncio.sleep(delay)
+        callback(*args)
+
+    def timer(self, fire, handler):
+        '''Call handler.ev_timer() after fire seconds'''
+        return self._spawn(self._sleep(fire, handler.ev_timer, None))
+
+    def cancel(self, timer):
+        '''Cancel a timer which did not fire yet'''
+        timer.cancel()
+
+    def schedule(self, action, command, nodes, handler, fanout=None,
+                 timeout=None):
+        '''
+        Start a task by node of the worker. Workers with a fanout have
+        their own semaphore, the others share the global one.
+        '''
+        worker = BackendWorker(action, command, nodes, handler)
+        if timeout is not None:
+            worker.timeout = timeout
+        if fanout:
+            semaphore = asyncio.Semaphore(fanout)
+        else:
+            if self._semaphore is None:
+                self._semaphore = asyncio.Semaphore(
+                                                self.manager.default_fanout)
+            semaphore = self._semaphore
+        handler.ev_start(worker)
+        self._nodes[worker] = [self._spawn(self._run_node(worker, key,
+                                                          semaphore))
+                               for key in worker.keys]
+        return worker
+
+    def abort(self, worker):
+        '''
+        Cancel the tasks of worker but the current one, if it reports the
+        end of a node. The last task closes the worker.
+        '''
+        current = asyncio.current_task(self.loop)
+        for task in self._nodes.get(worker, ()):
+            if task is not current:
+                task.cancel()
+
+    async def _run_node(self, worker, key, semaphore):
+        '''Run the command of worker on node key and report its end'''
+        try:
+            async with semaphore:
+                worker.current_node = key
+                worker.eh.ev_pickup(worker)
+                try:
+                    retcode, buf = await asyncio.wait_for(
+                                        self._execute(worker, key),
+                                        worker.timeout or None)
+                except asyncio.TimeoutError:
+                    retcode, buf = None, b''
+        except asyncio.CancelledError:
+            # Aborted worker, the node has no result
+            pass
+        else:
+            worker.current_node = key
+            if buf:
+                worker._buffers[key] = buf.rstrip(b'\n')
+            if retcode is None:
+                worker._timeouts.append(key)
+            else:
+                worker.current_rc = retcode
+                worker._retcodes[key] = retcode
+                worker.eh.ev_hup(worker)
+        worker._pending -= 1
+        if not worker._pending:
+            del self._nodes[worker]
+            worker.eh.ev_close(worker)
+
+    async def _execute(self, worker, key):
+        '''Return the (retcode, output) of the command of worker on key'''
+        if worker.command.startswith(CHECK_PREFIX):
+            args = worker.command[len(CHECK_PREFIX):].split()
+            check = args and self.checks.get(args[0])
+            if not check:
+                return 127, b'unknown check: ' + worker.command.encode()
+            return await check(key, args[1:])
+
+        proc = await asyncio.create_subprocess_exec(
+                        *command_args(worker, key, self.ssh_options),
+                        stdin=asyncio.subprocess.DEVNULL,
+                        stdout=asyncio.subprocess.PIPE,
+                        stderr=asyncio.subprocess.STDOUT,
+                        start_new_session=True)
+        try:
+            buf, _ = await proc.communicate()
+        finally:
+            # Cancelled on timeout
+            if proc.returncode is None:
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                await proc.wait()
+        retcode = proc.returncode
+        # Exit codes like shells do for killed processes
+        if retcode < 0:
+            retcode = 128 - retcode
+        return retcode, buf
+
+    async def run_async(self):
+        '''Wait until all tasks of the engine are done'''
+        while self._tasks:
+            done, _ = await asyncio.wait(list(self._tasks))
+            for task in done:
+                self._tasks.discard(task)
+                if not task.cancelled() and task.exception():
+                    raise task.exception()
+        self._semaphore = None
+
+    def run(self):
+        '''Run the event loop until all tasks of the engine are done'''
+        self.loop.run_until_complete(self.run_async())
@@ -0,0 +1,626 @@
+#
+# Copyright CEA (2026)
+#
+# This file is part of MilkCheck project.
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading,  using,  modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean  that it is complicated to manipulate,  and  that  also
+# therefore means  that it is reserved for developers  and  experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and,  more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+"""
+This module contains the execution backends of the ActionManager: the
+ClusterShell one, used by default, and a local one running commands with a
+bounded pool of processes.
+"""
+
+import os
+import time
+import heapq
+import select
+import signal
+import subprocess
+import threading
+from string import Template
+
+from ClusterShell.NodeSet import NodeSet
+from ClusterShell.Event import EventHandler
+from ClusterShell.Task import Task, task_self
+from ClusterShell.Worker.Exec import ExecWorker
+from ClusterShell.Worker.Popen import WorkerPopen
+
+from MilkCheck.Engine.BaseEntity import MilkCheckEngineError
+
+
+class ExecutionBackend(object):
+    '''
+    Interface of the execution backends. A backend starts the commands of
+    actions and reports their progress to an event handler (ev_start,
+    ev_pickup, ev_hup and ev_close) with a worker object. Results of a
+    closed worker are read through iter_buffers(), iter_retcodes() and
+    nodes_timeout().
+    '''
+
+    # Simulated backends run nothing, their results are not recorded
+    simulated = False
+
+    # Extra options of the ssh commands
+    ssh_options = ()
+
+    def now(self):
+        '''Return the current time'''
+        return time.time()
+
+    def set_fanout(self, fanout):
+        '''Set the global fanout'''
+
+    def set_ssh_options(self, options):
+        '''Add options to the ssh commands run by this backend'''
+        self.ssh_options = tuple(options)
+
+    def fork_child(self):
+        '''
+        Called in a child process forked before the backend ran anything,
+        to stop sharing event loop resources with the parent.
+        '''
+
+    def timer(self, fire, handler):
+        '''Call handler.ev_timer() after fire seconds'''
+        raise NotImplementedError
+
+    def cancel(self, timer):
+        '''Cancel a timer returned by timer() which did not fire yet'''
+        raise NotImplementedError
+
+    def schedule(self, action, command, nodes, handler, fanout=None,
+                 timeout=None):
+        '''
+        Run command on nodes, or locally if nodes is None, and return the
+        worker. If set, fanout is the window of this worker, the global
+        fanout is used otherwise. If set, timeout bounds the commands of
+        this worker instead of the timeout of action.
+        '''
+        raise NotImplementedError
+
+    def run(self):
+        '''Process events until nothing is left to do'''
+        raise NotImplementedError
+
+    def record_wait(self, name, limit, count, wait):
+        '''
+        Note that count nodes waited wait seconds for a slot of a fanout
+        window: the one of action name, or the global one if name is None.
+        '''
+
+    def abort(self, worker):
+        '''
+        Stop worker, possibly from one of its events: nodes not done yet
+        get no result, then the worker is closed.
+        '''
+        raise NotImplementedError
+
+    def iter_buffers(self, worker):
+        '''Return an iterator over outputs and associated NodeSet'''
+        return worker.iter_buffers()
+
+    def iter_retcodes(self, worker):
+        '''Return an iterator over return codes and associated NodeSet'''
+        return worker.iter_retcodes()
+
+    def nodes_timeout(self, worker):
+        '''Return the NodeSet of timed out nodes'''
+        return NodeSet.fromlist(list(worker.iter_keys_timeout()))
+
+    def node_buffer(self, worker, node):
+        '''Return the output of node'''
+        return worker.node_buffer(node)
+
+
+class ClusterShellBackend(ExecutionBackend):
+    '''Run commands with the ClusterShell master task.'''
+
+    def __init__(self):
+        self.task = task_self()
+
+    def set_fanout(self, fanout):
+        '''Set the global fanout'''
+        self.task.set_info('fanout', fanout)
+
+    def set_ssh_options(self, options):
+        '''
+        Add options to the ssh commands run by the master task, in place of
+        those given by the previous call.
+        '''
+        current = (self.task.info('ssh_options') or '').strip()
+        previous = ' '.join(self.ssh_options)
+        if previous and current.endswith(previous):
+            current = current[:-len(previous)].strip()
+        ExecutionBackend.set_ssh_options(self, options)
+        self.task.set_info('ssh_options',
+                           ' '.join([current] + list(options)).strip())
+
+    def fork_child(self):
+        '''Use a new master task, not sharing its engine with the parent'''
+        # Aborting the inherited task would unregister the parent's file
+        # descriptors from the shared epoll set: just forget about it.
+        Task._tasks.pop(threading.current_thread(), None)
+        parent, self.task = self.task, task_self()
+        for key in ('fanout', 'ssh_options'):
+            self.task.set_info(key, parent.info(key))
+
+    def timer(self, fire, handler):
+        '''Call handler.ev_timer() after fire seconds'''
+        return self.task.timer(handler=handler, fire=fire)
+
+    def cancel(self, timer):
+        '''Cancel a timer which did not fire yet'''
+        timer.invalidate()
+
+    def _build_worker(self, action, command, nodes, handler, timeout):
+        """Create the ClusterShell worker which will run the action."""
+        task = self.task
+        if action.mode == 'exec':
+            return ExecWorker(nodes=nodes, handler=handler,
+                              timeout=timeout, command=command,
+                              remote=action.remote)
+        elif nodes is None:
+            return WorkerPopen(command, handler=handler,
+                               stderr=task.default('stderr'),
+                               timeout=timeout)
+        elif task._default_tree_is_enabled():
+            # Tree mode: let ClusterShell manage its gateways
+            return None
+        elif action.remote:
+            wrkcls = task.default('distant_worker')
+        else:
+            wrkcls = task.default('local_worker')
+        return wrkcls(NodeSet(nodes), command=command, handler=handler,
+                      stderr=task.default('stderr'), timeout=timeout,
+                      remote=action.remote)
+
+    def schedule(self, action, command, nodes, handler, fanout=None,
+                 timeout=None):
+        '''Create and schedule the worker of the action'''
+        if timeout is None:
+            timeout = action.timeout
+        wkr = self._build_worker(action, command, nodes, handler, timeout)
+        if wkr is None:
+            return self.task.shell(command, nodes=nodes,
+                                   timeout=timeout, handler=handler,
+                                   remote=action.remote)
+        # Per-worker window, must be set before the worker is scheduled
+        if fanout:
+            wkr._fanout = fanout
+        self.task.schedule(wkr)
+        return wkr
+
+    def run(self):
+        '''Run the master task, if not already running'''
+        if not self.task.running():
+            self.task.run()
+
+    def abort(self, worker):
+        '''
+        Stop worker. ClusterShell does not close workers whose nodes were
+        not all started, they are closed once the current event is
+        processed.
+        '''
+        worker.abort()
+        self.task.timer(handler=CloseHandler(worker), fire=0)
+
+    def iter_buffers(self, worker):
+        '''Return an iterator over outputs and associated NodeSet'''
+        if isinstance(worker, WorkerPopen):
+            return iter([(worker.read(), 'localhost')])
+        return worker.iter_buffers()
+
+    def iter_retcodes(self, worker):
+        '''Return an iterator over return codes and associated NodeSet'''
+        if isinstance(worker, WorkerPopen):
+            # We don't count timeout (retcode=None)
+            if worker.retcode() is None:
+                return iter([])
+            return iter([(worker.retcode(), 'localhost')])
+        return worker.iter_retcodes()
+
+    def node_buffer(self, worker, node):
+        '''Return the output of node'''
+        if isinstance(worker, WorkerPopen):
+            return worker.read()
+        return worker.node_buffer(node)
+
+    def nodes_timeout(self, worker):
+        '''Return the NodeSet of timed out nodes'''
+        if isinstance(worker, WorkerPopen):
+            if worker.did_timeout():
+                return NodeSet("localhost")
+            return NodeSet()
+        return ExecutionBackend.nodes_timeout(self, worker)
+
+
+class CloseHandler(EventHandler):
+    '''Close an aborted ClusterShell worker.'''
+
+    def __init__(self, worker):
+        EventHandler.__init__(self)
+        self._worker = worker
+
+    def ev_timer(self, timer):
+        '''Event handlers of MilkCheck ignore a second ev_close()'''
+        self._worker.eh.ev_close(self._worker)
+
+
+class BackendWorker(object):
+    '''
+    Worker of the backends which are not based on ClusterShell. It runs a
+    command on some nodes, or locally as one node named None, and keeps
+    the results of each node.
+    '''
+
+    def __init__(self, action, command, nodes, handler):
+        self.action = action
+        self.command = command
+        self.nodes = nodes
+        self.eh = handler
+        # Timeout of the commands, see ExecutionBackend.schedule()
+        self.timeout = action.timeout
+        self.current_node = None
+        self.current_rc = None
+        self._retcodes = {}
+        self._buffers = {}
+        self._timeouts = []
+        if nodes is None:
+            self.keys = [None]
+        else:
+            self.keys = list(NodeSet(nodes))
+        self._ranks = dict((key, rank) for rank, key in enumerate(self.keys))
+        self._pending = len(self.keys)
+
+    def rank(self, key):
+        '''Return the rank of node key in the worker nodes'''
+        return self._ranks[key]
+
+    def iter_buffers(self):
+        '''Return an iterator over outputs and associated NodeSet'''
+        bybuf = {}
+        for key, buf in self._buffers.items():
+            bybuf.setdefault(buf, []).append(key or 'localhost')
+        for buf, keys in sorted(bybuf.items()):
+            yield buf, NodeSet.fromlist(keys)
+
+    def iter_retcodes(self):
+        '''Return an iterator over return codes and associated NodeSet'''
+        bycode = {}
+        for key, retcode in self._retcodes.items():
+            bycode.setdefault(retcode, []).append(key or 'localhost')
+        for retcode, keys in sorted(bycode.items()):
+            yield retcode, NodeSet.fromlist(keys)
+
+    def iter_keys_timeout(self):
+        '''Return an iterator over timed out nodes'''
+        return iter([key or 'localhost' for key in self._timeouts])
+
+    def node_buffer(self, key):
+        '''Return the output of node key'''
+        return self._buffers.get(key, b'')
+
+
+class EventLoopBackend(ExecutionBackend):
+    '''
+    Base of the backends with their own event loop: timers are kept in a
+    heap and nodes wait in fanout windows. Subclasses start nodes in
+    _start() and call _done() when they end.
+    '''
+
+    def __init__(self, manager):
+        self.manager = manager
+        self._events = []
+        self._seq = 0
+        # Fanout windows: key -> [running count, limit, queued items,
+        # action name or None for the global window]. Queued items are
+        # (worker, key, queuing time).
+        self._windows = {}
+        # Window name -> [limit, waiting nodes count, longest wait]
+        self.waits = {}
+
+    def _clock(self):
+        '''Return the time used by the event loop'''
+        return self.now()
+
+    def _push(self, delay, callback, *args):
+        '''Call callback(*args) once delay seconds elapsed'''
+        event = (self._clock() + delay, self._seq, callback, args)
+        self._seq += 1
+        heapq.heappush(self._events, event)
+        return event
+
+    def timer(self, fire, handler):
+        '''Call handler.ev_timer() after fire seconds'''
+        return self._push(fire, handler.ev_timer, None)
+
+    def cancel(self, timer):
+        '''Cancel a timer which did not fire yet'''
+        if timer in self._events:
+            self._events.remove(timer)
+            heapq.heapify(self._events)
+
+    def _new_worker(self, action, command, nodes, handler):
+        '''Return the worker of the action'''
+        return BackendWorker(action, command, nodes, handler)
+
+    def schedule(self, action, command, nodes, handler, fanout=None,
+                 timeout=None):
+        '''
+        Start a worker running command on nodes. Workers with a fanout
+        have their own window, the others share the global one.
+        '''
+        worker = self._new_worker(action, command, nodes, handler)
+        if timeout is not None:
+            worker.timeout = timeout
+        if fanout:
+            # Windows reduced to the free global slots are the global one
+            name = None
+            if fanout == self.manager.fanout_window(action):
+                name = action.fullname()
+            window = [0, fanout, [], name]
+            self._windows[worker] = window
+        else:
+            window = self._windows.setdefault('default', [0, None, [], None])
+        now = self._clock()
+        window[2].extend((worker, key, now) for key in worker.keys)
+        handler.ev_start(worker)
+        self._fill(window)
+        return worker
+
+    def _fill(self, window):
+        '''Start queued nodes of window while it has free slots'''
+        limit = window[1] or self.manager.default_fanout
+        while window[2] and window[0] < limit:
+            worker, key, queued = window[2].pop(0)
+            window[0] += 1
+            now = self._clock()
+            if now > queued:
+                # Nodes of reduced windows waited for the global fanout
+                cap = limit
+                if window[3] is None:
+                    cap = self.manager.default_fanout
+                self.record_wait(window[3], cap, 1, now - queued)
+            worker.current_node = key
+            worker.eh.ev_pickup(worker)
+            self._start(window, worker, key)
+
+    def record_wait(self, name, limit, count, wait):
+        '''Keep the longest wait of each fanout window in self.waits'''
+        waits = self.waits.setdefault(name, [limit, 0, 0])
+        waits[1] += count
+        waits[2] = max(waits[2], wait)
+
+    def _start(self, window, worker, key):
+        '''Start the command of worker on node key'''
+        raise NotImplementedError
+
+    def _done(self, window, worker, key, retcode, buf=None):
+        '''A command ended, or timed out if retcode is None'''
+        window[0] -= 1
+        worker.current_node = key
+        if buf:
+            worker._buffers[key] = buf
+        if retcode is None:
+            worker._timeouts.append(key)
+        else:
+            worker.current_rc = retcode
+            worker._retcodes[key] = retcode
+            worker.eh.ev_hup(worker)
+        self._fill(window)
+        worker._pending -= 1
+        if not worker._pending:
+            self._windows.pop(worker, None)
+            self._close(worker)
+
+    def _close(self, worker):
+        '''All nodes of worker are done'''
+        worker.eh.ev_close(worker)
+
+    def abort(self, worker):
+        '''
+        Stop worker: its queued nodes are dropped and its running ones are
+        stopped, without results. Then the worker is closed, by _done() if
+        a node of worker is ending.
+        '''
+        for window in self._windows.values():
+            queued = [item for item in window[2] if item[0] is not worker]
+            worker._pending -= len(window[2]) - len(queued)
+            window[2][:] = queued
+        for window in self._stop(worker):
+            window[0] -= 1
+            worker._pending -= 1
+        self._windows.pop(worker, None)
+        for window in list(self._windows.values()):
+            self._fill(window)
+        if not worker._pending:
+            self._close(worker)
+
+    def _stop(self, worker):
+        '''Stop the running nodes of worker, return their windows'''
+        raise NotImplementedError
+
+    def _next_event(self):
+        '''Pop and return the next timer event'''
+        return heapq.heappop(self._events)
+
+
+def replace_cmd(command, node, rank):
+    '''
+    Replace %h/%host and %n/%rank in command, like ClusterShell does for
+    the commands it executes itself.
+    '''
+    class Replacer(Template):
+        '''Template using ClusterShell placeholders'''
+        delimiter = '%'
+    values = {'h': node, 'host': node, 'hosts': node,
+              'n': rank or 0, 'rank': rank or 0}
+    try:
+        return Replacer(command).substitute(values)
+    except (KeyError, ValueError) as exc:
+        raise MilkCheckEngineError("%s is not a valid pattern, use '%%%%' "
+                                   "to escape '%%'" % exc)
+
+
+SSH_COMMAND = ['ssh', '-oForwardAgent=no', '-oForwardX11=no',
+               '-oBatchMode=yes']
+
+# Like ClusterShell, ssh fails with its own error once the connection
+# takes too long, instead of running into the timeout of the action. It
+# comes after ssh_options, where it could be set too.
+SSH_CONNECT_TIMEOUT = '-oConnectTimeout=10'
+
+def command_args(worker, key, ssh_options=()):
+    '''
+    Return the arguments of the process running the command of worker on
+    node key: a local shell, or ssh, with ssh_options, for remote actions.
+    '''
+    action = worker.action
+    if key is None:
+        return ['/bin/sh', '-c', worker.command]
+    if action.remote and action.mode != 'exec':
+        return SSH_COMMAND + list(ssh_options) + [SSH_CONNECT_TIMEOUT, key,
+                                                  worker.command]
+    return ['/bin/sh', '-c', replace_cmd(worker.command, key,
+                                         worker.rank(key))]
+
+
+class LocalBackend(EventLoopBackend):
+    '''
+    Run commands with a bounded pool of local processes, without
+    ClusterShell. Remote commands are run through 'ssh'.
+    '''
+
+    def __init__(self, manager):
+        EventLoopBackend.__init__(self, manager)
+        # Running processes by output file descriptor:
+        # fd -> (process, window, worker, key, output chunks, deadline)
+        self._procs = {}
+        self._poller = select.poll()
+        # Time of the current loop iteration
+        self._loop_time = None
+
+    def fork_child(self):
+        '''Use a new poll object'''
+        self._poller = select.poll()
+
+    def _clock(self):
+        '''Return the time of the current loop iteration'''
+        return self._loop_time or self.now()
+
+    def _start(self, window, worker, key):
+        '''Start the process of worker on node key'''
+        with open(os.devnull) as devnull:
+            proc = subprocess.Popen(command_args(worker, key,
+                                                 self.ssh_options),
+                                    stdin=devnull, stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT,
+                                    close_fds=True, preexec_fn=os.setsid)
+        deadline = None
+        if worker.timeout:
+            deadline = self.now() + worker.timeout
+        fdesc = proc.stdout.fileno()
+        self._procs[fdesc] = (proc, window, worker, key, [], deadline)
+        self._poller.register(fdesc, select.POLLIN | select.POLLHUP)
+
+    def _kill(self, fdesc):
+        '''Kill the process writing to fdesc and forget it'''
+        proc, window = self._procs.pop(fdesc)[:2]
+        self._poller.unregister(fdesc)
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        proc.wait()
+        proc.stdout.close()
+        return window
+
+    def _stop(self, worker):
+        '''Kill the processes of worker, return their windows'''
+        return [self._kill(fdesc) for fdesc, proc in list(self._procs.items())
+                if proc[2] is worker]
+
+    def _reap(self, fdesc, timeout=False):
+        '''Wait for the process writing to fdesc and report its end'''
+        proc, window, worker, key, chunks, _ = self._procs[fdesc]
+        retcode = None
+        if timeout:
+            self._kill(fdesc)
+        else:
+            del self._procs[fdesc]
+            self._poller.unregister(fdesc)
+            retcode = proc.wait()
+            proc.stdout.close()
+            # Exit codes like shells do for killed processes
+            if retcode < 0:
+                retcode = 128 - retcode
+        buf = b''.join(chunks).rstrip(b'\n')
+        self._done(window, worker, key, retcode, buf)
+
+    def _poll(self, delay):
+        '''Wait at most delay seconds for process outputs'''
+        if delay is not None:
+            delay = int(max(delay, 0) * 1000)
+        for fdesc, _ in self._poller.poll(delay):
+            if fdesc not in self._procs:
+                continue
+            data = os.read(fdesc, 65536)
+            if data:
+                self._procs[fdesc][4].append(data)
+            else:
+                self._reap(fdesc)
+
+    def run(self):
+        '''Process timers and processes until none is left'''
+        while self._events or self._procs:
+            now = self._loop_time = self.now()
+            # Timers and timeouts which expired
+            if self._events and self._events[0][0] <= now:
+                _, _, callback, args = self._next_event()
+                callback(*args)
+                continue
+            expired = [fdesc for fdesc, proc in self._procs.items()
+                       if proc[5] is not None and proc[5] <= now]
+            for fdesc in expired:
+                self._reap(fdesc, timeout=True)
+            if expired:
+                continue
+
+            # Wait for the next timer, timeout or output
+            deadlines = [proc[5] for proc in self._procs.values()
+                         if proc[5] is not None]
+            if self._events:
+                deadlines.append(self._events[0][0])
+            delay = None
+            if deadlines:
+                delay = min(deadlines) - now
+            if self._procs:
+                self._poll(delay)
+            elif delay:
+                time.sleep(delay)
+        self._loop_time = None
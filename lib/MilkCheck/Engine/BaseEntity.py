@@ -34,8 +34,13 @@ This module contains the BaseEntity class definition
 """
 
 # Classes
-import re
+import os
+import json
+import math
+import time
 import logging
+from fnmatch import fnmatchcase
+from multiprocessing.pool import ThreadPool
 from subprocess import Popen, PIPE
 from ClusterShell.NodeSet import NodeSet
 
@@ -138,6 +143,332 @@ class InvalidVariableError(MilkCheckEngineError):
         msg = "Cannot evaluate expression '%s'" % varname
         MilkCheckEngineError.__init__(self, msg)
 
+class InvalidPropertyError(MilkCheckEngineError):
+    '''
+    This error is raised when a property of the configuration has an
+    invalid value.
+    '''
+    def __init__(self, name, value):
+        msg = "Invalid %s property: %s" % (name, value)
+        MilkCheckEngineError.__init__(self, msg)
+
+# Template substitution
+TPL_DELIMITER = '%'
+
+# Kind of template tokens
+TPL_LITERAL = 'LITERAL'
+TPL_VARIABLE = 'VARIABLE'
+TPL_COMMAND = 'COMMAND'
+
+# Parsed templates, by template string
+_TEMPLATES = {}
+
+def _is_identifier_start(char):
+    """Tell if char could start a variable name"""
+    return char == '_' or ('a' <= char <= 'z') or ('A' <= char <= 'Z')
+
+def _is_identifier_char(char):
+    """Tell if char could be part of a variable name"""
+    return _is_identifier_start(char) or ('0' <= char <= '9')
+
+def _invalid_placeholder(template, pos):
+    """Raise a detailed error message for an invalid placeholder at pos"""
+    lines = template[:pos].splitlines(True)
+    # A placeholder could not be at the begining of template.
+    assert lines, "invalid pattern as the begining of template"
+    colno = pos - len(''.join(lines[:-1]))
+    lineno = len(lines)
+    raise ValueError('Invalid placeholder in string: line %d, col %d' %
+                     (lineno, colno))
+
+def parse_template(template):
+    """
+    Split a template in a tuple of (kind, value) tokens, where kind is one of
+    TPL_LITERAL, TPL_VARIABLE or TPL_COMMAND. Supported patterns are:
+        %%          a literal '%'
+        %name       a variable
+        %{name}     a variable
+        %(command)  the output of a shell command (up to the first ')' of
+                    the line)
+    Result is cached by template.
+    """
+    tokens = _TEMPLATES.get(template)
+    if tokens is not None:
+        return tokens
+
+    tokens = []
+    literal = []
+    length = len(template)
+    pos = 0
+    while pos < length:
+        delim = template.find(TPL_DELIMITER, pos)
+        if delim < 0:
+            literal.append(template[pos:])
+            break
+        literal.append(template[pos:delim])
+        pos = delim + 1
+        char = template[pos:pos + 1]
+        token = None
+        if char == TPL_DELIMITER:
+            literal.append(TPL_DELIMITER)
+            pos += 1
+        elif char and _is_identifier_start(char):
+            end = pos + 1
+            while end < length and _is_identifier_char(template[end]):
+                end += 1
+            token = (TPL_VARIABLE, template[pos:end])
+            pos = end
+        elif char == '{':
+            end = pos + 1
+            if end < length and _is_identifier_start(template[end]):
+                end += 1
+                while end < length and _is_identifier_char(template[end]):
+                    end += 1
+            if end > pos + 1 and template[end:end + 1] == '}':
+                token = (TPL_VARIABLE, template[pos + 1:end])
+                pos = end + 1
+            else:
+                _invalid_placeholder(template, pos)
+        elif char == '(':
+            # Command is at least one character long and on a single line
+            end = template.find(')', pos + 2)
+            eol = template.find('\n', pos + 1)
+            if end < 0 or (0 <= eol < end):
+                _invalid_placeholder(template, pos)
+            token = (TPL_COMMAND, template[pos + 1:end])
+            pos = end + 1
+        else:
+            _invalid_placeholder(template, pos)
+
+        if token is not None:
+            if ''.join(literal):
+                tokens.append((TPL_LITERAL, ''.join(literal)))
+            literal = []
+            tokens.append(token)
+
+    if ''.join(literal):
+        tokens.append((TPL_LITERAL, ''.join(literal)))
+
+    tokens = tuple(tokens)
+    _TEMPLATES[template] = tokens
+    return tokens
+
+def run_command(raw):
+    """Run a shell command and return its output."""
+    logger = logging.getLogger('milkcheck')
+    cmd = Popen(raw, stdout=PIPE, stderr=PIPE, shell=True)
+    stdout = cmd.communicate()[0].decode()
+    logger.debug("External command exited with %d: '%s'" %
+                 (cmd.returncode, stdout))
+    if cmd.returncode >= 126:
+        raise InvalidVariableError(raw)
+    return stdout.rstrip('\n')
+
+def wave_size(value, total):
+    '''
+    Return the number of nodes of a rolling wave: value nodes, or value
+    percent of total nodes if value is a string like '10%'. At least one.
+    '''
+    if isinstance(value, str) and value.endswith('%'):
+        size = int(math.ceil(total * float(value[:-1]) / 100))
+    else:
+        size = int(value)
+    if size < 0 or (size == 0 and total):
+        raise ValueError("Invalid wave size '%s'" % value)
+    return max(size, 1)
+
+def check_rolling(rolling):
+    '''
+    Check the 'rolling' property: a dict with a 'batch' size and optional
+    'canary' size and 'max_failures' count. Return it.
+    '''
+    try:
+        if set(rolling) - set(('batch', 'canary', 'max_failures')):
+            raise ValueError(rolling)
+        wave_size(rolling['batch'], 100)
+        if 'canary' in rolling:
+            wave_size(rolling['canary'], 100)
+        if int(rolling.get('max_failures', 0)) < 0:
+            raise ValueError(rolling)
+    except (TypeError, KeyError, ValueError):
+        raise InvalidPropertyError('rolling', rolling)
+    return rolling
+
+class CommandPending(Exception):
+    """Raised while prefetching, when a command output is not known yet."""
+
+class CommandCache(object):
+    '''
+    Keep the outputs of %(...) command substitutions. Each command is run
+    only once per run. Independent commands could be run in parallel with
+    prefetch(). Outputs of commands matching one of the 'ttls' patterns are
+    also stored on disk, in 'directory', and reused by the next runs until
+    they expire. The on-disk cache is written by save(), once the commands
+    of a resolution are known.
+    '''
+    _instance = None
+
+    CACHE_FILE = 'commands.json'
+
+    def __init__(self):
+        # Command outputs and failures for the current run
+        self._outputs = {}
+        self._failures = {}
+        # Max number of commands run at the same time by prefetch()
+        self.workers = 8
+        # Directory of the on-disk cache
+        self.directory = None
+        # Command glob pattern -> time to live in seconds of its output on
+        # disk. First matching pattern is used.
+        self.ttls = {}
+        # On-disk cache content: command -> (timestamp, output)
+        self._disk = None
+        self._dirty = False
+        # Commands discovered by prefetch()
+        self._prefetching = False
+        self._pending = set()
+
+    def clear(self):
+        '''Forget command outputs. A new run will start.'''
+        self._outputs.clear()
+        self._failures.clear()
+
+    def _ttl(self, cmd):
+        '''Return the time to live on disk of cmd output, 0 if none.'''
+        for pattern, ttl in self.ttls.items():
+            if fnmatchcase(cmd, pattern):
+                return ttl
+        return 0
+
+    def _cache_path(self):
+        '''Return the path of the on-disk cache'''
+        return os.path.join(self.directory, self.CACHE_FILE)
+
+    def _disk_get(self, cmd):
+        '''Return cmd output from the on-disk cache, None if missing.'''
+        ttl = self._ttl(cmd)
+        if not ttl or not self.directory:
+            return None
+        if self._disk is None:
+            self._disk = {}
+            try:
+                with open(self._cache_path()) as cache:
+                    self._disk = json.load(cache)
+            except (IOError, OSError, ValueError) as exc:
+                logger = logging.getLogger('milkcheck')
+                logger.debug("Command cache not loaded: %s" % exc)
+        entry = self._disk.get(cmd)
+        if entry and time.time() - entry[0] < ttl:
+            return entry[1]
+        return None
+
+    def _disk_set(self, cmd, output):
+        '''Store cmd output in the on-disk cache if it should be kept.'''
+        if self._ttl(cmd) and self.directory and self._disk is not None:
+            self._disk[cmd] = (time.time(), output)
+            self._dirty = True
+
+    def save(self):
+        '''Write the on-disk cache if it was modified.'''
+        if not self._dirty:
+            return
+        self._dirty = False
+        path = self._cache_path()
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            tmpname = '%s.%d' % (path, os.getpid())
+            with open(tmpname, 'w') as cache:
+                json.dump(self._disk, cache)
+            os.rename(tmpname, path)
+        except (IOError, OSError) as exc:
+            logger = logging.getLogger('milkcheck')
+            logger.warning("Cannot write command cache %s: %s" % (path, exc))
+
+    def output(self, cmd):
+        '''Return the output of cmd, running it if needed.'''
+        if cmd in self._outputs:
+            return self._outputs[cmd]
+        if cmd in self._failures:
+            raise self._failures[cmd]
+        output = self._disk_get(cmd)
+        if output is None:
+            if self._prefetching:
+                self._pending.add(cmd)
+                raise CommandPending(cmd)
+            output = run_command(cmd)
+            self._disk_set(cmd, output)
+        self._outputs[cmd] = output
+        return output
+
+    def _run(self, cmd):
+        '''Run cmd and record its output or failure.'''
+        try:
+            output = run_command(cmd)
+        except InvalidVariableError as exc:
+            self._failures[cmd] = exc
+        else:
+            self._outputs[cmd] = output
+            self._disk_set(cmd, output)
+
+    def prefetch(self, templates):
+        '''
+        Run, in parallel, the commands needed to resolve the provided
+        (entity, value) pairs. Commands built from the output of other
+        commands are run once those are known.
+        '''
+        todo = [(ent, value) for ent, value in templates
+                if type(value) is str and TPL_DELIMITER in value]
+        self._prefetching = True
+        try:
+            while todo:
+                self._pending = set()
+                remaining = []
+                for ent, value in todo:
+                    try:
+                        ent._substitute(value)
+                    except CommandPending:
+                        remaining.append((ent, value))
+                    except (MilkCheckEngineError, ValueError):
+                        # Errors will be raised by the real resolution
+                        pass
+                if not self._pending:
+                    break
+                pool = ThreadPool(min(self.workers, len(self._pending)))
+                try:
+                    pool.map(self._run, sorted(self._pending))
+                finally:
+                    pool.close()
+                    pool.join()
+                todo = remaining
+        finally:
+            self._prefetching = False
+            self._pending = set()
+        self.save()
+
+def command_cache_self():
+    """Return a singleton instance of the CommandCache class"""
+    if not CommandCache._instance:
+        CommandCache._instance = CommandCache()
+    return CommandCache._instance
+
+class PendingTarget(object):
+    '''
+    Target value read from configuration, resolved by its entity when first
+    needed. Entities inheriting the target share it: it is resolved once.
+    '''
+
+    def __init__(self, entity, value):
+        self.entity = entity
+        self.value = value
+        self._nodes = None
+
+    def nodes(self):
+        '''Return a new NodeSet of the resolved target'''
+        if self._nodes is None:
+            self._nodes = NodeSet(self.entity._resolve(self.value))
+        return NodeSet(self._nodes)
+
 class Dependency(object):
     '''
     This class define the structure of a dependency. A dependency can
@@ -183,13 +514,17 @@ class Dependency(object):
 
     def status(self):
         """Give entity status from a dependency point of view."""
-        if self.target.status in (ERROR, TIMEOUT, DEP_ERROR):
+        return self.status_of(self.target.status)
+
+    def status_of(self, status):
+        """Give the provided target status from a dependency point of view."""
+        if status in (ERROR, TIMEOUT, DEP_ERROR):
             if self.is_strong():
                 return DEP_ERROR
             else:
                 return DONE
         else:
-            return self.target.status
+            return status
 
     def graph(self, source):
         """ Return DOT dependencies output for the given source"""
@@ -214,6 +549,47 @@ class Dependency(object):
 
         return dep_str
 
+class DepsCounter(object):
+    '''
+    Track the status of the dependencies of an entity. It is updated each
+    time one of the dependencies changes its status, so readiness and
+    overall dependency status are known without rescanning dependencies.
+    '''
+
+    def __init__(self, deps, reverse):
+        # Direction used to build the counter
+        self.reverse = reverse
+        # Number of dependencies tracked
+        self.size = len(deps)
+        # Number of dependencies without a final status
+        self.pending = 0
+        # Dependencies count for each status, from a dependency point of view
+        self.statuses = {}
+        for dep in deps.values():
+            self.add(dep, dep.target.status)
+
+    def add(self, dep, status, offset=1):
+        '''Count (or uncount, with offset=-1) a dependency status.'''
+        if status in (NO_STATUS, WAITING_STATUS):
+            self.pending += offset
+        dep_status = dep.status_of(status)
+        count = self.statuses.get(dep_status, 0) + offset
+        if count:
+            self.statuses[dep_status] = count
+        else:
+            del self.statuses[dep_status]
+
+    def update(self, dep, old, new):
+        '''A dependency status changed from old to new.'''
+        self.add(dep, old, -1)
+        self.add(dep, new)
+
+    def worst(self):
+        '''Return the worst dependency status, MISSING if there is none.'''
+        if not self.statuses:
+            return MISSING
+        return max(self.statuses, key=DEP_ORDER.get)
+
 class BaseEntity(object):
     '''
     This class is abstract and shall not be instanciated.
@@ -221,6 +597,11 @@ class BaseEntity(object):
     on parents and children.
     '''
 
+    # Properties resolved by resolve_all()
+    RESOLVED_PROPERTIES = ('fanout', 'maxretry', 'errors', 'warnings',
+                           'timeout', 'delay', 'backoff', 'cost', 'target',
+                           '_target_backup', 'mode', 'desc')
+
     LOCAL_VARIABLES = {
         'NAME':    'name',
         'FANOUT':  'fanout',
@@ -235,7 +616,10 @@ class BaseEntity(object):
         self.name = name
 
         # Each entity has a status which it state
-        self.status = NO_STATUS
+        self._status = NO_STATUS
+
+        # Status of dependencies, see _get_deps_counter()
+        self._deps_counter = None
 
         # Description of an entity
         self.desc = None
@@ -245,8 +629,10 @@ class BaseEntity(object):
         # ClusterShell 64
         self.fanout = None
 
-        # Nodes on which the entity is launched
+        # Nodes on which the entity is launched. A target read from the
+        # configuration is only resolved when first used, see _defer_target()
         self._target = None
+        self._target_pending = None
         self.target = target
         self._target_backup = self.target
 
@@ -271,6 +657,17 @@ class BaseEntity(object):
 
         self.maxretry = 0
 
+        # Base waiting time before a retry, doubled for each new retry.
+        # When set, it replaces delay between retries.
+        self.backoff = 0
+
+        # Expected duration in seconds, used to start the longest
+        # chains of actions first. Estimated from history if None.
+        self.cost = None
+
+        # Run actions in successive waves of nodes, see check_rolling()
+        self.rolling = None
+
         self.failed_nodes = NodeSet()
 
         # Parent of the current object. Must be a subclass of BaseEntity
@@ -307,6 +704,58 @@ class BaseEntity(object):
         """
         self.failed_nodes.add(nodes)
 
+    def _get_status(self):
+        '''Return self._status'''
+        return self._status
+
+    def _set_status(self, status):
+        '''Assign status and update dependency counters of dependents'''
+        old = self._status
+        self._status = status
+        if old != status:
+            self._notify_dependents(old, status)
+
+    status = property(fset=_set_status, fget=_get_status)
+
+    def _notify_dependents(self, old, new):
+        '''
+        Update the counters of the entities which depend on this one. An
+        entity using the standard direction sees us in its parents (so we
+        see it in our children), and the opposite when it is reversed.
+        '''
+        for deps, reverse in ((self.children, False), (self.parents, True)):
+            for dep in deps.values():
+                ent = dep.target
+                counter = ent._deps_counter
+                if counter is None or counter.reverse != reverse:
+                    continue
+                if reverse:
+                    edge = ent.children.get(self.name)
+                else:
+                    edge = ent.parents.get(self.name)
+                if edge is not None and edge.target is self:
+                    counter.update(edge, old, new)
+                else:
+                    # Renamed entity or one-way link: recount later
+                    ent._deps_changed()
+
+    def _get_deps_counter(self):
+        '''
+        Return the DepsCounter of the current dependencies, building it if
+        dependencies or direction changed since it was computed.
+        '''
+        counter = self._deps_counter
+        deps = self.deps()
+        if counter is None or counter.reverse != self._algo_reversed \
+           or counter.size != len(deps):
+            counter = DepsCounter(deps, self._algo_reversed)
+            self._deps_counter = counter
+        return counter
+
+    def _deps_changed(self):
+        '''Dependencies were modified, counters should be rebuilt'''
+        self._deps_counter = None
+
     def add_var(self, varname, value):
         '''Add a new variable within the entity context'''
         if varname in self.LOCAL_VARIABLES:
@@ -342,21 +791,41 @@ class BaseEntity(object):
             self.target.intersection_update(nodeset)
 
     def _get_target(self):
-        '''Return self._target'''
+        '''Return self._target, resolving it first if it was deferred'''
+        if self._target_pending is not None:
+            pending = self._target_pending
+            self._target_pending = None
+            self._target = pending.nodes()
         return self._target
 
     def _set_target(self, value):
         '''Assign nodeset to _target'''
+        self._target_pending = None
         self._target = None
         if value is not None:
             self._target = NodeSet(self._resolve(value))
 
+    def _defer_target(self, value):
+        '''
+        Assign value to _target, but only resolve it when the target is
+        read. Entities which are never used do not pay for variables or
+        commands referenced by their target.
+        '''
+        self._target = None
+        self._target_pending = None
+        if value is not None:
+            self._target_pending = PendingTarget(self, value)
+
+    def expand_targets(self):
+        '''Resolve the target now if its resolution was deferred'''
+        self._get_target()
+
     target = property(fset=_set_target, fget=_get_target)
 
     def reset(self):
         '''Reset values of attributes in order to perform multiple exec.'''
         self._tagged = False
-        self.target = self._target_backup
+        self._defer_target(self._target_backup)
         self.status = NO_STATUS
         self.failed_nodes = NodeSet()
         self.algo_reversed = False
@@ -365,6 +834,13 @@ class BaseEntity(object):
         """
         Get the root service from the Entity graph.
         """
+        # Follow the group hierarchy first, it does not need a graph walk
+        entity = self.parent
+        while entity is not None:
+            if getattr(entity, 'root', False):
+                return entity
+            entity = entity.parent
+
         target = None
         deps = self.children
         if reverse:
@@ -393,6 +869,9 @@ class BaseEntity(object):
                 # Search from the root Service/ServiceGroup
                 _main_svc_grp = self._get_root()
                 if _main_svc_grp:
+                    target = _main_svc_grp.lookup(name)
+                    if target is not None:
+                        return target
                     _grp = _main_svc_grp.search(_grp_name, reverse)
                     if _grp is not None:
                         return _grp.search(sub_name, reverse)
@@ -402,6 +881,13 @@ class BaseEntity(object):
                     return target
         return target
 
+    def lookup(self, name):
+        '''
+        Return the entity referenced by name (possibly dotted) in this
+        entity scope, or None. Only groups reference other entities.
+        '''
+        return None
+
     def add_dep(self, target, sgth=REQUIRE, parent=True):
         '''
         Add a dependency in both direction. This method allow the user to
@@ -417,6 +903,8 @@ class BaseEntity(object):
                     # This dependency is considered as a parent
                     self.parents[target.name] = Dependency(target, sgth, False)
                     target.children[self.name] = Dependency(self, sgth, False)
+                    self._deps_changed()
+                    target._deps_changed()
             else:
                 if target.name in self.children:
                     raise DependencyAlreadyReferenced()
@@ -424,6 +912,8 @@ class BaseEntity(object):
                     # This dependency is considered as a child
                     self.children[target.name] = Dependency(target, sgth, False)
                     target.parents[self.name] = Dependency(self, sgth, False)
+                    self._deps_changed()
+                    target._deps_changed()
         else:
             raise IllegalDependencyTypeError(sgth)
 
@@ -437,10 +927,14 @@ class BaseEntity(object):
             dep = self.parents[dep_name]
             del self.parents[dep_name]
             del dep.target.children[self.name]
+            self._deps_changed()
+            dep.target._deps_changed()
         elif dep_name in self.children:
             dep = self.children[dep_name]
             del self.children[dep_name]
             del dep.target.parents[self.name]
+            self._deps_changed()
+            dep.target._deps_changed()
 
     def clear_parent_deps(self):
         '''Remove all parent dependencies of an entity'''
@@ -470,6 +964,7 @@ class BaseEntity(object):
         '''Clear parent/child dependencies.'''
         self.parents.clear()
         self.children.clear()
+        self._deps_changed()
 
     def deps(self):
         """
@@ -487,10 +982,7 @@ class BaseEntity(object):
         Determine if the current services has to wait before to
         start due to unterminated dependencies.
         '''
-        for dep in self.deps().values():
-            if dep.target.status in (NO_STATUS, WAITING_STATUS):
-                return False
-        return True
+        return not self._get_deps_counter().pending
 
     def match_tags(self, tags):
         """
@@ -559,12 +1051,7 @@ class BaseEntity(object):
         Evaluate the result of the dependencies in order to establish
         a status.
         '''
-        if len(self.deps()):
-            order = lambda dep: DEP_ORDER[dep.status()]
-            sorted_deps = sorted(self.deps().values(), key=order)
-            return sorted_deps[-1].status()
-        else:
-            return MISSING
+        return self._get_deps_counter().worst()
 
     def set_algo_reversed(self, flag):
         '''Assign the right values for the property algo_reversed'''
@@ -607,68 +1094,34 @@ class BaseEntity(object):
 
     def _substitute(self, template):
         """Substitute %xxx patterns from the provided template."""
-        delimiter = '%'
-        pattern = r"""
-          %(delim)s(?:
-            (?P<escaped>%(delim)s) | # Escape sequence of two delimiters
-            (?P<named>%(id)s)      | # delimiter and a Python identifier
-            {(?P<braced>%(id)s)}   | # delimiter and a braced identifier
-            \((?P<parenth>.+?)\)   | # delimiter and parenthesis
-            (?P<invalid>)            # Other ill-formed delimiter exprs
-          )""" % {
-                'delim' : delimiter,
-                'id' : r'[_a-z][_a-z0-9]*',
-            }
-        pattern = re.compile(pattern, re.IGNORECASE | re.VERBOSE)
-
-        # Command substitution
-        def _cmd_repl(raw):
-            '''Replace a command execution pattern by its result.'''
-            logger = logging.getLogger('milkcheck')
-            cmd = Popen(raw, stdout=PIPE, stderr=PIPE, shell=True)
-            stdout = cmd.communicate()[0].decode()
-            logger.debug("External command exited with %d: '%s'" %
-                         (cmd.returncode, stdout))
-            if cmd.returncode >= 126:
-                raise InvalidVariableError(raw)
-            return stdout.rstrip('\n')
-
-        def _invalid(mobj, template):
-            '''Helper to raise a detail error message'''
-            i = mobj.start('invalid')
-            lines = template[:i].splitlines(True)
-            # With the current regexp, it is impossible that lines is empty.
-            assert lines, "invalid pattern as the begining of template"
-            colno = i - len(''.join(lines[:-1]))
-            lineno = len(lines)
-            raise ValueError('Invalid placeholder in string: line %d, col %d' %
-                             (lineno, colno))
-
-        def _convert(mobj):
-            """Helper function for .sub()"""
-            # Check the mobjst commobjn path first.
-            named = mobj.group('named') or mobj.group('braced')
-            if named is not None:
-                val = str(self._lookup_variable(named))
-                return self._resolve(val)
-            if mobj.group('escaped') is not None:
-                return delimiter
-            if mobj.group('parenth') is not None:
-                val = self._resolve(mobj.group('parenth'))
-                return _cmd_repl(val)
-            if mobj.group('invalid') is not None:
-                _invalid(mobj, template)
-            raise ValueError('Unrecognized named group in pattern', pattern)
+        tokens = parse_template(template)
 
         # Check if content is only a variable pattern
-        mobj = re.match(pattern, template)
-        name = mobj and (mobj.group('named') or mobj.group('braced'))
-        if name is not None and template == mobj.group(0):
+        if len(tokens) == 1 and tokens[0][0] is TPL_VARIABLE:
             # In this case, simply replace it by variable content
             # (useful for list and dict)
-            return self._resolve(self._lookup_variable(name))
-        else:
-            return pattern.sub(_convert, template)
+            return self._resolve(self._lookup_variable(tokens[0][1]))
+
+        result = []
+        pending = None
+        for kind, value in tokens:
+            if kind is TPL_LITERAL:
+                result.append(value)
+                continue
+            # While prefetching, all commands of the template are collected
+            # before raising CommandPending, so they are run together
+            try:
+                if kind is TPL_VARIABLE:
+                    val = str(self._lookup_variable(value))
+                    result.append(self._resolve(val))
+                else:
+                    cmd = self._resolve(value)
+                    result.append(command_cache_self().output(cmd))
+            except CommandPending as exc:
+                pending = exc
+        if pending is not None:
+            raise pending
+        return ''.join(result)
 
     def _resolve(self, value):
         '''
@@ -683,7 +1136,7 @@ class BaseEntity(object):
         '''
         # For compat: if provided value is not a str, we should not convert
         # it to a str if nothing matches.
-        if type(value) is not str:
+        if type(value) is not str or TPL_DELIMITER not in value:
             return value
 
         # Replace all %xxx patterns
@@ -722,21 +1175,29 @@ class BaseEntity(object):
         self.warnings = self.warnings or entity.warnings
         if self.timeout is None:
             self.timeout = entity.timeout
-        if self.target is None:
-            self.target = entity.target
+        if self._target is None and self._target_pending is None:
+            if entity._target_pending is not None:
+                self._target_pending = entity._target_pending
+            else:
+                self.target = entity._target
         self.mode = self.mode or entity.mode
         self.remote = self.remote and entity.remote
         if self.desc is None:
             self.desc = entity.desc
         self.delay = self.delay or entity.delay
         self.maxretry = self.maxretry or entity.maxretry
+        self.backoff = self.backoff or entity.backoff
+        if self.cost is None:
+            self.cost = entity.cost
+        if self.rolling is None:
+            self.rolling = entity.rolling
         self.tags = self.tags or entity.tags
 
     def fromdict(self, entdict):
         """Populate entity attributes from dict."""
         for item, prop in entdict.items():
             if item == 'target':
-                self.target = prop
+                self._defer_target(prop)
                 self._target_backup = prop
             elif item == 'mode':
                 self.mode = prop
@@ -750,6 +1211,12 @@ class BaseEntity(object):
                 self.delay = prop
             elif item == 'retry':
                 self.maxretry = prop
+            elif item == 'backoff':
+                self.backoff = prop
+            elif item == 'cost':
+                self.cost = prop
+            elif item == 'rolling':
+                self.rolling = check_rolling(prop)
             elif item == 'errors':
                 self.errors = prop
             elif item == 'warnings':
@@ -762,6 +1229,21 @@ class BaseEntity(object):
                 for varname, value in prop.items():
                     self.add_var(varname, value)
 
+    def iter_templates(self):
+        """
+        Iterate over (entity, value) pairs resolved by resolve_all(), for
+        this entity and the entities it contains.
+        """
+        for value in self.variables.values():
+            yield (self, value)
+        for item in self.RESOLVED_PROPERTIES:
+            # Deferred targets are not resolved here
+            if item == 'target' and self._target_pending is not None:
+                yield (self._target_pending.entity,
+                       self._target_pending.value)
+            else:
+                yield (self, getattr(self, item))
+
     def resolve_all(self):
         """Resolve all properties from the entity"""
         # Resolve local variables first.
@@ -770,9 +1252,7 @@ class BaseEntity(object):
             self.variables[name] = self._resolve(value)
 
         # Resolve properties
-        properties = ['fanout', 'maxretry', 'errors', 'warnings', 'timeout',
-                      'delay', 'target', '_target_backup', 'mode', 'desc']
-        for item in properties:
+        for item in self.RESOLVED_PROPERTIES:
             setattr(self, item, self._resolve(getattr(self, item)))
             if item == 'target':
                 self._target_backup = self.resolve_property('target')
@@ -0,0 +1,119 @@
+#
+# Copyright CEA (2026)
+#
+# This file is part of MilkCheck project.
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading,  using,  modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean  that it is complicated to manipulate,  and  that  also
+# therefore means  that it is reserved for developers  and  experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and,  more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+'''
+This module manages the persistent ssh connections of a run. Remote
+commands share OpenSSH ControlMaster sockets, kept in a private directory,
+so that each node is connected once per run and not once per action.
+'''
+
+import os
+import atexit
+import time
+import shutil
+import logging
+import tempfile
+import subprocess
+
+class ConnectionPool(object):
+    '''
+    Pool of multiplexed ssh connections. The first ssh command to a node
+    starts a master connection, which is reused by the next commands to
+    this node, until close() stops all of them.
+    '''
+    _instance = None
+
+    SSH_PATH = 'ssh'
+
+    # Idle masters exit by themselves after this delay (in seconds), should
+    # close() never be called.
+    PERSIST = 600
+
+    # Max time to wait for the masters to exit
+    CLOSE_TIMEOUT = 10
+
+    def __init__(self):
+        # Private directory of the control sockets, None when not started
+        self.directory = None
+
+    def start(self):
+        '''
+        Create the control directory, if needed, and return the ssh options
+        using it.
+        '''
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix='mlk-ssh-')
+            atexit.register(self.close)
+        return ['-oControlMaster=auto',
+                '-oControlPath=%s' % os.path.join(self.directory, '%C'),
+                '-oControlPersist=%d' % self.PERSIST]
+
+    def sockets(self):
+        '''Return the paths of the current control sockets'''
+        if self.directory is None:
+            return []
+        return [os.path.join(self.directory, name)
+                for name in sorted(os.listdir(self.directory))]
+
+    def close(self):
+        '''Stop all master connections and remove the control directory'''
+        if self.directory is None:
+            return
+        logger = logging.getLogger('milkcheck')
+        procs = []
+        with open(os.devnull, 'w') as devnull:
+            for path in self.sockets():
+                # The host name is ignored when the socket path is explicit
+                cmd = [self.SSH_PATH, '-oControlPath=%s' % path, '-O', 'exit',
+                       'milkcheck']
+                try:
+                    procs.append(subprocess.Popen(cmd, stdin=devnull,
+                                                  stdout=devnull,
+                                                  stderr=devnull,
+                                                  close_fds=True))
+                except OSError as exc:
+                    logger.warning("Cannot stop ssh master %s: %s"
+                                   % (path, exc))
+        deadline = time.time() + self.CLOSE_TIMEOUT
+        for proc in procs:
+            while proc.poll() is None and time.time() < deadline:
+                time.sleep(0.05)
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.directory = None
+
+def connection_pool_self():
+    """Return a singleton instance of the ConnectionPool class"""
+    if not ConnectionPool._instance:
+        ConnectionPool._instance = ConnectionPool()
+    return ConnectionPool._instance
@@ -0,0 +1,339 @@
+#
+# Copyright CEA (2026)
+#
+# This file is part of MilkCheck project.
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading,  using,  modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean  that it is complicated to manipulate,  and  that  also
+# therefore means  that it is reserved for developers  and  experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and,  more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+'''
+This module keeps track of the nodes which cannot be reached through ssh
+during a run, and optionally across runs.
+'''
+
+import os
+import re
+import json
+import time
+import errno
+import select
+import socket
+import logging
+
+from ClusterShell.NodeSet import NodeSet
+from ClusterShell.Event import EventHandler
+
+# Exit code of ssh when the connection failed, or timed out
+SSH_ERROR = 255
+
+# Messages of ssh when it could not connect: commands may exit with
+# SSH_ERROR too
+SSH_FAILURES = re.compile(r'^(ssh: (connect to host|Could not resolve hostname)'
+                          r'|Connection (closed|reset|timed out)'
+                          r'|kex_exchange_identification)', re.MULTILINE)
+
+# Port checked by the pre-flight probe, by default
+SSH_PORT = 22
+
+def _connect(node, port):
+    '''
+    Start a non-blocking TCP connection to port of node. Return the socket,
+    None if the connection failed right away, or True if it succeeded.
+    '''
+    try:
+        family, stype, proto, _, addr = socket.getaddrinfo(
+                                        node, port, 0, socket.SOCK_STREAM)[0]
+        sock = socket.socket(family, stype, proto)
+    except (socket.error, OSError, UnicodeError):
+        return None
+    sock.setblocking(False)
+    err = sock.connect_ex(addr)
+    if err in (errno.EINPROGRESS, errno.EAGAIN):
+        return sock
+    sock.close()
+    return err == 0
+
+class TcpProbe(object):
+    '''
+    Connections to port of nodes, with at most 'limit' sockets polled at
+    once. Nodes which accepted the connection within timeout seconds are
+    alive.
+    '''
+
+    def __init__(self, nodes, port=SSH_PORT, timeout=None, limit=512):
+        self.alive = set()
+        self._pending = list(reversed(list(nodes)))
+        self._port = port
+        self._timeout = timeout
+        self._limit = limit
+        # fd -> (socket, node, deadline)
+        self._socks = {}
+        self._poller = select.poll()
+
+    def _start(self):
+        '''Start connections to pending nodes, up to the socket limit'''
+        while self._pending and len(self._socks) < self._limit:
+            node = self._pending.pop()
+            sock = _connect(node, self._port)
+            if sock is True:
+                self.alive.add(node)
+            elif sock is not None:
+                deadline = None
+                if self._timeout is not None:
+                    deadline = time.time() + self._timeout
+                self._socks[sock.fileno()] = (sock, node, deadline)
+                self._poller.register(sock.fileno(), select.POLLOUT)
+
+    def poll(self, wait=None):
+        '''
+        Wait at most wait seconds, or until the next connection deadline if
+        wait is None, for the connecting nodes. Return True once all nodes
+        are checked.
+        '''
+        self._start()
+        if not self._socks:
+            return not self._pending
+
+        deadlines = [item[2] for item in self._socks.values()
+                     if item[2] is not None]
+        if deadlines:
+            left = max(min(deadlines) - time.time(), 0)
+            wait = left if wait is None else min(wait, left)
+        if wait is not None:
+            wait *= 1000
+        for fdesc, _ in self._poller.poll(wait):
+            sock, node, _ = self._socks.pop(fdesc)
+            self._poller.unregister(fdesc)
+            if not sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                self.alive.add(node)
+            sock.close()
+
+        now = time.time()
+        for fdesc, (sock, node, deadline) in list(self._socks.items()):
+            if deadline is not None and deadline <= now:
+                del self._socks[fdesc]
+                self._poller.unregister(fdesc)
+                sock.close()
+        return not self._pending and not self._socks
+
+def tcp_probe(nodes, port=SSH_PORT, timeout=None, limit=512):
+    '''
+    Connect to port of all nodes at once, see TcpProbe. Return the nodes
+    which accepted the connection within timeout seconds.
+    '''
+    probe = TcpProbe(nodes, port, timeout, limit)
+    while not probe.poll():
+        pass
+    return probe.alive
+
+class ProbeHandler(EventHandler):
+    '''
+    Run a TcpProbe from the timers of an event loop, without waiting for
+    the connections, then report the result to NodeHealth.
+    '''
+
+    # Seconds between two polls of the connections
+    INTERVAL = 0.05
+
+    def __init__(self, health, nodes, timer):
+        EventHandler.__init__(self)
+        self._health = health
+        self._nodes = nodes
+        self._timer = timer
+        self._probe = TcpProbe(nodes, health.port, health.timeout,
+                               health.PROBE_SOCKETS)
+
+    def ev_timer(self, timer):
+        '''Check the connections, again later if some are pending'''
+        if self._probe.poll(0):
+            self._health.probed(self._nodes, self._probe.alive)
+        else:
+            self._timer(self.INTERVAL, self)
+
+def ssh_failed(retcode, output):
+    '''Tell if ssh could not connect, from its exit code and its output'''
+    if retcode != SSH_ERROR or not output:
+        return False
+    if isinstance(output, bytes):
+        output = output.decode('utf-8', 'replace')
+    return SSH_FAILURES.search(output) is not None
+
+class NodeHealth(object):
+    '''
+    Nodes which failed to connect: ssh exited with SSH_ERROR and reported a
+    connection failure, or the command timed out and the node does not
+    answer the probe either. They are pruned from the targets of the next
+    remote actions of the run. With a time to live ('ttl', in seconds),
+    they are also stored on disk, in 'directory', and skipped by the next
+    runs until they expire.
+    '''
+    _instance = None
+
+    HEALTH_FILE = 'health.json'
+
+    # Max number of nodes checked at the same time by a probe
+    PROBE_SOCKETS = 512
+
+    def __init__(self):
+        # Unreachable nodes of the current run, cached ones included
+        self.unreachable = NodeSet()
+        # Nodes which answered during the current run
+        self.reachable = NodeSet()
+        # Directory of the on-disk cache
+        self.directory = None
+        self.ttl = 0
+        # Timeout and port of the probes of nodes
+        self.timeout = 3
+        self.port = SSH_PORT
+
+    def clear(self):
+        '''
+        Forget about nodes health. A new run will start, with the unexpired
+        unreachable nodes of the on-disk cache.
+        '''
+        self.unreachable = NodeSet()
+        self.reachable = NodeSet()
+        self.unreachable.updaten(self._load())
+
+    @staticmethod
+    def concerns(action):
+        '''Tell if action runs through ssh'''
+        return action.remote and action.mode is None
+
+    def _dead(self, nodes):
+        '''Nodes are unreachable'''
+        logger = logging.getLogger('milkcheck')
+        for node in NodeSet(nodes) - self.unreachable:
+            logger.debug("%s is unreachable, skipped by the next actions"
+                         % node)
+        self.unreachable.update(nodes)
+
+    def update(self, action, node, retcode, output=None):
+        '''
+        Classify node after action ended on it with retcode, and output
+        (where ssh reports its errors).
+        '''
+        if node is None or not self.concerns(action):
+            return
+        if ssh_failed(retcode, output):
+            self._dead(node)
+        else:
+            self.reachable.add(node)
+
+    def timed_out(self, action, nodes, timer):
+        '''
+        Probe nodes on which action timed out, from the event loop which
+        timer(fire, handler) belongs to: the run goes on meanwhile. Those
+        which do not answer are unreachable once the probe ends.
+        '''
+        if not nodes or not self.concerns(action):
+            return
+        nodes = NodeSet(nodes) - self.unreachable
+        if nodes:
+            timer(0, ProbeHandler(self, nodes, timer))
+
+    def prune(self, action, nodes):
+        '''Return nodes without the unreachable ones, if action uses ssh'''
+        if nodes is None or not self.concerns(action):
+            return nodes
+        return nodes - self.unreachable
+
+    def probe(self, nodes, timeout=None, port=None):
+        '''
+        Check that port (by default self.port) is open on nodes, in
+        parallel. Nodes which do not answer are unreachable. Return them.
+        '''
+        nodes = NodeSet(nodes) - self.unreachable
+        if not nodes:
+            return NodeSet()
+        return self.probed(nodes, tcp_probe(nodes, port or self.port, timeout,
+                                            self.PROBE_SOCKETS))
+
+    def probed(self, nodes, alive):
+        '''
+        Nodes were probed, only those in alive answered. Return the
+        unreachable ones.
+        '''
+        dead = NodeSet()
+        for node in nodes:
+            if node in alive:
+                self.reachable.add(node)
+            else:
+                dead.add(node)
+        self._dead(dead)
+        return dead
+
+    def _cache_path(self):
+        '''Return the path of the on-disk cache'''
+        return os.path.join(self.directory, self.HEALTH_FILE)
+
+    def _read(self):
+        '''Return the unexpired entries of the on-disk cache: node -> time'''
+        if not self.ttl or not self.directory:
+            return {}
+        try:
+            with open(self._cache_path()) as cache:
+                entries = json.load(cache)
+        except (IOError, OSError, ValueError) as exc:
+            logger = logging.getLogger('milkcheck')
+            logger.debug("Node health cache not loaded: %s" % exc)
+            return {}
+        now = time.time()
+        return dict((node, stamp) for node, stamp in entries.items()
+                    if now - stamp < self.ttl)
+
+    def _load(self):
+        '''Return the unreachable nodes of the on-disk cache'''
+        return list(self._read().keys())
+
+    def save(self):
+        '''Store unreachable nodes in the on-disk cache, if enabled'''
+        if not self.ttl or not self.directory:
+            return
+        entries = self._read()
+        now = time.time()
+        for node in self.unreachable - self.reachable:
+            entries.setdefault(node, now)
+        for node in self.reachable:
+            entries.pop(node, None)
+        path = self._cache_path()
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            tmpname = '%s.%d' % (path, os.getpid())
+            with open(tmpname, 'w') as cache:
+                json.dump(entries, cache)
+            os.rename(tmpname, path)
+        except (IOError, OSError) as exc:
+            logger = logging.getLogger('milkcheck')
+            logger.warning("Cannot write node health cache %s: %s"
+                           % (path, exc))
+
+def node_health_self():
+    """Return a singleton instance of the NodeHealth class"""
+    if not NodeHealth._instance:
+        NodeHealth._instance = NodeHealth()
+    return NodeHealth._instance
@@ -44,7 +44,8 @@ from MilkCheck.Engine.BaseEntity import MilkCheckEngineError
 
 # Symbols
 from MilkCheck.Engine.BaseEntity import NO_STATUS, MISSING, DEP_ERROR
-from MilkCheck.Engine.BaseEntity import WAITING_STATUS
+from MilkCheck.Engine.BaseEntity import WAITING_STATUS, SKIPPED
+from MilkCheck.Engine.BaseEntity import REQUIRE, FILTER
 from MilkCheck.Callback import EV_STATUS_CHANGED, EV_TRIGGER_DEP
 
 class ActionNotFoundError(MilkCheckEngineError):
@@ -94,17 +95,35 @@ class Service(BaseEntity):
         # Is this Service the root Service
         self.root = root
 
+        # Start the action on each node as soon as dependencies are done
+        # on it, instead of waiting for them to be done on all nodes.
+        self.pipeline = False
+
+        # Nodes on which the current action ended successfully
+        self._nodes_done = NodeSet()
+
+        # Cache of downstream_priority()
+        self._downstream = None
+
     def update_target(self, nodeset, mode=None):
         '''Update the attribute target of a service'''
         BaseEntity.update_target(self, nodeset, mode)
         for action in self._actions.values():
             action.update_target(nodeset, mode)
 
+    def expand_targets(self):
+        '''Resolve deferred targets of the service and its actions'''
+        BaseEntity.expand_targets(self)
+        for action in self._actions.values():
+            action.expand_targets()
+
     def reset(self):
         '''Reset values of attributes in order to perform multiple exec'''
         BaseEntity.reset(self)
         self.origin = False
         self._last_action = None
+        self._nodes_done = NodeSet()
+        self._downstream = None
         for action in self._actions.values():
             action.reset()
 
@@ -179,6 +198,85 @@ class Service(BaseEntity):
                         call_back_self().notify((self, tgt), EV_TRIGGER_DEP)
                     tgt.prepare()
 
+    def expected_duration(self):
+        '''Return the expected duration of the current action, in seconds.'''
+        action = self._actions.get(self._last_action)
+        if self.simulate or action is None:
+            return 0
+        return action.expected_duration()
+
+    def priority(self):
+        '''
+        Return the expected duration of the longest chain of services which
+        starts with this one.
+        '''
+        return self.expected_duration() + self.downstream_priority()
+
+    exit_priority = priority
+
+    def downstream_priority(self):
+        '''
+        Return the expected duration of the longest chain of services which
+        run once this one is done.
+        '''
+        if self._downstream is None:
+            deps = self.children
+            if self._algo_reversed:
+                deps = self.parents
+
+            # Group entry and exit points have no parent. They lead to the
+            # end of their group, not to its beginning.
+            pseudo = self.simulate and self.parent is None
+            self._downstream = 0
+            for dep in deps.values():
+                if pseudo:
+                    value = dep.target.exit_priority()
+                else:
+                    value = dep.target.priority()
+                self._downstream = max(self._downstream, value)
+        return self._downstream
+
+    def node_done(self, node):
+        '''
+        The current action ended successfully on node. Services depending
+        on this one, in pipeline mode, could start on this node.
+        '''
+        self._nodes_done.add(node)
+
+        deps = self.children
+        if self._algo_reversed:
+            deps = self.parents
+
+        for dep in deps.values():
+            tgt = dep.target
+            if tgt.pipeline and tgt._tagged and tgt.status is NO_STATUS:
+                tgt._pipeline_node(node)
+
+    def _node_is_done(self, node):
+        '''Tell if this service will not prevent node to go further.'''
+        return node in self._nodes_done or self.status in (SKIPPED, MISSING)
+
+    def _pipeline_node(self, node):
+        '''
+        Start the action on node if all dependencies are done on it. Only
+        'require' and 'filter' dependencies over services are supported.
+        '''
+        action = self._actions.get(self._last_action)
+        if self.simulate or action is None or not action.can_pipeline(node):
+            return
+
+        deps = self.parents
+        if self._algo_reversed:
+            deps = self.children
+
+        for dep in deps.values():
+            if dep.dep_type not in (REQUIRE, FILTER) or \
+               not isinstance(dep.target, Service) or dep.target.simulate or \
+               not dep.target._node_is_done(node):
+                return
+
+        action.pipeline(NodeSet(node))
+
     def _launch_action(self, action, status):
         """
         Try to launch the action.
@@ -241,6 +339,7 @@ class Service(BaseEntity):
     def inherits_from(self, entity):
         '''Inherit properties from entity'''
         BaseEntity.inherits_from(self, entity)
+        self.pipeline = self.pipeline or getattr(entity, 'pipeline', False)
         for action in self.iter_actions():
             action.inherits_from(self)
 
@@ -248,6 +347,9 @@ class Service(BaseEntity):
         """Populate service attributes from dict."""
         BaseEntity.fromdict(self, svcdict)
 
+        if 'pipeline' in svcdict:
+            self.pipeline = svcdict['pipeline']
+
         if 'actions' in svcdict:
             dependencies = {}
             for names, props in svcdict['actions'].items():
@@ -266,6 +368,14 @@ class Service(BaseEntity):
         for action in self.iter_actions():
             action.inherits_from(self)
 
+    def iter_templates(self):
+        """Iterate over (entity, value) pairs resolved by resolve_all()"""
+        for item in BaseEntity.iter_templates(self):
+            yield item
+        for action in self.iter_actions():
+            for item in action.iter_templates():
+                yield item
+
     def resolve_all(self):
         """Resolve all variables in Service properties"""
         BaseEntity.resolve_all(self)
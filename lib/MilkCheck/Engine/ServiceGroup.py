@@ -77,10 +77,17 @@ class ServiceGroup(Service):
         self._source.simulate = True
         self._source.add_dep(target=self, parent=False)
         del self.parents['source']
+        self._deps_changed()
         self._sink = Service('sink')
         self._sink.simulate = True
         # subservices
         self._subservices = {}
+        # All entities below this group, by name relative to this group
+        # (ie: 'svc' or 'subgroup.svc'). It is not a single index of full
+        # names at the root: groups are built before being attached to
+        # their parent, which changes their full names, and groups which
+        # are not the root do not see names relative to it.
+        self._index = {}
 
     def update_target(self, nodeset, mode=None):
         '''Update the attribute target of a ServiceGroup'''
@@ -88,6 +95,12 @@ class ServiceGroup(Service):
         for service in self._subservices.values():
             service.update_target(nodeset, mode)
 
+    def expand_targets(self):
+        '''Resolve deferred targets of the group and its subservices'''
+        Service.expand_targets(self)
+        for service in self._subservices.values():
+            service.expand_targets()
+
     def filter_nodes(self, nodes):
         """
         Add error nodes to skip list.
@@ -111,9 +124,64 @@ class ServiceGroup(Service):
         self._sink.reset()
         self._source.reset()
 
+    def _index_add(self, entity):
+        """
+        Reference entity, and entities below it, in this group and its
+        parent groups index.
+        """
+        entries = [(entity.name, entity)]
+        if isinstance(entity, ServiceGroup):
+            for name, subentity in entity._index.items():
+                entries.append(('%s.%s' % (entity.name, name), subentity))
+        group = self
+        while group is not None:
+            group._index.update(entries)
+            entries = [('%s.%s' % (group.name, name), subentity)
+                       for name, subentity in entries]
+            group = group.parent
+
+    def _index_remove(self, entity):
+        """Remove entity, and entities below it, from the groups index"""
+        names = [entity.name]
+        if isinstance(entity, ServiceGroup):
+            names += ['%s.%s' % (entity.name, name) for name in entity._index]
+        group = self
+        while group is not None:
+            for name in names:
+                group._index.pop(name, None)
+            names = ['%s.%s' % (group.name, name) for name in names]
+            group = group.parent
+
+    def lookup(self, name):
+        """
+        Return the entity referenced by name (possibly dotted) relative to
+        this group, or None.
+        """
+        return self._index.get(name)
+
+    def _lookup_dep(self, name):
+        """
+        Return the entity referenced by a dependency name declared inside
+        this group. Names relative to this group come first, then names
+        relative to the root group. Anything else falls back to a graph
+        search: it resolves names relative to other groups (ie: 'svc.sub'
+        from a sibling group of the one holding 'svc'), as MilkCheck always
+        did, and configurations rely on it.
+        """
+        target = self.lookup(name)
+        if target is None:
+            root = self._get_root()
+            if root is not None:
+                target = root.lookup(name)
+        if target is None:
+            target = self.search(name)
+        return target
+
     def search(self, name, reverse=False):
         """Look for a node through the overall graph"""
-        target = None
+        target = self.lookup(name)
+        if target is not None:
+            return target
         if reverse:
             target = self._sink.search(name, reverse)
         else:
@@ -175,6 +243,7 @@ class ServiceGroup(Service):
             self._source.add_dep(target=target, sgth=sgth)
         self._subservices[target.name] = target
         target.parent = self
+        self._index_add(target)
         self.__update_edges()
 
     def __update_edges(self, create_links=False):
@@ -213,6 +282,7 @@ class ServiceGroup(Service):
             dep.target.remove_dep(dep_name, parent=False)
         for dep in list(self._subservices[dep_name].children.values()):
             dep.target.remove_dep(dep_name)
+        self._index_remove(self._subservices[dep_name])
         del self._subservices[dep_name]
         self.__update_edges(True)
 
@@ -293,9 +363,28 @@ class ServiceGroup(Service):
                 intd_status = self._source.eval_deps_status()
             self.update_status(intd_status)
 
+    def priority(self):
+        '''
+        Return the expected duration of the longest chain of services which
+        starts with this group, through its subservices.
+        '''
+        if not self._subservices:
+            return Service.priority(self)
+        return max(svc.priority() for svc in self.iter_subservices())
+
+    exit_priority = Service.priority
+
+    def exit_services(self):
+        '''Return the subservices which end the group'''
+        exit_point = self._source
+        if self._algo_reversed:
+            exit_point = self._sink
+        return [dep.target for dep in exit_point.deps().values()]
+
     def inherits_from(self, entity):
         '''Inherit properties from entity'''
         BaseEntity.inherits_from(self, entity)
+        self.pipeline = self.pipeline or getattr(entity, 'pipeline', False)
         for subservice in self.iter_subservices():
             subservice.inherits_from(self)
 
@@ -309,6 +398,9 @@ class ServiceGroup(Service):
             del self._source.children[self.name]
             self._sink.add_dep(target=self)
             del self.children['sink']
+        self._deps_changed()
+        self._sink._deps_changed()
+        self._source._deps_changed()
         for service in self._subservices.values():
             service.algo_reversed = flag
         self._algo_reversed = flag
@@ -321,6 +413,9 @@ class ServiceGroup(Service):
         """Populate group attributes from dict."""
         BaseEntity.fromdict(self, grpdict)
 
+        if 'pipeline' in grpdict:
+            self.pipeline = grpdict['pipeline']
+
         if 'services' in grpdict:
             dep_mapping = {}
 
@@ -352,6 +447,7 @@ class ServiceGroup(Service):
                     # Link the group and its new subservice together
                     self._subservices[subservice] = service
                     service.parent = self
+                    self._index_add(service)
 
                     # Populate service variables present in YAML
                     service.fromdict({'variables': props.get('variables', {})})
@@ -370,10 +466,8 @@ class ServiceGroup(Service):
                         wrap.deps[dtype] = [wrap.deps[dtype]]
 
                     for dep in wrap.deps[dtype]:
-                        dep_obj = self.search(dep)
-                        if dep in self._subservices:
-                            dep_obj = self._subservices[dep]
-                        elif dep_obj is None:
+                        dep_obj = self._lookup_dep(dep)
+                        if dep_obj is None:
                             raise UnknownDependencyError(dep)
                         wrap.source.add_dep(dep_obj, sgth=dtype.upper())
 
@@ -394,6 +488,14 @@ class ServiceGroup(Service):
         for subser in self.iter_subservices():
             subser.inherits_from(self)
 
+    def iter_templates(self):
+        """Iterate over (entity, value) pairs resolved by resolve_all()"""
+        for item in BaseEntity.iter_templates(self):
+            yield item
+        for subser in self.iter_subservices():
+            for item in subser.iter_templates():
+                yield item
+
     def resolve_all(self):
         """Resolve all variables in ServiceGroup properties"""
         BaseEntity.resolve_all(self)
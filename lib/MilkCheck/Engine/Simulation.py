@@ -0,0 +1,243 @@
+#
+# Copyright CEA (2026)
+#
+# This file is part of MilkCheck project.
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading,  using,  modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean  that it is complicated to manipulate,  and  that  also
+# therefore means  that it is reserved for developers  and  experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and,  more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+"""
+This module contains the Simulator, an execution backend which runs the
+engine on a virtual clock without executing any command.
+"""
+
+import time
+import heapq
+from fnmatch import fnmatch
+
+from ClusterShell.NodeSet import NodeSet
+
+from MilkCheck.Engine.Backend import EventLoopBackend
+from MilkCheck.Engine.ServiceGroup import ServiceGroup
+
+
+class Simulator(EventLoopBackend):
+    '''
+    Backend whose timers fire and commands complete on a virtual clock, so
+    the real engine (dependencies, fanouts, delays and retries) runs
+    without any process. Commands succeed, or time out if they last longer
+    than their action timeout, unless they match a failure rule.
+
+    Each command lasts 'step' seconds or, if 'model' is True, the expected
+    duration of its action: its cost, else its duration in 'durations' (by
+    action full name), else its estimation from previous runs. Nodes
+    started at the same virtual time are reported as a wave.
+
+    'failures' are (NodeSet, action pattern) rules: commands of the actions
+    whose full name matches the pattern exit with FAILURE_RC on the nodes
+    of the NodeSet ('localhost' for local commands). A None part matches
+    everything.
+    '''
+
+    FAILURE_RC = 1
+
+    simulated = True
+
+    def __init__(self, manager, model=False, step=1.0, durations=None,
+                 failures=None):
+        EventLoopBackend.__init__(self, manager)
+        self.model = model
+        self.step = step
+        self.durations = durations or {}
+        self.failures = list(failures or ())
+        # Virtual time elapsed since the beginning
+        self.clock = 0.0
+        self._origin = time.time()
+        # Started commands: (clock, action, node)
+        self.launches = []
+        # Action -> start clock
+        self.started = {}
+        # Action -> stop clock
+        self.stopped = {}
+
+    def now(self):
+        '''Return the virtual current time, as time.time() would'''
+        return self._origin + self.clock
+
+    def _clock(self):
+        '''Return the virtual time elapsed since the beginning'''
+        return self.clock
+
+    def duration(self, action):
+        '''Return the simulated duration of a command of the action'''
+        if not self.model:
+            return self.step
+        if action.cost is None and action.fullname() in self.durations:
+            return self.durations[action.fullname()]
+        return action.expected_duration()
+
+    def retcode(self, action, node):
+        '''Return the simulated return code of the action on node'''
+        for nodes, pattern in self.failures:
+            if (nodes is None or (node or 'localhost') in nodes) and \
+               (pattern is None or fnmatch(action.fullname(), pattern)):
+                return self.FAILURE_RC
+        return 0
+
+    def schedule(self, action, command, nodes, handler, fanout=None,
+                 timeout=None):
+        '''Start a simulated worker running command on nodes'''
+        if action not in self.started:
+            self.started[action] = self.clock
+        return EventLoopBackend.schedule(self, action, command, nodes,
+                                         handler, fanout, timeout)
+
+    def _start(self, window, worker, key):
+        '''Simulate the command of worker on node key'''
+        self.launches.append((self.clock, worker.action.fullname(),
+                              key or 'localhost'))
+        duration = self.duration(worker.action)
+        timeout = worker.timeout
+        if timeout and duration > timeout:
+            self._push(timeout, self._done, window, worker, key, None)
+        else:
+            self._push(duration, self._done, window, worker, key,
+                       self.retcode(worker.action, key))
+
+    def _stop(self, worker):
+        '''Cancel the simulated commands of worker'''
+        windows = []
+        events = []
+        for event in self._events:
+            if event[2] == self._done and event[3][1] is worker:
+                windows.append(event[3][0])
+            else:
+                events.append(event)
+        heapq.heapify(events)
+        self._events = events
+        return windows
+
+    def _close(self, worker):
+        '''All nodes of worker are done'''
+        self.stopped[worker.action] = self.clock
+        EventLoopBackend._close(self, worker)
+
+    def run(self):
+        '''Process events until none is left'''
+        while self._events:
+            when, _, callback, args = self._next_event()
+            self.clock = max(self.clock, when)
+            callback(*args)
+
+    def iter_waves(self):
+        '''
+        Return an iterator over (clock, [(action, NodeSet), ...]) tuples,
+        one by wave, with actions in their start order.
+        '''
+        wave = None
+        for clock, action, node in self.launches:
+            if wave is None or wave[0] != clock:
+                if wave is not None:
+                    yield wave
+                wave = (clock, [])
+            if wave[1] and wave[1][-1][0] == action:
+                wave[1][-1][1].add(node)
+            else:
+                wave[1].append((action, NodeSet(node)))
+        if wave is not None:
+            yield wave
+
+    def elapsed(self):
+        '''Return the virtual time at which the last action ended'''
+        return max([0.0] + list(self.stopped.values()))
+
+    def _ends(self, entity, ran, seen):
+        '''
+        Return the simulated actions whose completion ended entity: its
+        actions, those ending the subservices of a group, or those it
+        waited for if it ran nothing.
+        '''
+        if entity in seen:
+            return []
+        seen.add(entity)
+        if isinstance(entity, ServiceGroup):
+            result = []
+            for service in entity.exit_services():
+                result.extend(self._ends(service, ran, seen))
+            return result
+        if entity in ran:
+            return ran[entity]
+        return self._upstream(entity, ran, seen)
+
+    def _upstream(self, service, ran, seen):
+        '''Return the simulated actions service waited for'''
+        result = []
+        for dep in service.deps().values():
+            # Entry point of a group: the group waited for its dependencies
+            if dep.target.simulate and dep.target.parent is None:
+                if service.parent is not None:
+                    result.extend(self._upstream(service.parent, ran, seen))
+            else:
+                result.extend(self._ends(dep.target, ran, seen))
+        return result
+
+    def critical_path(self):
+        '''
+        Return the chain of actions which ended last, as (action, start,
+        stop) tuples in start order. Each action follows, among the
+        actions it depends on, the one which ended last.
+        '''
+        path = []
+        if not self.stopped:
+            return path
+        ran = {}
+        for act in self.stopped:
+            ran.setdefault(act.parent, []).append(act)
+
+        action = max(self.stopped, key=lambda act: self.stopped[act])
+        while action is not None:
+            path.append((action, self.started[action], self.stopped[action]))
+            # Checks of the same service, then services it depends on
+            causes = [dep.target for dep in action.parents.values()]
+            causes += self._upstream(action.parent, ran, set())
+            causes = [act for act in causes
+                      if act in self.stopped and
+                      act not in [item[0] for item in path]]
+            action = None
+            if causes:
+                action = max(causes, key=lambda act: self.stopped[act])
+        path.reverse()
+        return path
+
+    def binding_fanouts(self):
+        '''
+        Return the fanout windows where nodes waited for a free slot, as
+        (action name or None for the global window, fanout, waiting nodes,
+        longest wait) tuples, the longest waits first.
+        '''
+        result = [(name, limit, count, wait)
+                  for name, (limit, count, wait) in self.waits.items()]
+        return sorted(result, key=lambda item: -item[3])
@@ -0,0 +1,260 @@
+#
+# Copyright CEA (2026)
+#
+# This file is part of MilkCheck project.
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading,  using,  modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean  that it is complicated to manipulate,  and  that  also
+# therefore means  that it is reserved for developers  and  experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and,  more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+
+'''
+This module stores the results of MilkCheck runs in a SQLite database, and
+computes duration statistics from them. They also give the expected
+durations of actions.
+'''
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import logging
+import sqlite3
+from optparse import OptionParser
+
+from ClusterShell.NodeSet import NodeSet
+
+from MilkCheck.config import default_cache_dir
+
+HISTORY_FILE = 'history.db'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    command TEXT,
+    start REAL,
+    stop REAL,
+    status TEXT
+);
+CREATE TABLE IF NOT EXISTS actions (
+    run INTEGER REFERENCES runs(id),
+    action TEXT,
+    target TEXT,
+    start REAL,
+    stop REAL,
+    tries INTEGER,
+    status TEXT
+);
+CREATE TABLE IF NOT EXISTS nodes (
+    run INTEGER REFERENCES runs(id),
+    action TEXT,
+    node TEXT,
+    retcode INTEGER,
+    start REAL,
+    stop REAL
+);
+CREATE INDEX IF NOT EXISTS actions_action ON actions (action);
+CREATE INDEX IF NOT EXISTS nodes_action ON nodes (action, node);
+CREATE INDEX IF NOT EXISTS nodes_node ON nodes (node);
+'''
+
+def percentile(values, percent):
+    '''Return the nearest-rank percentile of sorted values'''
+    rank = max(int(-(-len(values) * percent // 100)), 1)
+    return values[rank - 1]
+
+class RunHistory(object):
+    '''
+    Results of previous runs: one row by run, by action and by node of an
+    action, with start and stop times.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._db = sqlite3.connect(path)
+        self._db.executescript(SCHEMA)
+
+    def close(self):
+        '''Close the database'''
+        self._db.close()
+
+    def record(self, command, actions, status, start=None, stop=None):
+        '''
+        Store a run and the given actions. Return the run id.
+        '''
+        with self._db:
+            cursor = self._db.execute(
+                'INSERT INTO runs (command, start, stop, status) '
+                'VALUES (?, ?, ?, ?)', (command, start, stop or time.time(),
+                                        status))
+            run = cursor.lastrowid
+            for action in actions:
+                name = action.fullname()
+                self._db.execute(
+                    'INSERT INTO actions VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (run, name, str(action.target or ''), action.start_time,
+                     action.stop_time, action.tries, action.status))
+                # Timed out nodes are not always hung up
+                times = dict(action.node_times)
+                for node in action.nodes_timeout():
+                    if node in times and times[node][1] is None:
+                        times[node] = [times[node][0], action.stop_time, None]
+                self._db.executemany(
+                    'INSERT INTO nodes VALUES (?, ?, ?, ?, ?, ?)',
+                    [(run, name, node, rc, nstart, nstop)
+                     for node, (nstart, nstop, rc) in sorted(times.items())])
+        return run
+
+    def durations(self, by='action', action=None, nodes=None):
+        '''
+        Return a {key: sorted durations} dict, where keys are action names
+        or node names, depending on 'by'. Only successful actions and nodes
+        are taken into account.
+        '''
+        if by == 'action':
+            query = ('SELECT action, stop - start FROM actions '
+                     "WHERE status IN ('DONE', 'WARNING') AND stop IS NOT NULL")
+        elif by == 'node':
+            query = ('SELECT node, stop - start FROM nodes '
+                     'WHERE retcode = 0 AND stop IS NOT NULL')
+        else:
+            raise ValueError("Unknown key '%s'" % by)
+        args = []
+        if action:
+            query += ' AND action GLOB ?'
+            args.append(action)
+        # Selected nodes are kept in a temporary table, they could be more
+        # than the maximum number of query parameters
+        if by == 'node' and nodes is not None:
+            self._db.execute('CREATE TEMP TABLE IF NOT EXISTS selected '
+                             '(node TEXT PRIMARY KEY)')
+            self._db.execute('DELETE FROM selected')
+            self._db.executemany('INSERT OR IGNORE INTO selected VALUES (?)',
+                                 [(node,) for node in NodeSet(nodes)])
+            query += ' AND node IN (SELECT node FROM selected)'
+
+        result = {}
+        for key, duration in self._db.execute(query, args):
+            result.setdefault(key, []).append(duration)
+        for values in result.values():
+            values.sort()
+        return result
+
+    def statistics(self, by='action', action=None, nodes=None):
+        '''
+        Return a sorted list of (key, count, p50, p95, max) tuples, see
+        durations().
+        '''
+        stats = []
+        durations = self.durations(by, action, nodes)
+        for key, values in sorted(durations.items()):
+            stats.append((key, len(values), percentile(values, 50),
+                          percentile(values, 95), values[-1]))
+        return stats
+
+class DurationHistory(object):
+    '''
+    Expected durations of actions, by action full name: a percentile of
+    their durations in the run history kept in 'directory'.
+    '''
+    _instance = None
+
+    def __init__(self):
+        self.directory = None
+        self.percentile = 50
+        self._durations = None
+
+    def _load(self):
+        '''Read the durations of the run history, if any'''
+        self._durations = {}
+        if not self.directory:
+            return
+        path = os.path.join(self.directory, HISTORY_FILE)
+        if not os.path.exists(path):
+            return
+        try:
+            history = RunHistory(path)
+            try:
+                durations = history.durations('action')
+            finally:
+                history.close()
+        except sqlite3.Error as exc:
+            logger = logging.getLogger('milkcheck')
+            logger.warning("Cannot read run history %s: %s" % (path, exc))
+            return
+        for name, values in durations.items():
+            self._durations[name] = percentile(values, self.percentile)
+
+    def estimate(self, name):
+        '''Return the expected duration of action 'name', None if unknown'''
+        if self._durations is None:
+            self._load()
+        return self._durations.get(name)
+
+def duration_history_self():
+    """Return a singleton instance of the DurationHistory class"""
+    if not DurationHistory._instance:
+        DurationHistory._instance = DurationHistory()
+    return DurationHistory._instance
+
+def main(args=None):
+    '''Entry point of milkcheck-history'''
+    parser = OptionParser(usage='usage: %prog [options] [ACTION_PATTERN]')
+    parser.add_option('-f', '--file', dest='path',
+                      default=os.path.join(default_cache_dir(), HISTORY_FILE),
+                      help='History database (default: %default)')
+    parser.add_option('-N', '--by-node', action='store_const', dest='by',
+                      const='node', default='action',
+                      help='Statistics by node instead of by action')
+    parser.add_option('-n', '--nodes', dest='nodes',
+                      help='Only the specified nodes (with --by-node)')
+    (options, args) = parser.parse_args(args)
+    if len(args) > 1:
+        parser.error('too many arguments')
+    if not os.path.exists(options.path):
+        parser.error("no history database '%s'" % options.path)
+
+    nodes = None
+    if options.nodes:
+        nodes = NodeSet(options.nodes)
+    history = RunHistory(options.path)
+    try:
+        stats = history.statistics(options.by, args and args[0] or None, nodes)
+    finally:
+        history.close()
+
+    width = max([len(options.by)] + [len(row[0]) for row in stats])
+    print('%-*s %6s %9s %9s %9s' % (width, options.by.upper(), 'COUNT',
+                                     'P50', 'P95', 'MAX'))
+    for row in stats:
+        print('%-*s %6d %9.2f %9.2f %9.2f' % ((width,) + row))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
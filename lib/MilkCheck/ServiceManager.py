@@ -33,8 +33,19 @@
 This module contains the ServiceManager class definition.
 '''
 
-from MilkCheck.Engine.BaseEntity import LOCKED, WARNING, VariableAlreadyExistError
+import time
+import logging
+
+from ClusterShell.NodeSet import NodeSet
+
+from MilkCheck.Engine.BaseEntity import BaseEntity, LOCKED, WARNING
+from MilkCheck.Engine.BaseEntity import VariableAlreadyExistError
+from MilkCheck.Engine.BaseEntity import command_cache_self
+from MilkCheck.Engine.BaseEntity import parse_template, TPL_DELIMITER
+from MilkCheck.Engine.NodeHealth import node_health_self
 from MilkCheck.Engine.ServiceGroup import ServiceGroup, ServiceNotFoundError
+from MilkCheck.Engine.Action import Action, action_manager_self
+from MilkCheck.Components import ComponentRunner, iter_entities
 
 
 class ServiceManager(ServiceGroup):
@@ -84,16 +95,19 @@ class ServiceManager(ServiceGroup):
             for varname in ('selected_node', 'excluded_nodes'):
                 self.add_var(varname.upper(), '')
 
-    def _apply_config(self, conf):
+    def _apply_config(self, conf, services=None, reverse=False):
         '''
         This apply a sequence of modifications on the graph. A modification
         can be an update of the nodes usable by the services or whatever that
         is referenced within configuration.
+
+        Return the entities reachable from 'services' (see reachable()), or
+        None if all of them are.
         '''
 
         # Load the configuration located within the directory
         if conf.get('config_dir'):
-            self.load_config(conf['config_dir'])
+            self.load_config(conf['config_dir'], conf.get('cache_dir'))
 
         # Avoid some of the services referenced in the graph
         if conf.get('excluded_svc'):
@@ -106,12 +120,155 @@ class ServiceManager(ServiceGroup):
                 if not svc.match_tags(conf['tags']):
                     svc.skip()
 
-        # Use just those nodes
+        # Only entities which could be run need to be resolved
+        scope = None
+        if services:
+            scope = self.reachable(services, conf.get('nodeps'), reverse)
+
+        # Targets are resolved before command line variables are defined
+        for ent in (self,) if scope is None else scope:
+            ent.expand_targets()
+
+        self._filter_nodes(conf, scope)
+        return scope
+
+    def _filter_nodes(self, conf, scope=None):
+        '''
+        Restrict targets to the nodes selected in configuration. If scope
+        is given, only the entities it contains are updated.
+        '''
         if conf.get('only_nodes') is not None:
-            self.update_target(conf['only_nodes'], 'INT')
-        # Avoid those nodes
+            nodes, mode = conf['only_nodes'], 'INT'
         elif conf.get('excluded_nodes') is not None:
-            self.update_target(conf['excluded_nodes'], 'DIF')
+            nodes, mode = conf['excluded_nodes'], 'DIF'
+        else:
+            return
+
+        if scope is None:
+            self.update_target(nodes, mode)
+        else:
+            BaseEntity.update_target(self, nodes, mode)
+            for ent in scope:
+                ent.update_target(nodes, mode)
+
+    def _preflight(self, conf, scope=None):
+        '''
+        Probe the ssh port (preflight_port, 22 by default) of the nodes of
+        remote actions, all at once, and remove the nodes which do not
+        answer from the targets of these actions. If scope is given, only
+        the actions it contains are checked.
+        '''
+        health = node_health_self()
+        actions = [ent for ent in iter_entities(self)
+                   if isinstance(ent, Action) and health.concerns(ent) and
+                   ent.target and (scope is None or ent.parent in scope)]
+        nodes = NodeSet()
+        for action in actions:
+            nodes.update(action.target)
+        start = time.time()
+        dead = health.probe(nodes, conf.get('preflight_timeout'),
+                            conf.get('preflight_port'))
+        logger = logging.getLogger('milkcheck')
+        logger.info("Pre-flight check of %d nodes in %.2fs: %d unreachable"
+                    % (len(nodes), time.time() - start, len(dead)))
+        if dead:
+            for action in actions:
+                action.update_target(dead, 'DIF')
+
+    def reachable(self, services, nodeps=False, reverse=None):
+        '''
+        Return the set of entities which could be run when calling
+        'services': those services, everything they contain and,
+        unless nodeps is set, their dependencies. Dependencies are followed
+        in the current direction, unless reverse is given.
+        '''
+        if reverse is None:
+            reverse = self._algo_reversed
+        scope = set()
+        stack = [self._subservices[name] for name in services
+                 if name in self._subservices]
+        while stack:
+            ent = stack.pop()
+            if ent in scope:
+                continue
+            scope.add(ent)
+            if isinstance(ent, ServiceGroup):
+                stack.extend(ent.iter_subservices())
+            # Selected services lose their dependencies with nodeps, those
+            # from the services they contain are kept.
+            if nodeps and ent.parent is self:
+                continue
+            deps = ent.children if reverse else ent.parents
+            # Group pseudo-services (source, sink) have no parent
+            stack.extend(dep.target for dep in deps.values()
+                         if dep.target.parent is not None)
+        return scope
+
+    def _resolution_plan(self, group, scope, groups):
+        '''
+        Yield (entity, whole) pairs to resolve, top-down. Entities of scope
+        are resolved as a whole. Only properties and variables of the groups
+        containing them are resolved.
+        '''
+        yield (group, False)
+        for svc in group.iter_subservices():
+            if svc in scope:
+                yield (svc, True)
+            elif svc in groups:
+                for item in self._resolution_plan(svc, scope, groups):
+                    yield item
+
+    def check_templates(self):
+        """
+        Check the syntax of all templates of the graph, without resolving
+        them: invalid placeholders raise ValueError.
+        """
+        for _, value in self.iter_templates():
+            if type(value) is str and TPL_DELIMITER in value:
+                parse_template(value)
+
+    def resolve_all(self, scope=None):
+        """
+        Resolve all variables of the graph, or only those needed by entities
+        from scope. External commands are run first, in parallel. Templates
+        out of scope are still checked.
+        """
+        try:
+            self._resolve_scope(scope)
+        finally:
+            # Commands run outside prefetch() are stored once
+            command_cache_self().save()
+
+    def _resolve_scope(self, scope):
+        '''Resolve the variables needed by scope, see resolve_all()'''
+        if scope is None:
+            command_cache_self().prefetch(self.iter_templates())
+            ServiceGroup.resolve_all(self)
+            return
+
+        self.check_templates()
+
+        groups = set()
+        for ent in scope:
+            parent = ent.parent
+            while parent is not None and parent not in groups:
+                groups.add(parent)
+                parent = parent.parent
+        plan = list(self._resolution_plan(self, scope, groups))
+
+        templates = []
+        for ent, whole in plan:
+            if whole:
+                templates.extend(ent.iter_templates())
+            else:
+                templates.extend(BaseEntity.iter_templates(ent))
+        command_cache_self().prefetch(templates)
+
+        for ent, whole in plan:
+            if whole:
+                ent.resolve_all()
+            else:
+                BaseEntity.resolve_all(ent)
 
     def select_services(self, services):
         """Disable all services except those from 'services'"""
@@ -148,20 +305,27 @@ class ServiceManager(ServiceGroup):
         '''Allow the user to call one or multiple services.'''
 
         # Make sure that the graph is usable
+        command_cache_self().clear()
+        node_health_self().clear()
+        action_manager_self().reset_stop()
         self.reset()
         self.variables.clear()
 
+        scope = None
         if conf:
+            reverse = action in conf.get('reverse_actions')
             # Apply configuration over the graph
-            self._apply_config(conf)
+            scope = self._apply_config(conf, services, reverse)
             # Enable reverse mode if needed, based on config
-            self.algo_reversed = action in conf.get('reverse_actions')
+            self.algo_reversed = reverse
+        elif services:
+            scope = self.reachable(services)
 
         # Create global variable from configuration
         self._variable_config(conf)
 
         # Ensure all variables have been resolved
-        self.resolve_all()
+        self.resolve_all(scope)
 
         # Adapt the graph for required services
         if services:
@@ -170,7 +334,23 @@ class ServiceManager(ServiceGroup):
         if conf and conf.get('nodeps'):
             self._disable_deps()
 
-        self.run(action)
+        if conf and conf.get('preflight') and \
+           not action_manager_self().backend.simulated:
+            self._preflight(conf, scope)
+
+        # Independent parts of the graph can run in separate processes,
+        # unless a failure should stop all of them
+        plan = None
+        if conf and not action_manager_self().backend.simulated and \
+           not conf.get('fail_fast'):
+            runner = ComponentRunner(self, conf.get('workers') or 1)
+            plan = runner.plan()
+        if plan:
+            runner.run(action, plan)
+        else:
+            self.run(action)
+        # Commands could be run by resolutions during the run
+        command_cache_self().save()
 
     def output_graph(self, services=None, excluded=None):
         """Return service graph (DOT format)"""
@@ -184,9 +364,9 @@ class ServiceManager(ServiceGroup):
         grph += '}\n'
         return grph
 
-    def load_config(self, conf):
+    def load_config(self, conf, cache_dir=None):
         '''
         Load the configuration within the manager thanks to MilkCheckConfig
         '''
         from MilkCheck.config import load_from_dir
-        self.fromdict(load_from_dir(conf))
+        self.fromdict(load_from_dir(conf, cache_dir=cache_dir))
@@ -39,15 +39,23 @@ specificities.
 
 # classes
 from __future__ import print_function
-import fcntl, termios, struct, os, sys, traceback, threading, select
+import fcntl, termios, struct, os, sys, traceback, threading, select, time
+import sqlite3
 from signal import SIGINT
 from ClusterShell.NodeSet import NodeSet
 from MilkCheck.Callback import CoreEvent, call_back_self
 from MilkCheck.UI.OptionParser import McOptionParser
 from MilkCheck.Engine.Action import Action, action_manager_self
+from MilkCheck.Engine.Simulation import Simulator
+from MilkCheck.Engine.Backend import ClusterShellBackend, LocalBackend
+from MilkCheck.Engine.ConnectionPool import connection_pool_self
+from MilkCheck.Engine.NodeHealth import node_health_self
 from MilkCheck.Engine.Service import Service
+from MilkCheck.Engine.BaseEntity import command_cache_self
 from MilkCheck.ServiceManager import ServiceManager
 from MilkCheck.config import ConfigParser, ConfigError
+from MilkCheck.History import RunHistory, HISTORY_FILE
+from MilkCheck.History import duration_history_self
 
 # Exceptions
 from yaml.scanner import ScannerError
@@ -55,6 +63,7 @@ from MilkCheck.Engine.ServiceGroup import ServiceNotFoundError
 from MilkCheck.UI.OptionParser import InvalidOptionError
 from MilkCheck.Engine.BaseEntity import UnknownDependencyError
 from MilkCheck.Engine.BaseEntity import InvalidVariableError
+from MilkCheck.Engine.BaseEntity import InvalidPropertyError
 from MilkCheck.Engine.BaseEntity import UndefinedVariableError
 from MilkCheck.Engine.BaseEntity import VariableAlreadyExistError
 from MilkCheck.Engine.BaseEntity import DependencyAlreadyReferenced
@@ -239,8 +248,11 @@ class ConsoleDisplay(object):
             line = line % (label, '[%s]' % entity.status)
         self.output(line)
 
-    def print_summary(self, actions, report='default'):
-        """Print the errors summary of the array actions"""
+    def print_summary(self, actions, report='default', stopped=None):
+        """
+        Print the errors summary of the array actions, and why the run was
+        stopped if it was.
+        """
         lines = []
 
         errors = 0
@@ -259,6 +271,7 @@ class ConsoleDisplay(object):
             if ent.status in (TIMEOUT, ERROR, DEP_ERROR):
                 error_nodes.add(errs)
                 error_nodes.add(timeouts)
+                error_nodes.add(ent.aborted_nodes)
                 lines.append(" + %s" % self.string_color(
                                                 ent.longname().strip(), 'RED'))
                 if report == 'full':
@@ -285,6 +298,9 @@ class ConsoleDisplay(object):
                        to_spell,
                        self.string_color(errors, (errors and 'RED' or 'GREEN')))
         lines.insert(0, header)
+        if stopped:
+            lines.append(" + %s" % self.string_color('Run stopped: %s'
+                                                     % stopped, 'RED'))
         good_nodes = all_nodes - all_error_nodes
         if report == 'full' and good_nodes:
             lines.append(" + %s" % self.string_color('Success on all services',
@@ -297,7 +313,8 @@ class ConsoleDisplay(object):
         line = '%s %s %s %s\n > %s' % \
             (self.string_color(action.name, 'MAGENTA'),
              action.parent.fullname(),
-             self.string_color('on', 'MAGENTA'), action.target or 'localhost',
+             self.string_color('on', 'MAGENTA'),
+             action.attempt_target() or 'localhost',
              self.string_color(action.command, 'CYAN'))
         self.output(line)
 
@@ -338,38 +355,64 @@ class ConsoleDisplay(object):
             (self.string_color(action.name, 'MAGENTA'),
              action.parent.fullname(),
              action.duration)]
-        buffers = []
-        retcodes = []
-        timeout = NodeSet()
-        # Local action
-        if action.worker.current_node is None:
-            buffers = [(action.worker.read(), 'localhost')]
-            if action.worker.did_timeout():
-                timeout.add('localhost')
-            if action.worker.retcode() is not None:
-                retcodes.append((action.worker.retcode(),'localhost'))
-        # Remote action
-        else:
-            buffers = action.worker.iter_buffers()
-            retcodes = action.worker.iter_retcodes()
-            timeout = NodeSet.fromlist(action.worker.iter_keys_timeout())
+        backend = action_manager_self().backend
+        buffers = backend.iter_buffers(action.worker)
+        retcodes = backend.iter_retcodes(action.worker)
+        timeout = backend.nodes_timeout(action.worker)
 
         line += self.__gen_action_output(buffers, retcodes, timeout, error_only)
         self.output("\n".join(line))
 
+    def print_waves(self, simulator):
+        '''Display the actions started by a simulated run, wave by wave'''
+        lines = []
+        for idx, (clock, actions) in enumerate(simulator.iter_waves()):
+            for action, nodes in actions:
+                lines.append('wave %d (+%.2f s): %s on %s' %
+                             (idx + 1, clock,
+                              self.string_color(action, 'MAGENTA'),
+                              self.string_color(nodes, 'CYAN')))
+        if not simulator.failures:
+            lines.append('(all commands succeed, see --simulate-fail)')
+        self.output("\n".join(lines))
+
+    def print_estimate(self, simulator):
+        '''Display the predicted duration of a simulated run'''
+        lines = ['Estimated duration: %s' %
+                 self.string_color('%.2f s' % simulator.elapsed(), 'GREEN')]
+        # Durations are not sampled: one value by action, for all its nodes
+        lines.append('(each action lasts its cost or the p%d of its recorded '
+                     'durations on all its nodes)' %
+                     duration_history_self().percentile)
+        if not simulator.failures:
+            lines.append('(all commands succeed, see --simulate-fail)')
+        lines.append('Critical path:')
+        for action, start, stop in simulator.critical_path():
+            lines.append('  +%.2f s -> +%.2f s %s' %
+                         (start, stop,
+                          self.string_color(action.fullname(), 'MAGENTA')))
+        fanouts = simulator.binding_fanouts()
+        if fanouts:
+            lines.append('Binding fanouts:')
+        for name, fanout, count, wait in fanouts:
+            lines.append('  %s: fanout %d, %d nodes waited up to %.2f s' %
+                         (self.string_color(name or 'global', 'CYAN'),
+                          fanout, count, wait))
+        self.output("\n".join(lines))
+
     def print_delayed_action(self, action):
         '''Display a message specifying that this action has been delayed'''
         line = '%s %s %s %s s' % \
             (self.string_color(action.name, 'MAGENTA'),
              action.parent.fullname(),
              self.string_color('will fire in', 'MAGENTA'),
-             action.delay)
+             action.next_delay)
         self.output(line)
 
     def print_manager_status(self, manager):
         ''' Display current ActionManager status'''
         msg = self.string_color("\nActions in progress\n", 'MAGENTA')
-        for act in manager.running_tasks:
+        for act in list(manager.running_tasks):
             if act.status in (NO_STATUS, WAITING_STATUS):
                 target = str(act.pending_target) or 'localhost'
                 # Display nodeset count if needed (greather than 2)
@@ -379,7 +422,7 @@ class ConsoleDisplay(object):
                 # Manage delayed status
                 delayed = ''
                 if act.tries == 0 and act.delay:
-                    delayed = " (delayed for %ss)" % act.delay
+                    delayed = " (delayed for %ss)" % act.next_delay
                 # Manage line length
                 label = act.fullname()
                 name_len = len(" > %s on " % label)
@@ -508,11 +551,63 @@ class CommandLine(CoreEvent):
             # Configure ActionManager
             action_manager_self().default_fanout = self._conf['fanout']
             action_manager_self().dryrun = self._conf['dryrun']
+            action_manager_self().fusion = self._conf['fusion']
+            action_manager_self().coalesce = self._conf['coalesce']
+            action_manager_self().early_abort = self._conf['early_abort']
+            # Each run gets its own backend: a previous run could have
+            # left a simulator or another backend in place
+            failures = self._conf.get('simulate_fail')
+            if self._conf.get('simulation'):
+                action_manager_self().backend = \
+                        Simulator(action_manager_self(), failures=failures)
+            elif self._conf.get('estimate'):
+                action_manager_self().backend = \
+                        Simulator(action_manager_self(), model=True,
+                                  failures=failures)
+            elif self._conf.get('backend') == 'local':
+                action_manager_self().backend = \
+                                          LocalBackend(action_manager_self())
+            elif self._conf.get('backend') == 'asyncio':
+                # Python 3 only
+                from MilkCheck.Engine.AsyncBackend import AsyncioBackend
+                action_manager_self().backend = \
+                                        AsyncioBackend(action_manager_self())
+            else:
+                action_manager_self().backend = ClusterShellBackend()
+
+            # Run-level stop conditions, see ActionManager.stop()
+            action_manager_self().fail_fast = self._conf['fail_fast']
+            action_manager_self().deadline = None
+            if self._conf['deadline']:
+                action_manager_self().deadline = \
+                        action_manager_self().now() + self._conf['deadline']
+
+            # Remote commands share one ssh connection per node
+            if self._conf.get('ssh_pool') and not self._conf['dryrun'] and \
+               not action_manager_self().backend.simulated:
+                action_manager_self().backend.set_ssh_options(
+                                            connection_pool_self().start())
+
+            # Configure external command cache
+            command_cache_self().directory = self._conf['cache_dir']
+            command_cache_self().ttls = self._conf['command_cache']
+
+            # Durations in the run history estimate action costs
+            duration_history_self().directory = self._conf['cache_dir']
+            duration_history_self().percentile = \
+                                        self._conf.get('percentile') or 50
+
+            # Unreachable nodes could be skipped by the next runs
+            node_health_self().directory = self._conf['cache_dir']
+            node_health_self().ttl = self._conf['health_ttl']
+            node_health_self().timeout = self._conf['preflight_timeout']
+            node_health_self().port = self._conf['preflight_port']
 
             self.manager = self.manager or ServiceManager()
             # Case 0: build the graph
             if self._conf.get('graph', False):
-                self.manager.load_config(self._conf['config_dir'])
+                self.manager.load_config(self._conf['config_dir'],
+                                         self._conf.get('cache_dir'))
                 # Deps graph generation
                 self._console.output(self.manager.output_graph(self._args,
                                      self._conf.get('excluded_svc', [])))
@@ -535,18 +630,42 @@ class CommandLine(CoreEvent):
                     self.inter_thread.start()
 
                 # Run tasks
+                start = time.time()
                 self.manager.call_services(services, action, conf=self._conf)
+                unreachable = node_health_self().unreachable
+                if unreachable:
+                    self._logger.warning("Unreachable nodes skipped: %s"
+                                         % unreachable)
+                # Nodes which answered again are removed from the cache
+                if not self._conf['dryrun'] and \
+                   not action_manager_self().backend.simulated:
+                    node_health_self().save()
                 retcode = self.retcode()
-
-                if self._conf.get('report', 'no').lower() != 'no':
-                    r_type = self._conf.get('report','default')
-                    self._console.print_summary(self.actions, report=r_type)
+                self.record_history(command_line, start)
+
+                if self._conf.get('simulation'):
+                    self._console.print_waves(action_manager_self().backend)
+                elif self._conf.get('estimate'):
+                    self._console.print_estimate(
+                                            action_manager_self().backend)
+
+                # A stopped run always ends with its partial summary
+                r_type = self._conf.get('report', 'no').lower()
+                stopped = action_manager_self().stopped
+                if stopped and r_type == 'no':
+                    r_type = 'default'
+                if r_type != 'no':
+                    self._console.print_summary(self.actions, report=r_type,
+                                                stopped=stopped)
 
             # Case 2 : Check configuration
             elif self._conf.get('config_dir', False):
                 self._console.output("No actions specified, "
                                      "checking configuration...")
-                self.manager.load_config(self._conf['config_dir'])
+                self.manager.load_config(self._conf['config_dir'],
+                                         self._conf.get('cache_dir'))
+                # Targets are lazily resolved, check them all
+                self.manager.expand_targets()
                 self._console.output("%s seems good" % self._conf['config_dir'])
             # Case 3: Nothing to do so just print MilkCheck help
             else:
@@ -554,6 +673,7 @@ class CommandLine(CoreEvent):
         except (ServiceNotFoundError,
                 ActionNotFoundError,
                 InvalidVariableError,
+                InvalidPropertyError,
                 UndefinedVariableError,
                 VariableAlreadyExistError,
                 DependencyAlreadyReferenced,
@@ -586,6 +706,11 @@ class CommandLine(CoreEvent):
             else:
                 self._logger.error('Unexpected Exception : %s' % exc)
             retcode = RC_UNKNOWN_EXCEPTION
+        finally:
+            # Stop ssh master connections, even on KeyboardInterrupt, and
+            # do not use their options in the next runs
+            action_manager_self().backend.set_ssh_options([])
+            connection_pool_self().close()
 
         # Quit the interactive thread
         self.inter_thread.quit()
@@ -593,6 +718,23 @@ class CommandLine(CoreEvent):
 
         return retcode
 
+    def record_history(self, command_line, start):
+        '''Store executed actions in the run history database'''
+        if not self._conf.get('history') or self._conf.get('dryrun') or \
+           self._conf.get('simulation') or self._conf.get('estimate'):
+            return
+        path = os.path.join(self._conf['cache_dir'], HISTORY_FILE)
+        try:
+            history = RunHistory(path)
+            try:
+                history.record(' '.join(command_line), self.actions,
+                               self.manager.status, start)
+            finally:
+                history.close()
+        except (OSError, IOError, sqlite3.Error) as exc:
+            self._logger.warning("Cannot record run history in %s: %s"
+                                 % (path, exc))
+
     def retcode(self):
         '''
         Determine a retcode from a the last point of the graph
@@ -54,15 +54,29 @@ def check_nodeset(_option, _opt, _value):
     except GroupResolverError as msg:
         raise InvalidOptionError('%s uses a wrong group' % msg)
 
+def check_failure(_option, _opt, _value):
+    '''
+    Build a NODES/ACTION failure rule of the simulator from the option
+    value: a (NodeSet, action pattern) tuple, None for a missing part.
+    '''
+    nodes, _, action = _value.partition('/')
+    try:
+        return (NodeSet(nodes) if nodes else None, action or None)
+    except NodeSetException:
+        raise InvalidOptionError('%s is not a valid nodeset' % nodes)
+    except GroupResolverError as msg:
+        raise InvalidOptionError('%s uses a wrong group' % msg)
+
 
 class MilkCheckOption(Option):
     '''
     This class provide a new type that can be used in the type
     category of the parser.
     '''
-    TYPES = Option.TYPES + ('nodeset',)
+    TYPES = Option.TYPES + ('nodeset', 'failure')
     TYPE_CHECKER = copy(Option.TYPE_CHECKER)
     TYPE_CHECKER['nodeset'] = check_nodeset
+    TYPE_CHECKER['failure'] = check_failure
 
 class McOptionParser(OptionParser):
     '''
@@ -131,12 +145,44 @@ class McOptionParser(OptionParser):
                        dest='dryrun', default=False,
                        help='Only simulate command execution')
 
+        eng.add_option('--simulate', action='store_true',
+                       dest='simulation', default=False,
+                       help='Run nothing, print the waves in which actions '
+                            'would be started')
+
+        eng.add_option('--simulate-fail', action='append', type='failure',
+                       dest='simulate_fail', metavar='NODES/ACTION',
+                       help='Simulated commands of ACTION fail on NODES '
+                            '(default: all commands succeed)')
+
+        eng.add_option('-w', '--workers', action='store', type='int',
+                       dest='workers',
+                       help='Run independent services in up to WORKERS '
+                            'processes')
+
+        eng.add_option('--estimate', action='store_true',
+                       dest='estimate', default=False,
+                       help='Run nothing, predict the run duration from '
+                            'recorded durations')
+
+        eng.add_option('--percentile', action='store', type='int',
+                       dest='percentile',
+                       help='Percentile of recorded durations used as '
+                            'expected durations (default 50)')
+
         eng.add_option('--define', '--var', '-D', action='append',
                        dest='defines', help='Define custom variables')
 
         eng.add_option('--nodeps', action='store_true', dest='nodeps',
                        default=False, help='Do not run dependencies')
 
+        eng.add_option('--fail-fast', action='store_true', dest='fail_fast',
+                       help='Stop the run as soon as an action fails')
+
+        eng.add_option('--deadline', action='store', type='int',
+                       dest='deadline', metavar='SECONDS',
+                       help='Stop the run after SECONDS seconds')
+
         eng.add_option('-t', '--tags', action='callback', dest='tags',
                        callback=self._config_tags, type='string', default=set(),
                        help='Run services matching these tags')
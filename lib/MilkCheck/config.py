@@ -41,11 +41,23 @@ import re
 import os
 import os.path
 import yaml
+import hashlib
 import logging
+import marshal
+import multiprocessing
 
 class ConfigError(Exception):
     """Generic error for configuration file error."""
 
+def default_cache_dir():
+    """
+    Return the per-user directory where MilkCheck keeps data between runs:
+    milkcheck in $XDG_CACHE_HOME, or in ~/.cache.
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or \
+           os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'milkcheck')
+
 class ConfigParser(object):
     """Manage milkcheck.conf"""
 
@@ -58,6 +70,23 @@ class ConfigParser(object):
          'report':          { 'value': 'no', 'type': str,
                               'allowed_values': ('no', 'default', 'full') },
          'confirm_actions': { 'value': [], 'type': list },
+         'cache_dir':       { 'value': default_cache_dir(), 'type': str },
+         'command_cache':   { 'value': {}, 'type': dict },
+         'history':         { 'value': True, 'type': bool },
+         'workers':         { 'value': 1, 'type': int },
+         'ssh_pool':        { 'value': False, 'type': bool },
+         'fusion':          { 'value': False, 'type': bool },
+         'coalesce':        { 'value': False, 'type': bool },
+         'early_abort':     { 'value': False, 'type': bool },
+         'fail_fast':       { 'value': False, 'type': bool },
+         'deadline':        { 'value': 0, 'type': int },
+         'health_ttl':      { 'value': 0, 'type': int },
+         'preflight':       { 'value': False, 'type': bool },
+         'preflight_timeout': { 'value': 3, 'type': int },
+         'preflight_port':  { 'value': 22, 'type': int },
+         'backend':         { 'value': 'clustershell', 'type': str,
+                              'allowed_values': ('clustershell', 'local',
+                                                 'asyncio') },
          }
 
     def __init__(self, options):
@@ -201,30 +230,164 @@ def _merge_flow(flow):
                 raise ConfigError("Bad rule '%s'" % elem)
     return merged
 
+# libyaml based loader is much faster, when available
+YAMLLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
 def load_from_stream(stream):
     """
     Load configuration from a stream.
 
     A stream could be a string or file descriptor
     """
-    return _merge_flow(yaml.safe_load_all(stream))
+    return _merge_flow(yaml.load_all(stream, Loader=YAMLLoader))
+
+def load_from_file(filename):
+    """Load configuration from a YAML file."""
+    with open(filename) as stream:
+        return load_from_stream(stream)
+
+# Below this number of files, parsing them is faster than starting processes
+PARALLEL_MIN_FILES = 32
+
+def load_from_files(filenames, workers=None):
+    """
+    Load configuration from several YAML files, in parallel if there are
+    many of them. Return the list of their content, in the same order.
+    """
+    workers = min(workers or multiprocessing.cpu_count(), len(filenames))
+    if len(filenames) < PARALLEL_MIN_FILES or workers < 2:
+        return [load_from_file(filename) for filename in filenames]
+    pool = multiprocessing.Pool(workers)
+    try:
+        # Errors raised while parsing are raised again here
+        return pool.map(load_from_file, filenames)
+    finally:
+        pool.terminate()
+        pool.join()
+
+class ConfigCache(object):
+    """
+    Content of YAML configuration files, kept on disk between runs.
+
+    A file is parsed again only if its modification time or size changed
+    and its content hash is not the same anymore.
+    """
+
+    CACHE_FILE = 'config.cache'
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._entries = None
+        self._keys = {}
+        self._dirty = False
 
-def load_from_dir(directory, recursive=False):
+    def _cache_path(self):
+        '''Return the path of the on-disk cache'''
+        return os.path.join(self.directory, self.CACHE_FILE)
+
+    def _load(self):
+        '''Read the on-disk cache'''
+        self._entries = {}
+        try:
+            with open(self._cache_path(), 'rb') as cache:
+                entries = marshal.load(cache)
+            if isinstance(entries, dict):
+                self._entries = entries
+        except (IOError, OSError, EOFError, ValueError, TypeError) as exc:
+            logger = logging.getLogger('milkcheck')
+            logger.debug("Configuration cache not loaded: %s" % exc)
+
+    def lookup(self, filename):
+        """
+        Return a (found, data) tuple. If found is True, data is the content
+        of filename, as load_from_file() would return it.
+        """
+        if self._entries is None:
+            self._load()
+
+        stat = os.stat(filename)
+        key = (stat.st_mtime, stat.st_size)
+        entry = self._entries.get(filename)
+        if entry and entry[0] == key:
+            return (True, entry[2])
+
+        with open(filename, 'rb') as stream:
+            digest = hashlib.sha1(stream.read()).hexdigest()
+        self._keys[filename] = (key, digest)
+        if entry and entry[1] == digest:
+            self.store(filename, entry[2])
+            return (True, entry[2])
+        return (False, None)
+
+    def store(self, filename, data):
+        """Keep data as the content of filename, previously looked up."""
+        key, digest = self._keys.pop(filename)
+        try:
+            # Some YAML types (dates, ...) cannot be stored
+            marshal.dumps(data)
+        except ValueError:
+            self._entries.pop(filename, None)
+        else:
+            self._entries[filename] = (key, digest, data)
+        self._dirty = True
+
+    def save(self):
+        '''Write the on-disk cache if it was modified.'''
+        if not self._dirty:
+            return
+        self._dirty = False
+        path = self._cache_path()
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            tmpname = '%s.%d' % (path, os.getpid())
+            with open(tmpname, 'wb') as cache:
+                marshal.dump(self._entries, cache)
+            os.rename(tmpname, path)
+        except (IOError, OSError) as exc:
+            logger = logging.getLogger('milkcheck')
+            logger.warning("Cannot write configuration cache %s: %s"
+                           % (path, exc))
+
+def load_from_dir(directory, recursive=False, cache_dir=None):
     """
     Load all YAML files in the provided directory.
 
-    There is no recursion by default.
+    There is no recursion by default. If cache_dir is set, files which did
+    not change since the previous call are not parsed again.
     """
     if not os.path.isdir(directory):
         raise ValueError("Invalid directory '%s'" % directory)
 
-    flow = []
+    filenames = []
     for root, dirs, names in os.walk(directory):
         if not recursive:
             dirs[:] = []
         for name in names:
             fullname = os.path.join(root, name)
             if os.path.isfile(fullname) and re.search(r'\.ya?ml$', name):
-                flow.append(load_from_stream(open(fullname)))
-
+                filenames.append(fullname)
+
+    cache = None
+    if cache_dir:
+        cache = ConfigCache(cache_dir)
+
+    # Content is merged in directory walk order, whatever the parsing order
+    flow = [None] * len(filenames)
+    missing = []
+    for idx, filename in enumerate(filenames):
+        found = False
+        if cache:
+            found, flow[idx] = cache.lookup(filename)
+        if not found:
+            missing.append(idx)
+
+    parsed = load_from_files([filenames[idx] for idx in missing])
+    for idx, data in zip(missing, parsed):
+        flow[idx] = data
+        if cache:
+            cache.store(filenames[idx], data)
+
+    if cache:
+        cache.save()
     return _merge_flow(flow)
@@ -46,6 +46,7 @@ make install DESTDIR="%{buildroot}" PYTHON=%{__python_name} MANDIR=%{_mandir} \
 %config %{_sysconfdir}/%{name}/conf
 %config(noreplace) %{_sysconfdir}/%{name}/milkcheck.conf
 %{_bindir}/milkcheck
+%{_bindir}/milkcheck-history
 %{_mandir}/man8/*
 %doc AUTHORS
 %doc README.md
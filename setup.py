@@ -14,5 +14,5 @@ setup(name='MilkCheck',
       author_email='aurelien.degremont@cea.fr',
       package_dir={'': 'lib'},
       packages=find_packages('lib'),
-      scripts=['scripts/milkcheck']
+      scripts=['scripts/milkcheck', 'scripts/milkcheck-history']
      )
@@ -6,6 +6,8 @@
 This modules defines the tests cases targeting the BaseService
 """
 
+import os
+import shutil
 import socket
 import tempfile
 from unittest import TestCase
@@ -15,8 +17,10 @@ from ClusterShell.Task import task_self
 
 from MilkCheck.Engine.BaseEntity import NO_STATUS, DONE, ERROR, TIMEOUT, \
                                         DEP_ERROR, SKIPPED, WARNING
+from MilkCheck.Engine.BaseEntity import InvalidPropertyError
 from MilkCheck.Engine.Action import Action, ActionManager, action_manager_self
 from MilkCheck.Engine.Service import Service
+from MilkCheck.Engine.Backend import BackendWorker
 from MilkCheckTests import setup_sshconfig, cleanup_sshconfig
 
 HOSTNAME = socket.gethostname().split('.')[0]
@@ -249,6 +253,62 @@ class ActionTest(TestCase):
         self.assertTrue(0.59 <= action.duration <= 0.8,
                         "%.3f is not between 0.59 and 0.8" % action.duration)
 
+    def test_retry_failed_nodes(self):
+        """Test only failed nodes are retried"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            log = os.path.join(tmpdir, 'log')
+            action = Action('start', target='n[1-4]',
+                            command='echo %%h >> %s; test %%h != n3' % log)
+            action.remote = False
+            action.maxretry = 2
+            service = Service('retry')
+            service.add_action(action)
+            service.run('start')
+            self.assertEqual(action.tries, 3)
+            self.assertEqual(action.status, ERROR)
+            self.assertEqual(action.nodes_error(), NodeSet('n3'))
+            self.assertEqual(sorted(open(log).read().split()),
+                             ['n1', 'n2', 'n3', 'n3', 'n3', 'n4'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_retry_merged_results(self):
+        """Test results of nodes which succeeded are kept by retries"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            marker = os.path.join(tmpdir, 'marker')
+            action = Action('start', target='n[1-4]',
+                            command='if [ %%h = n3 -a ! -e %s ]; then '
+                                    'touch %s; echo failed; exit 1; fi; '
+                                    'echo ok' % (marker, marker))
+            action.remote = False
+            action.maxretry = 1
+            service = Service('retry')
+            service.add_action(action)
+            service.run('start')
+            self.assertEqual(action.tries, 2)
+            self.assertEqual(action.status, DONE)
+            backend = action_manager_self().backend
+            self.assertEqual(list(backend.iter_retcodes(action.worker)),
+                             [(0, NodeSet('n[1-4]'))])
+            self.assertEqual([(bytes(buf), nodes) for buf, nodes
+                              in backend.iter_buffers(action.worker)],
+                             [(b'ok', NodeSet('n[1-4]'))])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_retry_backoff(self):
+        """Test retry delay with exponential backoff"""
+        action = Action('start', command='/bin/false', delay=5)
+        action.backoff = 0.1
+        self.assertEqual(action._schedule_delay(), 5)
+        action.tries = 3
+        for _ in range(10):
+            self.assertTrue(0.2 <= action._schedule_delay() <= 0.4)
+        action.backoff = 0
+        self.assertEqual(action._schedule_delay(), 5)
+
     def test_schedule(self):
         """Test behaviour method schedule"""
         a1 = Action(name='start', command='/bin/true')
@@ -465,27 +525,31 @@ class ActionManagerTest(TestCase):
         task_manager.add_task(task2)
         task_manager.add_task(task3)
         task_manager.add_task(task3)
-        self.assertEqual(task_manager.fanout, 12)
+        self.assertEqual(task_manager.tasks_count, 3)
         task4 = Action('check')
         task4.fanout = 3
         task_manager.add_task(task4)
-        self.assertEqual(task_manager.fanout, 3)
         self.assertEqual(task_manager.tasks_count, 4)
         self.assertEqual(task_manager.tasks_done_count, 4)
 
-    def test_add_task_weird_values(self):
-        """Test the method add task with task without fanout"""
+    def test_fanout_window(self):
+        """Test each task gets its own fanout window"""
         task_manager = action_manager_self()
+        task_manager.default_fanout = 64
         task1 = Action('start')
         task1.fanout = 60
         task2 = Action('stop')
         task3 = Action('status')
-        task3.fanout = 50
+        task3.fanout = 128
+        task4 = Action('check')
+        task4.fanout = 0
+        self.assertEqual(task_manager.fanout_window(task1), 60)
+        self.assertEqual(task_manager.fanout_window(task2), None)
+        self.assertEqual(task_manager.fanout_window(task3), None)
+        self.assertEqual(task_manager.fanout_window(task4), None)
+        # A small fanout does not change the global one
         task_manager.add_task(task1)
-        task_manager.add_task(task2)
-        task_manager.add_task(task3)
-        self.assertEqual(task_manager.fanout, 50)
-        self.assertEqual(task_manager.tasks_count, 3)
+        self.assertEqual(task_self().info('fanout'), 64)
 
     def test_remove_task(self):
         """Test the behaviour of the remove_task method"""
@@ -502,15 +566,13 @@ class ActionManagerTest(TestCase):
         task_manager.add_task(task2)
         task_manager.add_task(task3)
         task_manager.add_task(task4)
-        self.assertEqual(task_manager.fanout, 85)
+        self.assertEqual(task_manager.tasks_count, 4)
         task_manager.remove_task(task2)
-        self.assertEqual(task_manager.fanout, 85)
+        self.assertFalse(task_manager._is_running_task(task2))
         task_manager.remove_task(task3)
-        self.assertEqual(task_manager.fanout, 148)
         task_manager.remove_task(task4)
-        self.assertEqual(task_manager.fanout, 260)
         task_manager.remove_task(task1)
-        self.assertFalse(task_manager.fanout)
+        self.assertFalse(task_manager.running_tasks)
         self.assertEqual(task_manager.tasks_count, 0)
         self.assertEqual(task_manager.tasks_done_count, 4)
 
@@ -548,6 +610,9 @@ class ActionManagerTest(TestCase):
         task_manager.add_task(task3)
         self.assertTrue(task_manager.running_tasks)
         self.assertEqual(len(task_manager.running_tasks), 3)
+        # This is a copy
+        task_manager.running_tasks.clear()
+        self.assertEqual(task_manager.tasks_count, 3)
 
     def test_perform_action(self):
         """test perform an action without any delay"""
@@ -594,6 +659,230 @@ class ActionManagerTest(TestCase):
         self.assertEqual(task_manager.tasks_done_count, 1)
         self.assert_near(0.3, 0.1, action.duration)
 
+    def test_perform_action_own_fanout(self):
+        """Test a small fanout only limits its own action"""
+        action1 = Action('start', command='sleep 0.3', target='node[1-4]')
+        action1.remote = False
+        action1.fanout = 2
+        svc1 = Service('Slow')
+        svc1.add_action(action1)
+        action2 = Action('start', command='sleep 0.3', target='node[5-8]')
+        action2.remote = False
+        svc2 = Service('Fast')
+        svc2.add_action(action2)
+        svc1.prepare('start')
+        svc2.run('start')
+        self.assert_near(0.6, 0.15, action1.duration)
+        self.assert_near(0.3, 0.15, action2.duration)
+
+    def test_perform_action_global_fanout(self):
+        """Test actions with their own fanout share the global one"""
+        action_manager_self().default_fanout = 2
+        action1 = Action('start', command='sleep 0.3', target='node[1-2]')
+        action1.remote = False
+        action1.fanout = 1
+        svc1 = Service('Slow')
+        svc1.add_action(action1)
+        action2 = Action('start', command='sleep 0.3', target='node[3-4]')
+        action2.remote = False
+        svc2 = Service('Fast')
+        svc2.add_action(action2)
+        svc1.prepare('start')
+        svc2.run('start')
+        # Only one global slot was left for action2
+        self.assert_near(0.6, 0.15, action1.duration)
+        self.assert_near(0.6, 0.15, action2.duration)
+        self.assertEqual(action_manager_self()._slots_used, 0)
+
+    def test_held_priority(self):
+        """Test waiting actions start by priority, not by arrival"""
+        action_manager_self().default_fanout = 1
+        first = Action('start', command='sleep 0.3')
+        svc1 = Service('First')
+        svc1.add_action(first)
+        low = Action('start', command='sleep 0.1', delay=0.1)
+        svc2 = Service('Low')
+        svc2.add_action(low)
+        high = Action('start', command='sleep 0.1', delay=0.2)
+        high.cost = 10
+        svc3 = Service('High')
+        svc3.add_action(high)
+        svc1.prepare('start')
+        svc2.prepare('start')
+        svc3.run('start')
+        self.assertTrue(first.stop_time <= high.stop_time < low.stop_time)
+
+    def test_fusion(self):
+        """Test ready actions with the same target run as one command"""
+        action_manager_self().fusion = True
+        action1 = Action('stop', command='echo one %h; sleep 0.2',
+                         target='node[1-2]')
+        action1.remote = False
+        svc1 = Service('First')
+        svc1.add_action(action1)
+        action2 = Action('stop', command='printf two; [ %h = node1 ]',
+                         target='node[1-2]')
+        action2.remote = False
+        svc2 = Service('Second')
+        svc2.add_action(action2)
+        action3 = Action('stop', command='echo three', target='node3')
+        action3.remote = False
+        svc3 = Service('Third')
+        svc3.add_action(action3)
+        action4 = Action('stop', command='echo four', target='node[1-2]',
+                         timeout=5)
+        action4.remote = False
+        svc4 = Service('Fourth')
+        svc4.add_action(action4)
+        svc1.prepare('stop')
+        svc2.prepare('stop')
+        svc3.prepare('stop')
+        svc4.run('stop')
+
+        self.assertTrue(isinstance(action1.worker, BackendWorker))
+        self.assertTrue(isinstance(action2.worker, BackendWorker))
+        self.assertFalse(isinstance(action3.worker, BackendWorker))
+        self.assertEqual(action1.status, DONE)
+        self.assertEqual(dict((bytes(buf), str(nodes)) for buf, nodes in
+                              action1.worker.iter_buffers()),
+                         {b'one node1': 'node1', b'one node2': 'node2'})
+        self.assertEqual(action2.status, ERROR)
+        self.assertEqual(action2.nodes_error(), NodeSet('node2'))
+        self.assertEqual([(bytes(buf), str(nodes)) for buf, nodes in
+                          action2.worker.iter_buffers()],
+                         [(b'two', 'node[1-2]')])
+        self.assertEqual(action3.status, DONE)
+        # Actions with a timeout run alone
+        self.assertFalse(isinstance(action4.worker, BackendWorker))
+        self.assertEqual(action4.status, DONE)
+        # Each action is timed by its own command
+        self.assertEqual(sorted(action2.node_times), ['node1', 'node2'])
+        first = action1.node_times['node1']
+        second = action2.node_times['node1']
+        self.assertTrue(first[1] - first[0] >= 0.15)
+        self.assertTrue(second[1] - second[0] < 0.15)
+        self.assertTrue(abs(second[0] - first[1]) < 0.05)
+        self.assertTrue(action2.duration < 0.15)
+
+    def test_coalesce(self):
+        """Test identical commands run once on all their nodes"""
+        action_manager_self().coalesce = True
+        tmpdir = tempfile.mkdtemp(prefix='test-mlk-')
+        try:
+            log = os.path.join(tmpdir, 'log')
+            command = 'echo %%h | tee -a %s; [ %%h != node2 ]' % log
+            actions = []
+            for name, target in (('First', 'node[1-2]'),
+                                 ('Second', 'node[2-3]'),
+                                 ('Local', None), ('Other', None)):
+                action = Action('status', command=command, target=target)
+                if target is None:
+                    action.command = 'echo local >> %s' % log
+                action.remote = False
+                svc = Service(name)
+                svc.add_action(action)
+                svc.prepare('status')
+                actions.append(action)
+            action_manager_self().run()
+
+            first, second, local, other = actions
+            self.assertEqual(first.status, ERROR)
+            self.assertEqual(first.nodes_error(), NodeSet('node2'))
+            self.assertEqual(dict((bytes(buf), str(nodes)) for buf, nodes in
+                                  first.worker.iter_buffers()),
+                             {b'node1': 'node1', b'node2': 'node2'})
+            self.assertEqual(second.nodes_error(), NodeSet('node2'))
+            self.assertEqual(sorted(second.node_times), ['node2', 'node3'])
+            self.assertEqual(local.status, DONE)
+            self.assertEqual(other.status, DONE)
+            with open(log) as output:
+                self.assertEqual(sorted(output.read().split()),
+                                 ['local', 'node1', 'node2', 'node3'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_rolling(self):
+        """Test rolling actions run in waves, stopped by too many failures"""
+        svc = Service('Canary')
+        svc.fromdict({'target': 'node[1-10]', 'remote': False,
+                      'actions': {'start': {
+                          'cmd': '[ %h != node3 ]',
+                          'rolling': {'batch': 3, 'canary': 1}}}})
+        svc.run('start')
+        action = svc._actions['start']
+        self.assertEqual(action.status, ERROR)
+        self.assertEqual(action.aborted_nodes, NodeSet('node[5-10]'))
+        self.assertEqual(action.nodes_error(), NodeSet('node3'))
+        self.assertEqual(sorted(action.node_times),
+                         ['node1', 'node2', 'node3', 'node4'])
+        self.assertTrue(action.node_times['node2'][0] >=
+                        action.node_times['node1'][1])
+        self.assertEqual(svc.failed_nodes, NodeSet('node3,node[5-10]'))
+
+        svc = Service('Budget')
+        svc.fromdict({'target': 'node[1-10]', 'remote': False,
+                      'errors': 1,
+                      'actions': {'start': {
+                          'cmd': '[ %h != node3 ]',
+                          'rolling': {'batch': '50%', 'max_failures': 1}}}})
+        svc.run('start')
+        action = svc._actions['start']
+        self.assertEqual(action.status, WARNING)
+        self.assertEqual(action.aborted_nodes, NodeSet())
+        self.assertEqual(len(action.node_times), 10)
+        self.assertTrue(min(action.node_times[node][0]
+                            for node in NodeSet('node[6-10]')) >=
+                        max(action.node_times[node][1]
+                            for node in NodeSet('node[1-5]')))
+
+    def test_rolling_invalid(self):
+        """Test invalid rolling properties are rejected"""
+        for rolling in ({'canary': 1}, {'batch': 'x%'}, {'batch': 0},
+                        {'batch': 2, 'max_failures': -1},
+                        {'batch': 2, 'size': 3}, 'batch'):
+            action = Action('start')
+            self.assertRaises(InvalidPropertyError, action.fromdict,
+                              {'rolling': rolling})
+
+    def test_early_abort(self):
+        """Test an action which fails anyway is aborted and ERROR at once"""
+        action_manager_self().early_abort = True
+        svc = Service('Early')
+        svc.fromdict({'target': 'node[1-4]', 'remote': False, 'fanout': 2,
+                      'actions': {'start': {
+                          'cmd': 'case %h in node1) exit 1;; *) sleep 5;; esac'}}})
+        child = Service('Child')
+        child.fromdict({'actions': {'start': {'cmd': '/bin/true'}}})
+        child.add_dep(svc)
+        child.run('start')
+        action = svc._actions['start']
+        self.assertEqual(action.status, ERROR)
+        self.assertEqual(action.nodes_error(), NodeSet('node1'))
+        self.assertEqual(action.aborted_nodes, NodeSet('node[2-4]'))
+        self.assertTrue(action.duration < 2)
+        self.assertEqual(child.status, DEP_ERROR)
+
+        # Actions which could still succeed, or be retried, are not aborted
+        svc = Service('Tolerant')
+        svc.fromdict({'target': 'node[1-2]', 'remote': False, 'errors': 1,
+                      'actions': {'start': {
+                          'cmd': 'case %h in node1) exit 1;; *) sleep 0.3;; esac'}}})
+        svc.run('start')
+        action = svc._actions['start']
+        self.assertEqual(action.status, WARNING)
+        self.assertEqual(action.aborted_nodes, NodeSet())
+
+        svc = Service('Retried')
+        svc.fromdict({'target': 'node[1-2]', 'remote': False,
+                      'retry': 1,
+                      'actions': {'start': {
+                          'cmd': 'case %h in node1) exit 1;; *) sleep 0.3;; esac'}}})
+        svc.run('start')
+        action = svc._actions['start']
+        self.assertEqual(action.status, ERROR)
+        self.assertEqual(action.tries, 2)
+        self.assertEqual(action.aborted_nodes, NodeSet())
+
     def test_perform_remote_false_action(self):
         """Test perform an action in remote mode=False"""
 
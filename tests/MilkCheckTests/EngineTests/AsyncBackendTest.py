@@ -0,0 +1,117 @@
+#
+# Copyright CEA (2026)
+#
+
+"""Tests for the asyncio execution backend, which needs Python 3"""
+
+import socket
+import threading
+from unittest import TestCase, skipIf
+
+from ClusterShell.NodeSet import NodeSet
+
+from MilkCheck.Engine.Action import ActionManager, action_manager_self
+from MilkCheck.Engine.Service import Service
+from MilkCheck.Engine.BaseEntity import DONE, WARNING, ERROR
+
+try:
+    from MilkCheck.Engine.AsyncBackend import AsyncioBackend, tcp_check
+except (ImportError, SyntaxError):
+    AsyncioBackend = None
+
+@skipIf(AsyncioBackend is None, "asyncio is not available")
+class AsyncioBackendTest(TestCase):
+    """Tests for AsyncioBackend"""
+
+    def setUp(self):
+        ActionManager._instance = None
+        self.manager = action_manager_self()
+        self.backend = AsyncioBackend(self.manager)
+        self.manager.backend = self.backend
+
+    def tearDown(self):
+        ActionManager._instance = None
+        self.backend.loop.close()
+
+    def test_commands(self):
+        """Test processes, timeouts and dependencies run as tasks"""
+        first = Service('first')
+        first.fromdict({
+            'target': 'n[1-3]',
+            'remote': False,
+            'errors': 2,
+            'delay': 0.1,
+            'actions': {'start': {
+                'timeout': 0.5,
+                'cmd': 'echo %h; case %h in n2) exit 2;; n3) sleep 5;; esac'}}})
+        second = Service('second')
+        second.fromdict({'actions': {'start': {'cmd': 'echo done'}}})
+        second.add_dep(first)
+        second.run('start')
+
+        action = first._actions['start']
+        self.assertEqual(action.status, WARNING)
+        self.assertEqual(action.nodes_error(), NodeSet('n2'))
+        self.assertEqual(action.nodes_timeout(), NodeSet('n3'))
+        self.assertTrue(0.5 <= action.duration < 2)
+        self.assertEqual(second.status, DONE)
+        self.assertEqual([(bytes(buf), str(nodes)) for buf, nodes in
+                          second._actions['start'].worker.iter_buffers()],
+                         [(b'done', 'localhost')])
+
+    def test_tcp_checks(self):
+        """Test many TCP probes run concurrently without processes"""
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(128)
+        port = sock.getsockname()[1]
+
+        def accept():
+            '''Accept all connections'''
+            try:
+                while True:
+                    sock.accept()[0].close()
+            except OSError:
+                pass
+        thread = threading.Thread(target=accept)
+        thread.start()
+        try:
+            svc = Service('svc')
+            svc.fromdict({'target': 'node[1-2000]',
+                          'actions': {'start': {'cmd': '@tcp %d' % port}}})
+            # All nodes resolve to the local host
+            self.backend.checks['tcp'] = \
+                lambda node, args: tcp_check('127.0.0.1', args)
+            svc.run('start')
+        finally:
+            sock.shutdown(socket.SHUT_RDWR)
+            sock.close()
+            thread.join()
+        action = svc._actions['start']
+        self.assertEqual(action.status, DONE)
+        self.assertEqual(len(action.worker._retcodes), 2000)
+
+        svc = Service('closed')
+        svc.fromdict({'actions': {'start': {'cmd': '@tcp %d' % port}}})
+        svc.run('start')
+        self.assertEqual(svc._actions['start'].status, ERROR)
+
+        svc = Service('unknown')
+        svc.fromdict({'actions': {'start': {'cmd': '@foo'}}})
+        svc.run('start')
+        self.assertEqual(svc._actions['start'].nodes_error(),
+                         NodeSet('localhost'))
+
+    def test_early_abort(self):
+        """Test the tasks of an aborted worker are cancelled"""
+        self.manager.early_abort = True
+        svc = Service('svc')
+        svc.fromdict({'target': 'n[1-3]', 'remote': False,
+                      'actions': {'start': {
+                          'cmd': 'case %h in n1) exit 1;; *) sleep 5;; esac'}}})
+        svc.run('start')
+        action = svc._actions['start']
+        self.assertEqual(action.status, ERROR)
+        self.assertEqual(action.aborted_nodes, NodeSet('n[2-3]'))
+        self.assertEqual(action.nodes_error(), NodeSet('n1'))
+        self.assertTrue(action.duration < 2)
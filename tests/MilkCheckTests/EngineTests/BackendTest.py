@@ -0,0 +1,206 @@
+#
+# Copyright CEA (2026)
+#
+
+"""Tests for the execution backends"""
+
+import os
+import stat
+from unittest import TestCase
+
+from ClusterShell.NodeSet import NodeSet
+
+from MilkCheck.Engine.Action import ActionManager, action_manager_self
+from MilkCheck.Engine.Backend import LocalBackend, ClusterShellBackend
+from MilkCheck.Engine.Backend import BackendWorker, command_args
+from MilkCheck.Engine.ConnectionPool import ConnectionPool
+from MilkCheck.Engine.Service import Service
+from MilkCheck.Engine.BaseEntity import DONE, WARNING, ERROR, TIMEOUT
+
+class LocalBackendTest(TestCase):
+    """Tests for LocalBackend"""
+
+    def setUp(self):
+        ActionManager._instance = None
+        self.manager = action_manager_self()
+        self.manager.backend = LocalBackend(self.manager)
+
+    def tearDown(self):
+        ActionManager._instance = None
+
+    def test_default_backend(self):
+        """Test ClusterShell is the default backend"""
+        ActionManager._instance = None
+        self.assertTrue(isinstance(action_manager_self().backend,
+                                   ClusterShellBackend))
+
+    def test_local_command(self):
+        """Test a command without target runs as localhost"""
+        svc = Service('svc')
+        svc.fromdict({'actions': {'start': {'cmd': 'echo foo; exit 3'}}})
+        svc.run('start')
+        action = svc._actions['start']
+        self.assertEqual(action.status, ERROR)
+        self.assertEqual(action.nodes_error(), NodeSet('localhost'))
+        self.assertEqual([(bytes(buf), str(nodes)) for buf, nodes in
+                          self.manager.backend.iter_buffers(action.worker)],
+                         [(b'foo', 'localhost')])
+
+    def test_nodes(self):
+        """Test per-node commands, retcodes and timeouts"""
+        svc = Service('svc')
+        svc.fromdict({
+            'target': 'n[1-4]',
+            'remote': False,
+            'fanout': 2,
+            'errors': 2,
+            'actions': {'start': {
+                'timeout': 0.5,
+                'cmd': 'echo %h; case %h in n2) exit 2;; n3) sleep 5;; esac'}}})
+        svc.run('start')
+        action = svc._actions['start']
+        self.assertEqual(action.status, WARNING)
+        self.assertEqual(action.nodes_error(), NodeSet('n2'))
+        self.assertEqual(action.nodes_timeout(), NodeSet('n3'))
+        self.assertTrue(action.duration < 2)
+        self.assertEqual(dict((bytes(buf), str(nodes)) for buf, nodes in
+                              action.worker.iter_buffers()),
+                         {b'n1': 'n1', b'n2': 'n2', b'n3': 'n3',
+                          b'n4': 'n4'})
+        # n3 and n4 waited for a slot
+        self.assertEqual(self.manager.backend.waits['svc.start'][:2], [2, 2])
+
+    def test_delay(self):
+        """Test delayed actions and dependencies"""
+        first = Service('first')
+        first.fromdict({'delay': 0.2,
+                        'actions': {'start': {'cmd': '/bin/true'}}})
+        second = Service('second')
+        second.fromdict({'actions': {'start': {'cmd': '/bin/true'}}})
+        second.add_dep(first)
+        second.run('start')
+        self.assertEqual(second.status, DONE)
+        self.assertTrue(first._actions['start'].duration >= 0.2)
+        self.assertTrue(second._actions['start'].start_time >=
+                        first._actions['start'].stop_time)
+
+    def test_timeout_status(self):
+        """Test an action timing out on all its nodes"""
+        svc = Service('svc')
+        svc.fromdict({'actions': {'start': {'cmd': 'sleep 5',
+                                            'timeout': 0.2}}})
+        svc.run('start')
+        self.assertEqual(svc._actions['start'].status, TIMEOUT)
+
+    def test_fusion_timeout(self):
+        """Test actions with a timeout are not fused, each one times out"""
+        self.manager.fusion = True
+        services = []
+        for name, cmd in (('fast', 'echo %h'), ('slow', 'sleep 5')):
+            svc = Service(name)
+            svc.fromdict({'target': 'n[1-2]', 'remote': False,
+                          'actions': {'stop': {'cmd': cmd,
+                                               'timeout': 0.3}}})
+            services.append(svc)
+        services[0].prepare('stop')
+        services[1].run('stop')
+        fast = services[0]._actions['stop']
+        slow = services[1]._actions['stop']
+        self.assertEqual(fast.status, DONE)
+        self.assertEqual(dict((bytes(buf), str(nodes)) for buf, nodes in
+                              fast.worker.iter_buffers()),
+                         {b'n1': 'n1', b'n2': 'n2'})
+        self.assertEqual(slow.status, TIMEOUT)
+        self.assertEqual(slow.nodes_timeout(), NodeSet('n[1-2]'))
+        self.assertNotEqual(fast.worker, slow.worker)
+        # The slow command got its own timeout only
+        self.assertTrue(fast.duration < 0.3)
+        self.assertTrue(0.3 <= slow.duration < 0.6)
+
+    def test_early_abort(self):
+        """Test queued and running nodes of an aborted worker are stopped"""
+        self.manager.early_abort = True
+        first = Service('first')
+        first.fromdict({'target': 'n[1-4]', 'remote': False, 'fanout': 2,
+                        'actions': {'start': {
+                            'cmd': 'case %h in n1) exit 1;; *) sleep 5;; esac'}}})
+        other = Service('other')
+        other.fromdict({'target': 'n[5-6]', 'remote': False,
+                        'actions': {'start': {'cmd': 'sleep 0.3'}}})
+        first.prepare('start')
+        other.run('start')
+        action = first._actions['start']
+        self.assertEqual(action.status, ERROR)
+        self.assertEqual(action.aborted_nodes, NodeSet('n[2-4]'))
+        self.assertEqual(sorted(action.node_times), ['n1', 'n2'])
+        self.assertTrue(action.duration < 2)
+        self.assertEqual(other.status, DONE)
+        self.assertEqual(self.manager.backend._procs, {})
+
+class ConnectionPoolTest(TestCase):
+    """Tests for ConnectionPool"""
+
+    def setUp(self):
+        self.pool = ConnectionPool()
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_start(self):
+        """Test control sockets are kept in a private directory"""
+        options = self.pool.start()
+        directory = self.pool.directory
+        self.assertTrue(os.path.isdir(directory))
+        self.assertEqual(stat.S_IMODE(os.stat(directory).st_mode), 0o700)
+        self.assertTrue('-oControlMaster=auto' in options)
+        self.assertTrue('-oControlPath=%s/%%C' % directory in options)
+        # Started once per run
+        self.assertEqual(self.pool.start(), options)
+        self.assertEqual(self.pool.directory, directory)
+
+    def test_close(self):
+        """Test close() removes the control directory"""
+        self.pool.start()
+        directory = self.pool.directory
+        open(os.path.join(directory, 'stale'), 'w').close()
+        self.assertEqual(self.pool.sockets(),
+                         [os.path.join(directory, 'stale')])
+        self.pool.close()
+        self.assertFalse(os.path.exists(directory))
+        self.assertEqual(self.pool.directory, None)
+        self.assertEqual(self.pool.sockets(), [])
+        # Closing twice is harmless
+        self.pool.close()
+
+    def test_ssh_options(self):
+        """Test remote commands use the pool options"""
+        svc = Service('svc')
+        svc.fromdict({'target': 'n1',
+                      'actions': {'start': {'cmd': 'uname'},
+                                  'status': {'cmd': 'uname',
+                                             'remote': False}}})
+        options = self.pool.start()
+        worker = BackendWorker(svc._actions['start'], 'uname', 'n1', None)
+        args = command_args(worker, 'n1', options)
+        self.assertEqual(args[0], 'ssh')
+        self.assertEqual(args[-len(options) - 3:-3], options)
+        self.assertEqual(args[-3:], ['-oConnectTimeout=10', 'n1', 'uname'])
+        worker = BackendWorker(svc._actions['status'], 'uname', 'n1', None)
+        self.assertEqual(command_args(worker, 'n1', options),
+                         ['/bin/sh', '-c', 'uname'])
+
+    def test_clustershell_ssh_options(self):
+        """Test pool options of a run replace those of the previous one"""
+        backend = ClusterShellBackend()
+        backend.task.set_info('ssh_options', '-F config')
+        try:
+            for _ in range(3):
+                options = self.pool.start()
+                backend.set_ssh_options(options)
+                self.assertEqual(backend.task.info('ssh_options'),
+                                 ' '.join(['-F config'] + options))
+                backend.set_ssh_options([])
+                self.pool.close()
+            self.assertEqual(backend.task.info('ssh_options'), '-F config')
+        finally:
+            backend.task.set_info('ssh_options', '')
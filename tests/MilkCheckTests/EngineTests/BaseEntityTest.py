@@ -5,11 +5,17 @@
 Test cases for the BaseEntity classes.
 """
 
+import os
+import time
+import shutil
+import tempfile
 import unittest
 
 # Classes
 from ClusterShell.NodeSet import NodeSet, NodeSetException
 from MilkCheck.Engine.BaseEntity import BaseEntity, Dependency
+from MilkCheck.Engine.BaseEntity import parse_template
+from MilkCheck.Engine.BaseEntity import CommandCache, command_cache_self
 from MilkCheck.Engine.ServiceGroup import ServiceGroup
 
 # Symbols
@@ -17,6 +23,7 @@ from MilkCheck.Engine.BaseEntity import CHECK, REQUIRE_WEAK, REQUIRE
 from MilkCheck.Engine.BaseEntity import NO_STATUS, DONE, WAITING_STATUS
 from MilkCheck.Engine.BaseEntity import TIMEOUT, DEP_ERROR, ERROR
 from MilkCheck.Engine.BaseEntity import WARNING
+from MilkCheck.Engine.BaseEntity import TPL_LITERAL, TPL_VARIABLE, TPL_COMMAND
 
 # Exceptions
 from MilkCheck.Engine.BaseEntity import IllegalDependencyTypeError
@@ -172,6 +179,30 @@ class BaseEntityTest(unittest.TestCase):
         ent_dep2.status = DONE
         self.assertTrue(ent.is_ready())
 
+    def test_is_ready_counter(self):
+        """Test readiness is updated on status change and dependency changes"""
+        ent = BaseEntity('foo')
+        ent_dep = BaseEntity('parent')
+        ent_dep2 = BaseEntity('parent2')
+        ent.add_dep(ent_dep)
+        ent.add_dep(ent_dep2)
+        self.assertFalse(ent.is_ready())
+        ent_dep.status = DONE
+        self.assertFalse(ent.is_ready())
+        ent.remove_dep('parent2')
+        self.assertTrue(ent.is_ready())
+        ent_dep.status = NO_STATUS
+        self.assertFalse(ent.is_ready())
+        # Reversed direction uses children
+        ent.algo_reversed = True
+        self.assertTrue(ent.is_ready())
+        ent_child = BaseEntity('child')
+        ent_child.add_dep(ent)
+        self.assertFalse(ent.is_ready())
+        ent_child.status = ERROR
+        self.assertTrue(ent.is_ready())
+        self.assertEqual(ent.eval_deps_status(), DEP_ERROR)
+
     def test_clear_deps(self):
         """Test method clear_deps"""
         ent = BaseEntity('foo')
@@ -209,6 +240,16 @@ class BaseEntityTest(unittest.TestCase):
         serv_b.status = WARNING
         self.assertEqual(service.eval_deps_status(), NO_STATUS)
 
+    def test_eval_deps_renamed(self):
+        """eval_deps_status() follows the status of a renamed dependency"""
+        service = BaseEntity("test_service")
+        serv_a = BaseEntity("A")
+        service.add_dep(serv_a)
+        self.assertEqual(service.eval_deps_status(), NO_STATUS)
+        serv_a.name = "B"
+        serv_a.status = DONE
+        self.assertEqual(service.eval_deps_status(), DONE)
+
     def test_eval_deps_waiting(self):
         """Test that eval_deps_status return WAITING_STATUS"""
         service = BaseEntity("test_service")
@@ -275,6 +316,27 @@ class BaseEntityTest(unittest.TestCase):
         self.assertEqual(ent2.errors, 3)
         self.assertEqual(ent2.timeout, 15)
 
+    def test_inheritance_of_deferred_target(self):
+        '''Test a deferred target is resolved once for its inheritors'''
+        resolved = []
+        class CountingEntity(BaseEntity):
+            '''Record the values it resolves'''
+            def _resolve(self, value):
+                resolved.append(value)
+                return BaseEntity._resolve(self, value)
+        ent1 = CountingEntity(name='parent')
+        ent1.add_var('NODES', 'aury[10-16]')
+        ent1.fromdict({'target': '%NODES'})
+        ent2 = BaseEntity(name='child1')
+        ent2.inherits_from(ent1)
+        ent3 = BaseEntity(name='child2')
+        ent3.inherits_from(ent1)
+        self.assertEqual(ent2.target, NodeSet('aury[10-16]'))
+        self.assertEqual(ent3.target, NodeSet('aury[10-16]'))
+        self.assertEqual(ent1.target, NodeSet('aury[10-16]'))
+        self.assertEqual(resolved.count('%NODES'), 1)
+        self.assertFalse(ent2.target is ent3.target)
+
     def test_inheritance_of_non_existing_target(self):
         '''
         Test inheritance between entities with non-existing target/description
@@ -558,6 +620,26 @@ class VariableBaseEntityTest(unittest.TestCase):
         service.add_var('BAR', 'bar')
         self.assertEqual(service._resolve('%FOO%BAR'), 'foobar')
 
+    def test_parse_template(self):
+        '''Test templates are split in cached tokens'''
+        tokens = parse_template('a%%b %{FOO}%BAR %(echo a) ')
+        self.assertEqual(tokens, ((TPL_LITERAL, 'a%b '),
+                                  (TPL_VARIABLE, 'FOO'),
+                                  (TPL_VARIABLE, 'BAR'),
+                                  (TPL_LITERAL, ' '),
+                                  (TPL_COMMAND, 'echo a'),
+                                  (TPL_LITERAL, ' ')))
+        self.assertTrue(parse_template('a%%b %{FOO}%BAR %(echo a) ') is tokens)
+        self.assertEqual(parse_template('%FOO'), ((TPL_VARIABLE, 'FOO'),))
+
+    def test_parse_template_invalid(self):
+        '''Test invalid placeholders report their position'''
+        self.assertRaises(ValueError, parse_template, 'foo\nbar %{baz')
+        with self.assertRaises(ValueError) as ctx:
+            parse_template('foo\nbar %(baz\n)')
+        self.assertEqual(str(ctx.exception),
+                         'Invalid placeholder in string: line 2, col 5')
+
     def test_resolve_escape_char(self):
         '''Test resolution with a variable escaping %'''
         service = BaseEntity('test_service')
@@ -711,3 +793,90 @@ class DependencyTest(unittest.TestCase):
         self.assertEqual(dep_r.graph(ent), '"ENTITY" -> "Base";\n')
         self.assertEqual(dep_rw.graph(ent), 
                             '"ENTITY" -> "Base" [style=dashed];\n')
+
+
+class CommandCacheTest(unittest.TestCase):
+    """Tests cases for command substitution cache"""
+
+    def setUp(self):
+        CommandCache._instance = None
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        CommandCache._instance = None
+        shutil.rmtree(self.tmpdir)
+
+    def test_command_run_once(self):
+        """Identical commands are run only once"""
+        counter = os.path.join(self.tmpdir, 'counter')
+        ent1 = BaseEntity('foo')
+        ent2 = BaseEntity('bar')
+        cmd = '%%(echo x >> %s; echo ok)' % counter
+        self.assertEqual(ent1._resolve(cmd), 'ok')
+        self.assertEqual(ent2._resolve(cmd), 'ok')
+        self.assertEqual(open(counter).read(), 'x\n')
+        # A new run executes it again
+        command_cache_self().clear()
+        self.assertEqual(ent1._resolve(cmd), 'ok')
+        self.assertEqual(open(counter).read(), 'x\nx\n')
+
+    def test_prefetch_parallel(self):
+        """Independent commands are run in parallel by prefetch()"""
+        ent = BaseEntity('foo')
+        ent.add_var('FOO', '%(sleep 0.3; echo foo)')
+        ent.add_var('BAR', '%(sleep 0.3; echo bar)')
+        ent.add_var('BAZ', '%(echo %FOO)')
+        start = time.time()
+        command_cache_self().prefetch(ent.iter_templates())
+        self.assertTrue(time.time() - start < 0.55)
+        start = time.time()
+        ent.resolve_all()
+        self.assertTrue(time.time() - start < 0.1)
+        self.assertEqual(ent.variables['BAZ'], 'foo')
+
+    def test_prefetch_one_template(self):
+        """Commands of the same template are run in the same round"""
+        ent = BaseEntity('foo')
+        ent.add_var('FOO', '%(sleep 0.3; echo a) %(sleep 0.3; echo b) '
+                           '%(sleep 0.3; echo c)')
+        start = time.time()
+        command_cache_self().prefetch(ent.iter_templates())
+        self.assertTrue(time.time() - start < 0.55)
+        ent.resolve_all()
+        self.assertEqual(ent.variables['FOO'], 'a b c')
+
+    def test_prefetch_error(self):
+        """Failing commands raise errors during resolution"""
+        ent = BaseEntity('foo')
+        ent.add_var('FOO', '%(notexist)')
+        command_cache_self().prefetch(ent.iter_templates())
+        self.assertRaises(InvalidVariableError, ent.resolve_all)
+
+    def test_disk_cache(self):
+        """Command outputs matching a pattern are kept on disk"""
+        counter = os.path.join(self.tmpdir, 'counter')
+        cmd = 'echo x >> %s; echo ok' % counter
+        cache = command_cache_self()
+        cache.directory = self.tmpdir
+        cache.ttls = {'echo x*': 60}
+        self.assertEqual(cache.output(cmd), 'ok')
+        # Written once the resolution is done
+        path = os.path.join(self.tmpdir, CommandCache.CACHE_FILE)
+        self.assertFalse(os.path.exists(path))
+        cache.save()
+        self.assertTrue(os.path.exists(path))
+        # Next run, output is read from disk
+        CommandCache._instance = None
+        cache = command_cache_self()
+        cache.directory = self.tmpdir
+        cache.ttls = {'echo x*': 60}
+        self.assertEqual(cache.output(cmd), 'ok')
+        self.assertEqual(open(counter).read(), 'x\n')
+        # Expired entry
+        CommandCache._instance = None
+        cache = command_cache_self()
+        cache.directory = self.tmpdir
+        cache.ttls = {'echo x*': 0.001}
+        time.sleep(0.01)
+        self.assertEqual(cache.output(cmd), 'ok')
+        self.assertEqual(open(counter).read(), 'x\nx\n')
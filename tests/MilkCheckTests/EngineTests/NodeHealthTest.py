@@ -0,0 +1,212 @@
+#
+# Copyright CEA (2026)
+#
+
+"""Tests for the unreachable nodes tracking"""
+
+import os
+import json
+import time
+import shutil
+import socket
+import tempfile
+from unittest import TestCase
+
+from ClusterShell.NodeSet import NodeSet
+
+from MilkCheck.Engine.Action import Action, ActionManager, \
+                                    action_manager_self
+from MilkCheck.Engine.NodeHealth import NodeHealth, node_health_self
+from MilkCheck.Engine.Service import Service
+from MilkCheck.Engine.BaseEntity import ERROR, SKIPPED, DONE
+from MilkCheckTests import setup_sshconfig, cleanup_sshconfig
+
+ERROR_MSG = b'ssh: Could not resolve hostname n1: Name or service not known'
+
+class NodeHealthTest(TestCase):
+    """Tests for NodeHealth"""
+
+    def setUp(self):
+        self.health = NodeHealth()
+        self.tmpdir = tempfile.mkdtemp(prefix='test-mlk-')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_classify(self):
+        """Test only ssh failures of remote actions make nodes unreachable"""
+        remote = Action('start', target='n[1-4]', command='true')
+        local = Action('start', target='n[1-4]', command='true')
+        local.remote = False
+        self.health.update(remote, 'n1', 255,
+                           b'ssh: connect to host n1 port 22: No route to host')
+        self.health.update(remote, 'n2', 1)
+        self.health.update(local, 'n3', 255,
+                           b'ssh: connect to host n3 port 22: No route to host')
+        # The command itself exited with 255
+        self.health.update(remote, 'n4', 255, b'failed')
+        self.assertEqual(self.health.unreachable, NodeSet('n1'))
+        self.assertEqual(self.health.reachable, NodeSet('n[2,4]'))
+        self.assertEqual(self.health.prune(remote, NodeSet('n[1-3]')),
+                         NodeSet('n[2-3]'))
+        # Local commands could be needed to repair unreachable nodes
+        self.assertEqual(self.health.prune(local, NodeSet('n[1-3]')),
+                         NodeSet('n[1-3]'))
+        self.assertEqual(self.health.prune(remote, None), None)
+        self.health.clear()
+        self.assertEqual(self.health.unreachable, NodeSet())
+
+    def test_cache(self):
+        """Test unreachable nodes are skipped by the next runs until expired"""
+        remote = Action('start', target='n[1-3]', command='true')
+        # Disabled without ttl
+        self.health.directory = self.tmpdir
+        self.health.update(remote, 'n1', 255, ERROR_MSG)
+        self.health.save()
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+        path = os.path.join(self.tmpdir, NodeHealth.HEALTH_FILE)
+        with open(path, 'w') as cache:
+            json.dump({'n2': time.time() - 10, 'n3': time.time() - 100},
+                      cache)
+        self.health.ttl = 60
+        self.health.clear()
+        self.assertEqual(self.health.unreachable, NodeSet('n2'))
+        self.health.update(remote, 'n1', 255, ERROR_MSG)
+        self.health.save()
+
+        other = NodeHealth()
+        other.directory = self.tmpdir
+        other.ttl = 60
+        other.clear()
+        self.assertEqual(other.unreachable, NodeSet('n[1-2]'))
+        # Nodes which answered are removed
+        other.reachable.add('n1')
+        other.save()
+        with open(path) as cache:
+            self.assertEqual(sorted(json.load(cache)), ['n2'])
+
+    def test_probe(self):
+        """Test nodes which do not answer on the probed port"""
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(8)
+        try:
+            port = sock.getsockname()[1]
+            dead = self.health.probe('127.0.0.1,badnode.invalid', 1, port)
+        finally:
+            sock.close()
+        self.assertEqual(dead, NodeSet('badnode.invalid'))
+        self.assertEqual(self.health.unreachable, NodeSet('badnode.invalid'))
+        self.assertEqual(self.health.reachable, NodeSet('127.0.0.1'))
+        # Known unreachable nodes are not probed again
+        self.assertEqual(self.health.probe('badnode.invalid', 1, port),
+                         NodeSet())
+
+    def test_probe_many(self):
+        """Test nodes are probed by batches of sockets, on self.port"""
+        sock = socket.socket()
+        sock.bind(('', 0))
+        sock.listen(64)
+        self.health.PROBE_SOCKETS = 4
+        try:
+            self.health.port = sock.getsockname()[1]
+            nodes = NodeSet('127.0.0.[1-10],bad[1-10].invalid')
+            start = time.time()
+            dead = self.health.probe(nodes, 1)
+        finally:
+            sock.close()
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual(dead, NodeSet('bad[1-10].invalid'))
+        self.assertEqual(self.health.reachable, NodeSet('127.0.0.[1-10]'))
+
+class UnreachableRunTest(TestCase):
+    """Tests for unreachable nodes during a run"""
+
+    def setUp(self):
+        ActionManager._instance = None
+        self.ssh_cfg = setup_sshconfig()
+
+    def tearDown(self):
+        ActionManager._instance = None
+        NodeHealth._instance = None
+        cleanup_sshconfig(self.ssh_cfg)
+
+    def test_pruned(self):
+        """Test unreachable nodes are not tried again in the run"""
+        svc1 = Service('first')
+        svc1.fromdict({'target': 'badnode.invalid', 'maxretry': 2,
+                       'actions': {'start': {'cmd': 'true'}}})
+        svc1.run('start')
+        action = svc1._actions['start']
+        self.assertEqual(action.status, ERROR)
+        self.assertEqual(action.tries, 1)
+        self.assertEqual(node_health_self().unreachable,
+                         NodeSet('badnode.invalid'))
+
+        svc2 = Service('second')
+        svc2.fromdict({'target': 'badnode.invalid',
+                       'actions': {'start': {'cmd': 'true'}}})
+        svc2.run('start')
+        self.assertEqual(svc2.status, SKIPPED)
+
+        # Local commands still run on them
+        svc3 = Service('third')
+        svc3.fromdict({'target': 'badnode.invalid', 'remote': False,
+                       'actions': {'start': {'cmd': 'echo %h'}}})
+        svc3.run('start')
+        self.assertEqual(svc3.status, DONE)
+
+    def test_timed_out(self):
+        """Test nodes which timed out are unreachable if the probe fails"""
+        action = Action('start', target='n1', command='true')
+        backend = action_manager_self().backend
+        node_health_self().timeout = 1
+        node_health_self().timed_out(action, NodeSet('badnode.invalid'),
+                                     backend.timer)
+        # The probe runs from the event loop
+        self.assertEqual(node_health_self().unreachable, NodeSet())
+        backend.run()
+        self.assertEqual(node_health_self().unreachable,
+                         NodeSet('badnode.invalid'))
+        local = Action('start', target='n1', command='true')
+        local.remote = False
+        node_health_self().timed_out(local, NodeSet('otherbadnode.invalid'),
+                                     backend.timer)
+        backend.run()
+        self.assertEqual(node_health_self().unreachable,
+                         NodeSet('badnode.invalid'))
+
+    def test_timed_out_loop(self):
+        """Test the probe of nodes which timed out does not block the run"""
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(0)
+        # Fill the backlog: the next connections hang
+        clients = []
+        try:
+            for _ in range(8):
+                client = socket.socket()
+                client.setblocking(False)
+                client.connect_ex(sock.getsockname())
+                clients.append(client)
+            node_health_self().port = sock.getsockname()[1]
+            node_health_self().timeout = 1
+            action = Action('start', target='127.0.0.1', command='true')
+            svc = Service('other')
+            svc.fromdict({'actions': {'start': {'cmd': 'sleep 0.2'}}})
+            backend = action_manager_self().backend
+            start = time.time()
+            node_health_self().timed_out(action, NodeSet('127.0.0.1'),
+                                         backend.timer)
+            self.assertTrue(time.time() - start < 0.5)
+            svc.run('start')
+            # The other action ran while the probe was pending
+            other = svc._actions['start']
+            self.assertTrue(other.stop_time - start < 0.8)
+            self.assertEqual(node_health_self().unreachable,
+                             NodeSet('127.0.0.1'))
+        finally:
+            for client in clients:
+                client.close()
+            sock.close()
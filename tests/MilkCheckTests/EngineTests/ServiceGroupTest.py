@@ -156,6 +156,27 @@ class ServiceGroupTest(TestCase):
         self.assertTrue(group2.search('GROUP1.I1'))
         self.assertTrue(group2.search('GROUP1.I2'))
 
+    def test_lookup_index(self):
+        """Test entities are indexed by their name relative to the group"""
+        group = ServiceGroup('group', root=True)
+        group1 = ServiceGroup('GROUP1')
+        ser1 = Service('I1')
+        group1.add_inter_dep(target=ser1)
+        group.add_inter_dep(target=group1)
+        group2 = ServiceGroup('GROUP2')
+        group.add_inter_dep(target=group2)
+        ser2 = Service('I2')
+        group2.add_inter_dep(target=ser2)
+        self.assertTrue(group.lookup('GROUP1') is group1)
+        self.assertTrue(group.lookup('GROUP1.I1') is ser1)
+        self.assertTrue(group.lookup('GROUP2.I2') is ser2)
+        self.assertTrue(group2.lookup('I2') is ser2)
+        self.assertEqual(group.lookup('I1'), None)
+        self.assertTrue(ser2.search('GROUP1.I1') is ser1)
+        group.remove_inter_dep('GROUP2')
+        self.assertEqual(group.lookup('GROUP2.I2'), None)
+        self.assertEqual(group.lookup('GROUP2'), None)
+
     def test_add_dep_service_group(self):
         '''Test ability to add dependencies to a ServiceGroup'''
         ser_group = ServiceGroup('GROUP')
@@ -5,10 +5,13 @@
 """
 This modules defines the tests cases targeting the Action and Service objects.
 """
+import os
+import shutil
+import tempfile
 from unittest import TestCase
 
 # Classes
-from MilkCheck.Engine.Action import Action
+from MilkCheck.Engine.Action import Action, action_manager_self
 from MilkCheck.Engine.Service import Service
 from ClusterShell.NodeSet import NodeSet
 
@@ -1052,3 +1055,61 @@ class ServiceFromDictTest(TestCase):
         srv.resolve_all()
         self.assertEqual(srv.desc, "I am a service")
         self.assertEqual(srv._actions['start'].command, "service foo start")
+
+    def test_critical_path(self):
+        """Test actions at the head of the longest chain start first"""
+        tmpdir = tempfile.mkdtemp()
+        fanout = action_manager_self().default_fanout
+        try:
+            log = os.path.join(tmpdir, 'log')
+            services = {}
+            for name, cost in (('short', 1), ('head', 1), ('tail', 10),
+                               ('last', 1)):
+                services[name] = Service(name)
+                services[name].fromdict({
+                    'cost': cost,
+                    'actions': {'start': {'cmd': 'echo %s >> %s' % (name, log)}}})
+            services['tail'].add_dep(services['head'])
+            services['last'].add_dep(services['short'])
+            services['last'].add_dep(services['tail'])
+            # Only one action at a time
+            action_manager_self().default_fanout = 1
+            services['last'].run('start')
+            self.assertEqual(services['head'].priority(), 12)
+            self.assertEqual(services['short'].priority(), 2)
+            # short waits for tail, which became ready later
+            self.assertEqual(open(log).read().splitlines(),
+                             ['head', 'tail', 'short', 'last'])
+        finally:
+            action_manager_self().default_fanout = fanout
+            shutil.rmtree(tmpdir)
+
+    def test_pipeline(self):
+        """Test a pipelined service starts on nodes done by its parents"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            log = os.path.join(tmpdir, 'log')
+            parent = Service('parent')
+            parent.fromdict({
+                'target': 'n[1-3]',
+                'remote': False,
+                'actions': {'start': {
+                    'cmd': 'case %%h in n2) sleep 0.5;; n3) exit 1;; esac;'
+                           'echo parent %%h >> %s' % log}}})
+            child = Service('child')
+            child.fromdict({
+                'target': 'n[1-3]',
+                'remote': False,
+                'pipeline': True,
+                'actions': {'start': {'cmd': 'echo child %%h >> %s' % log}}})
+            child.add_dep(parent, sgth=FILTER)
+            child.run('start')
+            self.assertEqual(parent.status, ERROR)
+            self.assertEqual(child.status, DONE)
+            # child started on n1 before parent was done on n2
+            self.assertEqual(open(log).read().splitlines(),
+                             ['parent n1', 'child n1', 'parent n2', 'child n2'])
+            self.assertEqual(child._actions['start'].target, NodeSet('n[1-2]'))
+            self.assertEqual(child._actions['start'].nodes_error(), NodeSet())
+        finally:
+            shutil.rmtree(tmpdir)
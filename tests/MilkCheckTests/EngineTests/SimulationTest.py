@@ -0,0 +1,164 @@
+#
+# Copyright CEA (2026)
+#
+
+"""Tests for the in-process Simulator"""
+
+from unittest import TestCase
+
+from ClusterShell.NodeSet import NodeSet
+
+from MilkCheck.Engine.Action import ActionManager, action_manager_self
+from MilkCheck.History import DurationHistory
+from MilkCheck.Engine.Service import Service
+from MilkCheck.Engine.ServiceGroup import ServiceGroup
+from MilkCheck.Engine.Simulation import Simulator
+from MilkCheck.Engine.BaseEntity import DONE, ERROR, TIMEOUT
+
+class SimulatorTest(TestCase):
+    """Tests for Simulator"""
+
+    def setUp(self):
+        ActionManager._instance = None
+        # Durations recorded by other tests change priorities
+        DurationHistory._instance = None
+        self.manager = action_manager_self()
+        self.manager.backend = Simulator(self.manager)
+
+    def tearDown(self):
+        ActionManager._instance = None
+
+    def _waves(self):
+        """Return the simulated waves as strings"""
+        return [(clock, [(action, str(nodes)) for action, nodes in actions])
+                for clock, actions in self.manager.backend.iter_waves()]
+
+    def test_waves(self):
+        """Test nothing runs and waves follow dependencies and fanouts"""
+        first = Service('first')
+        first.fromdict({'target': 'badnode[1-5]', 'fanout': 2,
+                        'actions': {'start': {'cmd': '/bin/false'}}})
+        second = Service('second')
+        second.fromdict({'target': 'badnode[1-3]',
+                         'actions': {'start': {'cmd': '/bin/false'}}})
+        local = Service('local')
+        local.fromdict({'actions': {'start': {'cmd': '/bin/false'}}})
+        second.add_dep(first)
+        second.add_dep(local)
+        second.run('start')
+
+        self.assertEqual(first.status, DONE)
+        self.assertEqual(second.status, DONE)
+        self.assertEqual(self._waves(), [
+            (0, [('first.start', 'badnode[1-2]'),
+                 ('local.start', 'localhost')]),
+            (1, [('first.start', 'badnode[3-4]')]),
+            (2, [('first.start', 'badnode5')]),
+            (3, [('second.start', 'badnode[1-3]')])])
+        # Durations are virtual
+        self.assertEqual(first._actions['start'].duration, 3)
+
+    def test_delay_and_timeout(self):
+        """Test delays and modelled durations use the virtual clock"""
+        self.manager.backend.model = True
+        svc = Service('svc')
+        svc.fromdict({'target': 'badnode1', 'delay': 60,
+                      'actions': {'start': {'cmd': ':', 'cost': 600,
+                                            'timeout': 300}}})
+        svc.run('start')
+        action = svc._actions['start']
+        self.assertEqual(action.status, TIMEOUT)
+        self.assertEqual(action.nodes_timeout(), NodeSet('badnode1'))
+        self.assertEqual(self._waves(), [(60, [('svc.start', 'badnode1')])])
+        self.assertEqual(action.duration, 360)
+
+    def test_failures(self):
+        """Test commands matching a failure rule fail, the others succeed"""
+        self.manager.backend = Simulator(self.manager, failures=[
+            (NodeSet('badnode2'), '*.start'), (None, 'local.start')])
+        first = Service('first')
+        first.fromdict({'target': 'badnode[1-3]',
+                        'actions': {'start': {'cmd': ':'}}})
+        local = Service('local')
+        local.fromdict({'actions': {'start': {'cmd': ':'}}})
+        second = Service('second')
+        second.fromdict({'target': 'badnode[1-3]',
+                         'actions': {'stop': {'cmd': ':'}}})
+        first.prepare('start')
+        local.prepare('start')
+        second.run('stop')
+        action = first._actions['start']
+        self.assertEqual(action.status, ERROR)
+        self.assertEqual(action.nodes_error(), NodeSet('badnode2'))
+        self.assertEqual(local.status, ERROR)
+        self.assertEqual(second.status, DONE)
+
+    def test_estimate(self):
+        """Test critical path and binding fanouts of a modelled run"""
+        self.manager.backend = Simulator(self.manager, model=True,
+                                           durations={'long.start': 100})
+        self.manager.default_fanout = 4
+        short = Service('short')
+        short.fromdict({'target': 'badnode[1-8]',
+                        'actions': {'start': {'cmd': ':', 'cost': 10}}})
+        long = Service('long')
+        long.fromdict({'target': 'badnode1', 'fanout': 1,
+                       'actions': {'start': {'cmd': ':'}}})
+        last = Service('last')
+        last.fromdict({'target': 'badnode1',
+                       'actions': {'start': {'cmd': ':', 'cost': 5}}})
+        last.add_dep(short)
+        last.add_dep(long)
+        last.run('start')
+
+        # short.start goes first and uses the 4 global slots until it ends:
+        # long.start waited for the global fanout, not for a dependency
+        simulator = self.manager.backend
+        self.assertEqual(simulator.elapsed(), 125)
+        self.assertEqual([(act.fullname(), start, stop)
+                          for act, start, stop in simulator.critical_path()],
+                         [('long.start', 20, 120), ('last.start', 120, 125)])
+        self.assertEqual(simulator.binding_fanouts(), [(None, 4, 5, 20)])
+
+    def test_critical_path_dependencies(self):
+        """Test the critical path follows the dependency ended last"""
+        self.manager.backend.model = True
+        services = {}
+        for name, cost in (('A', 5), ('D', 5), ('C', 1)):
+            services[name] = Service(name)
+            services[name].fromdict({
+                'actions': {'start': {'cmd': ':', 'cost': cost}}})
+        services['C'].add_dep(services['A'])
+        root = Service('root')
+        root.fromdict({'actions': {'start': {'cmd': ':', 'cost': 1}}})
+        root.add_dep(services['C'])
+        root.add_dep(services['D'])
+        root.run('start')
+
+        # D ended at the same time as A, after C started
+        simulator = self.manager.backend
+        self.assertEqual([(act.fullname(), start, stop)
+                          for act, start, stop in simulator.critical_path()],
+                         [('A.start', 0, 5), ('C.start', 5, 6),
+                          ('root.start', 6, 7)])
+
+    def test_critical_path_group(self):
+        """Test the critical path goes through subservices of groups"""
+        self.manager.backend.model = True
+        first = Service('first')
+        first.fromdict({'actions': {'start': {'cmd': ':', 'cost': 3}}})
+        group = ServiceGroup('group')
+        group.fromdict({'services': {
+            'fast': {'actions': {'start': {'cmd': ':', 'cost': 1}}},
+            'slow': {'actions': {'start': {'cmd': ':', 'cost': 4}}}}})
+        group.add_dep(first)
+        last = Service('last')
+        last.fromdict({'actions': {'start': {'cmd': ':', 'cost': 1}}})
+        last.add_dep(group)
+        last.run('start')
+
+        simulator = self.manager.backend
+        self.assertEqual([(act.fullname(), start, stop)
+                          for act, start, stop in simulator.critical_path()],
+                         [('first.start', 0, 3), ('group.slow.start', 3, 7),
+                          ('last.start', 7, 8)])
@@ -0,0 +1,125 @@
+#
+# Copyright CEA (2026)
+#
+
+"""Tests for the run history database"""
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from ClusterShell.NodeSet import NodeSet
+
+from MilkCheck.Engine.Service import Service
+from MilkCheck.Engine.Action import ActionManager
+from MilkCheck.Engine.BaseEntity import DONE, WARNING, ERROR
+from MilkCheck.History import RunHistory, DurationHistory, HISTORY_FILE
+from MilkCheck.History import percentile, main
+
+class RunHistoryTest(TestCase):
+    """Tests for RunHistory"""
+
+    def setUp(self):
+        ActionManager._instance = None
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'sub', 'history.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_percentile(self):
+        """Test nearest-rank percentiles"""
+        values = list(range(1, 21))
+        self.assertEqual(percentile(values, 50), 10)
+        self.assertEqual(percentile(values, 95), 19)
+        self.assertEqual(percentile(values, 100), 20)
+        self.assertEqual(percentile([4], 95), 4)
+
+    def test_record(self):
+        """Test actions and nodes are recorded with their durations"""
+        svc = Service('svc')
+        svc.fromdict({
+            'target': 'n[1-3]',
+            'remote': False,
+            'errors': 1,
+            'actions': {'start': {
+                'cmd': 'case %h in n2) sleep 0.2;; n3) exit 4;; esac'}}})
+        svc.run('start')
+        action = svc._actions['start']
+        self.assertEqual(action.status, WARNING)
+
+        history = RunHistory(self.path)
+        try:
+            run = history.record('svc start', [action], svc.status)
+            rows = history._db.execute(
+                'SELECT run, action, target, tries, status FROM actions')
+            self.assertEqual(rows.fetchall(),
+                             [(run, 'svc.start', 'n[1-3]', 1, WARNING)])
+            rows = history._db.execute(
+                'SELECT node, retcode FROM nodes ORDER BY node')
+            self.assertEqual(rows.fetchall(),
+                             [('n1', 0), ('n2', 0), ('n3', 4)])
+
+            # Failed nodes are not part of statistics
+            stats = history.statistics('node')
+            self.assertEqual([row[0] for row in stats], ['n1', 'n2'])
+            self.assertTrue(stats[1][2] >= 0.2)
+            stats = history.statistics('node', nodes=NodeSet('n1'))
+            self.assertEqual([row[0] for row in stats], ['n1'])
+
+            stats = history.statistics('action', action='svc.*')
+            self.assertEqual([row[:2] for row in stats], [('svc.start', 1)])
+            self.assertEqual(history.statistics('action', action='other*'), [])
+        finally:
+            history.close()
+
+    def test_statistics(self):
+        """Test p50 and p95 are computed over runs"""
+        svc = Service('svc')
+        svc.fromdict({'target': 'localhost', 'remote': False,
+                      'actions': {'start': {'cmd': '/bin/true'}}})
+        action = svc._actions['start']
+        history = RunHistory(self.path)
+        try:
+            for duration in range(1, 21):
+                action.start_time = 1000
+                action.stop_time = 1000 + duration
+                action.status = DONE
+                history.record('svc start', [action], DONE)
+            # Errors are ignored
+            action.stop_time = 2000
+            action.status = ERROR
+            history.record('svc start', [action], ERROR)
+            self.assertEqual(history.statistics(),
+                             [('svc.start', 20, 10, 19, 20)])
+        finally:
+            history.close()
+        self.assertEqual(main(['-f', self.path, 'svc.*']), 0)
+
+    def test_expected_durations(self):
+        """Test expected durations are percentiles of the run history"""
+        svc = Service('svc')
+        svc.fromdict({'target': 'localhost', 'remote': False,
+                      'actions': {'start': {'cmd': '/bin/true'}}})
+        action = svc._actions['start']
+        history = RunHistory(os.path.join(self.tmpdir, HISTORY_FILE))
+        try:
+            for duration in range(1, 21):
+                action.start_time = 1000
+                action.stop_time = 1000 + duration
+                action.status = DONE
+                history.record('svc start', [action], DONE)
+        finally:
+            history.close()
+
+        durations = DurationHistory()
+        durations.directory = self.tmpdir
+        durations.percentile = 95
+        self.assertEqual(durations.estimate('svc.start'), 19)
+        self.assertEqual(durations.estimate('svc.stop'), None)
+
+        # Without history, nothing is expected
+        durations = DurationHistory()
+        durations.directory = os.path.join(self.tmpdir, 'none')
+        self.assertEqual(durations.estimate('svc.start'), None)
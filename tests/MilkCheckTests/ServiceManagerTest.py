@@ -7,6 +7,8 @@ Test cases for MilkCheck.ServiceManager
 """
 
 import os
+import json
+import shutil
 import tempfile
 import textwrap
 import time
@@ -15,12 +17,18 @@ import unittest
 from ClusterShell.NodeSet import NodeSet
 
 from MilkCheck.Engine.BaseEntity import VariableAlreadyExistError
+from MilkCheck.Engine.BaseEntity import MilkCheckEngineError
+from MilkCheck.Engine.BaseEntity import CommandCache, command_cache_self
 from MilkCheck.Engine.BaseEntity import NO_STATUS, DONE, REQUIRE_WEAK
-from MilkCheck.Engine.BaseEntity import DEP_ERROR, ERROR, WARNING
-from MilkCheck.Engine.Action import Action
+from MilkCheck.Engine.BaseEntity import DEP_ERROR, ERROR, WARNING, SKIPPED, \
+                                        TIMEOUT
+from MilkCheck.Engine.Action import Action, ActionManager, action_manager_self
+from MilkCheck.Engine.NodeHealth import NodeHealth, node_health_self
 from MilkCheck.Engine.Service import Service
 from MilkCheck.Engine.ServiceGroup import ServiceGroup
 from MilkCheck.ServiceManager import ServiceManager, ServiceNotFoundError
+from MilkCheck.Components import ComponentRunner
+from MilkCheck.Callback import CoreEvent, call_back_self
 
 
 class ServiceManagerTest(unittest.TestCase):
@@ -406,3 +414,258 @@ node [style=filled];
         self.assertFalse(srv.to_skip('start'))
         manager._apply_config({'tags': set(['bar'])})
         self.assertTrue(srv.to_skip('start'))
+
+    def test_call_services_components(self):
+        """Independent services run in separate processes"""
+        tmpdir = tempfile.mkdtemp(prefix='test-mlk-')
+        try:
+            pids = os.path.join(tmpdir, 'pids')
+            statuses = []
+            for workers in (1, 2):
+                ActionManager._instance = None
+                manager = ServiceManager()
+                manager.fromdict({'services': {
+                    'S1': {'require': ['S2'],
+                           'actions': {'start': {'cmd': '/bin/true'}}},
+                    'S2': {'actions': {'start': {
+                               'cmd': 'echo $PPID >> %s' % pids}}},
+                    'S3': {'actions': {'start': {
+                               'cmd': 'echo $PPID >> %s; exit 3' % pids}}},
+                    }})
+                manager.call_services([], 'start',
+                                      conf={'reverse_actions': ['stop'],
+                                            'workers': workers})
+                statuses.append((manager.status,
+                    dict((name, svc.status)
+                         for name, svc in manager._subservices.items())))
+                action = manager._subservices['S3']._actions['start']
+                self.assertEqual(action.nodes_error(), NodeSet('localhost'))
+                self.assertTrue(action.duration is not None)
+
+            self.assertEqual(statuses[0], statuses[1])
+            self.assertEqual(statuses[1][1]['S3'], ERROR)
+            # One process for the first run, two for the second one
+            ppids = open(pids).read().split()
+            self.assertEqual(len(set(ppids[:2])), 1)
+            self.assertEqual(len(set(ppids[2:])), 2)
+            self.assertFalse(str(os.getpid()) in ppids[2:])
+        finally:
+            ActionManager._instance = None
+            shutil.rmtree(tmpdir)
+
+    def test_components_running_tasks(self):
+        """Actions running in child processes are running tasks"""
+        class Recorder(CoreEvent):
+            """Record running tasks when actions start"""
+            def __init__(self):
+                self.running = []
+            def ev_started(self, obj):
+                if isinstance(obj, Action):
+                    self.running.append(set(
+                        act.fullname()
+                        for act in action_manager_self().running_tasks))
+            def ev_complete(self, obj):
+                pass
+            def ev_status_changed(self, obj):
+                pass
+            def ev_finished(self, obj):
+                pass
+            def ev_delayed(self, obj):
+                pass
+            def ev_trigger_dep(self, obj_source, obj_triggered):
+                pass
+
+        recorder = Recorder()
+        call_back_self().attach(recorder)
+        try:
+            manager = ServiceManager()
+            manager.fromdict({'services': {
+                'S1': {'actions': {'start': {'cmd': 'sleep 0.2'}}},
+                'S2': {'actions': {'start': {'cmd': 'sleep 0.2'}}}}})
+            manager.call_services([], 'start',
+                                  conf={'reverse_actions': ['stop'],
+                                        'workers': 2})
+            self.assertEqual(len(recorder.running), 2)
+            for running in recorder.running:
+                self.assertTrue(running)
+            self.assertEqual(action_manager_self().running_tasks, set())
+        finally:
+            call_back_self().detach(recorder)
+
+    def test_components_failure(self):
+        """Child processes are reaped when one of them fails"""
+        manager = ServiceManager()
+        manager.fromdict({'services': {
+            'S1': {'actions': {'start': {'cmd': 'sleep 30'}}},
+            'S2': {'actions': {'start': {'cmd': 'sleep 30'}}}}})
+        runner = ComponentRunner(manager, 2)
+        start = time.time()
+        # The second child does not find its service
+        self.assertRaises(MilkCheckEngineError, runner.run, 'start',
+                          [['S1'], ['S3']])
+        self.assertTrue(time.time() - start < 10)
+        self.assertRaises(ChildProcessError, os.waitpid, -1, os.WNOHANG)
+
+    def test_call_services_preflight(self):
+        """Nodes failing the pre-flight probe are removed from remote actions"""
+        manager = ServiceManager()
+        manager.fromdict({'services': {
+            'S1': {'actions': {'start': {'target': 'badnode.invalid',
+                                         'cmd': 'true'}}},
+            'S2': {'remote': False,
+                   'actions': {'start': {'target': 'badnode.invalid',
+                                         'cmd': 'echo %%h'}}},
+            }})
+        try:
+            manager.call_services([], 'start',
+                                  conf={'reverse_actions': ['stop'],
+                                        'preflight': True,
+                                        'preflight_timeout': 1})
+            self.assertEqual(manager._subservices['S1']._actions['start'].status,
+                             SKIPPED)
+            self.assertEqual(manager._subservices['S2'].status, DONE)
+            self.assertEqual(node_health_self().unreachable,
+                             NodeSet('badnode.invalid'))
+        finally:
+            NodeHealth._instance = None
+
+    def test_call_services_fail_fast(self):
+        """A failed action stops the run and cancels the other actions"""
+        manager = ServiceManager()
+        manager.fromdict({'services': {
+            'Broken': {'actions': {'start': {'cmd': 'exit 1'}}},
+            'Slow': {'actions': {'start': {'cmd': 'sleep 5'}}},
+            'Late': {'actions': {'start': {'cmd': '/bin/true',
+                                           'delay': 3}}},
+            'Next': {'require': ['Slow'],
+                     'actions': {'start': {'cmd': '/bin/true'}}},
+            }})
+        try:
+            action_manager_self().fail_fast = True
+            start = time.time()
+            manager.call_services([], 'start',
+                                  conf={'reverse_actions': ['stop']})
+            self.assertTrue(time.time() - start < 2)
+            self.assertEqual(action_manager_self().stopped,
+                             'Broken.start is ERROR')
+            self.assertEqual(manager.status, DEP_ERROR)
+            for name, status in (('Broken', ERROR), ('Slow', ERROR),
+                                 ('Late', ERROR), ('Next', DEP_ERROR)):
+                self.assertEqual(manager._subservices[name].status, status)
+            late = manager._subservices['Late']._actions['start']
+            self.assertEqual(late.aborted_nodes, NodeSet('localhost'))
+            self.assertEqual(late.node_times, {})
+
+            # The next run in the same process is not stopped
+            action_manager_self().fail_fast = False
+            manager.call_services(['Broken', 'Late'], 'start',
+                                  conf={'reverse_actions': ['stop']})
+            self.assertEqual(action_manager_self().stopped, None)
+            self.assertEqual(manager._subservices['Late'].status, DONE)
+        finally:
+            ActionManager._instance = None
+
+    def test_call_services_deadline(self):
+        """The deadline stops the run and bounds action timeouts"""
+        manager = ServiceManager()
+        manager.fromdict({'services': {
+            'Fast': {'actions': {'start': {'cmd': '/bin/true'}}},
+            'Slow': {'actions': {'start': {'cmd': 'sleep 5'}}},
+            'Late': {'actions': {'start': {'cmd': '/bin/true',
+                                           'delay': 3}}},
+            }})
+        try:
+            action_manager_self().deadline = time.time() + 0.5
+            manager.call_services([], 'start',
+                                  conf={'reverse_actions': ['stop']})
+            self.assertEqual(action_manager_self().stopped,
+                             'deadline reached')
+            self.assertEqual(manager._subservices['Fast'].status, DONE)
+            slow = manager._subservices['Slow']._actions['start']
+            self.assertTrue(slow.status in (TIMEOUT, ERROR))
+            # Only its worker was bounded
+            self.assertEqual(slow.timeout, None)
+            self.assertTrue(slow.duration < 1)
+            self.assertEqual(manager._subservices['Late'].status, ERROR)
+
+            # A run ending before the deadline is not kept waiting for it
+            ActionManager._instance = None
+            manager = ServiceManager()
+            manager.fromdict({'services': {
+                'Fast': {'actions': {'start': {'cmd': '/bin/true'}}}}})
+            action_manager_self().deadline = time.time() + 60
+            start = time.time()
+            manager.call_services([], 'start',
+                                  conf={'reverse_actions': ['stop']})
+            self.assertTrue(time.time() - start < 2)
+            self.assertEqual(action_manager_self().stopped, None)
+            self.assertEqual(manager.status, DONE)
+        finally:
+            ActionManager._instance = None
+
+    def test_call_services_lazy_resolution(self):
+        """Entities which cannot be run are not resolved"""
+        tmpdir = tempfile.mkdtemp(prefix='test-mlk-')
+        try:
+            counter = os.path.join(tmpdir, 'counter')
+            manager = ServiceManager()
+            manager.fromdict({'services': {
+                'S1': {'require': ['S2'],
+                       'actions': {'start': {'cmd': '/bin/true'}}},
+                'S2': {'variables': {'foo': '%%(echo S2 >> %s)' % counter},
+                       'actions': {'start': {'cmd': 'echo %foo'}}},
+                'S3': {'target': '%%(echo S3 >> %s; echo localhost)' % counter,
+                       'actions': {'start': {'cmd': '/bin/true'}}},
+                }})
+            self.assertEqual(manager.reachable(['S1']),
+                             set([manager._subservices['S1'], manager._subservices['S2']]))
+            manager.call_services(['S1'], 'start',
+                                  conf={'reverse_actions': ['stop']})
+            self.assertEqual(manager.status, DONE)
+            self.assertEqual(open(counter).read(), 'S2\n')
+            self.assertEqual(manager._subservices['S3'].target, NodeSet('localhost'))
+            self.assertEqual(open(counter).read(), 'S2\nS3\n')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_call_services_command_cache(self):
+        """Command outputs are stored on disk once the run is done"""
+        tmpdir = tempfile.mkdtemp(prefix='test-mlk-')
+        try:
+            cache = command_cache_self()
+            cache.directory = tmpdir
+            cache.ttls = {'echo *': 60}
+            manager = ServiceManager()
+            manager.fromdict({'services': {
+                'S1': {'variables': {'foo': '%(echo S1)'},
+                       'actions': {'start': {'cmd': 'echo %foo'}}},
+                'S2': {'target': '%(echo localhost)',
+                       'actions': {'start': {'cmd': '/bin/true'}}},
+                }})
+            manager.call_services(['S1'], 'start',
+                                  conf={'reverse_actions': ['stop']})
+            self.assertEqual(manager.status, DONE)
+            path = os.path.join(tmpdir, CommandCache.CACHE_FILE)
+            with open(path) as disk:
+                self.assertEqual(sorted(json.load(disk)), ['echo S1'])
+            # Resolved out of the run, stored by the next one
+            self.assertEqual(manager._subservices['S2'].target,
+                             NodeSet('localhost'))
+            manager.call_services(['S1'], 'start',
+                                  conf={'reverse_actions': ['stop']})
+            with open(path) as disk:
+                self.assertEqual(sorted(json.load(disk)),
+                                 ['echo S1', 'echo localhost'])
+        finally:
+            CommandCache._instance = None
+            shutil.rmtree(tmpdir)
+
+    def test_call_services_scope_check(self):
+        """Invalid placeholders out of scope are still reported"""
+        manager = ServiceManager()
+        manager.fromdict({'services': {
+            'S1': {'actions': {'start': {'cmd': '/bin/true'}}},
+            'S2': {'actions': {'start': {'cmd': 'echo %(foo'}}},
+            }})
+        self.assertRaises(ValueError, manager.call_services, ['S1'], 'start',
+                          conf={'reverse_actions': ['stop']})
@@ -10,6 +10,7 @@ This modules defines the tests cases targeting the class CommandLine
 import os
 import re
 import select
+import shutil
 import socket
 import sys
 import time
@@ -27,7 +28,9 @@ import MilkCheck.UI.Cli
 from MilkCheck.UI.Cli import CommandLine, ConsoleDisplay, MAXTERMWIDTH
 from MilkCheck.ServiceManager import ServiceManager
 from MilkCheck.Engine.Service import Service
-from MilkCheck.Engine.Action import Action, ActionManager
+from MilkCheck.Engine.Action import Action, ActionManager, \
+                                    action_manager_self
+from MilkCheck.Engine.Backend import ClusterShellBackend
 from MilkCheck.Engine.ServiceGroup import ServiceGroup
 from MilkCheck.Callback import CallbackHandler
 from MilkCheck.config import ConfigParser
@@ -36,7 +39,7 @@ from ClusterShell.NodeSet import NodeSet
 # Symbols
 from MilkCheck.UI.Cli import RC_OK, RC_ERROR, RC_EXCEPTION, \
                              RC_UNKNOWN_EXCEPTION, RC_WARNING
-from MilkCheck.Engine.BaseEntity import REQUIRE_WEAK
+from MilkCheck.Engine.BaseEntity import REQUIRE_WEAK, DONE
 
 # Exceptions
 from yaml.scanner import ScannerError
@@ -92,6 +95,12 @@ class CLISimpleTest(TestCase):
 
     def setUp(self):
         """ Define configuration file for simple tests """
+        # Data kept between runs
+        self.cache_dir = tempfile.mkdtemp(suffix='milkcache')
+        self._cache_default = ConfigParser.DEFAULT_FIELDS['cache_dir']
+        ConfigParser.DEFAULT_FIELDS['cache_dir'] = {'value': self.cache_dir,
+                                                    'type': str}
+
         self.configdir = tempfile.mkdtemp(suffix='milktest')
         self.configfile = tempfile.NamedTemporaryFile(suffix='.yaml', dir=self.configdir)
         self.configfile.write(textwrap.dedent("""
@@ -107,6 +116,8 @@ class CLISimpleTest(TestCase):
         """ Cleanup temporary file installed in setUp """
         self.configfile.close()
         os.rmdir(self.configdir)
+        ConfigParser.DEFAULT_FIELDS['cache_dir'] = self._cache_default
+        shutil.rmtree(self.cache_dir)
 
     def _cli_check(self, args, retcode=RC_OK):
         """Simple wrapper to CLI execute()"""
@@ -130,6 +141,12 @@ class CLICommon(TestCase):
         ConfigParser.DEFAULT_FIELDS['config_dir']['value'] = ''
         ConfigParser.CONFIG_PATH = '/dev/null'
 
+        # Data kept between runs
+        self.cache_dir = tempfile.mkdtemp(suffix='milkcache')
+        self._cache_default = ConfigParser.DEFAULT_FIELDS['cache_dir']
+        ConfigParser.DEFAULT_FIELDS['cache_dir'] = {'value': self.cache_dir,
+                                                    'type': str}
+
         self.manager = ServiceManager()
         ActionManager._instance = None
 
@@ -146,6 +163,9 @@ class CLICommon(TestCase):
         sys.stderr = sys.__stderr__
         CallbackHandler._instance = None
 
+        ConfigParser.DEFAULT_FIELDS['cache_dir'] = self._cache_default
+        shutil.rmtree(self.cache_dir)
+
         # Cleanup ssh configuration
         cleanup_sshconfig(self.ssh_cfg)
 
@@ -621,9 +641,23 @@ Options:
     -X EXCLUDED_SVC, --exclude-service=EXCLUDED_SVC
                         Skip the specified services
     --dry-run           Only simulate command execution
+    --simulate          Run nothing, print the waves in which actions would be
+                        started
+    --simulate-fail=NODES/ACTION
+                        Simulated commands of ACTION fail on NODES (default:
+                        all commands succeed)
+    -w WORKERS, --workers=WORKERS
+                        Run independent services in up to WORKERS processes
+    --estimate          Run nothing, predict the run duration from recorded
+                        durations
+    --percentile=PERCENTILE
+                        Percentile of recorded durations used as expected
+                        durations (default 50)
     -D DEFINES, --define=DEFINES, --var=DEFINES
                         Define custom variables
     --nodeps            Do not run dependencies
+    --fail-fast         Stop the run as soon as an action fails
+    --deadline=SECONDS  Stop the run after SECONDS seconds
     -t TAGS, --tags=TAGS
                         Run services matching these tags
 """.format(prog=PROGNAME))
@@ -661,6 +695,18 @@ ServiceGroup                                                      [    OK   ]
 ServiceGroup                                                      [    OK   ]
 """)
 
+    def test_backend_reset(self):
+        '''Test each run gets the configured backend, not the previous one'''
+        for args in (['--simulate'], []):
+            cli = CommandLine()
+            cli.manager = self.manager
+            cli.execute(['ServiceGroup', 'start'] + args)
+            if args:
+                self.assertTrue(action_manager_self().backend.simulated)
+        self.assertTrue(isinstance(action_manager_self().backend,
+                                   ClusterShellBackend))
+        self.assertEqual(self.start_action.status, DONE)
+
     def test_command_output_ok_verbose2(self):
         '''Test command line output with local action OK in verbose x2'''
         self._output_check(['ServiceGroup', 'start', '-vv'], RC_OK,
@@ -934,6 +980,29 @@ ServiceGroup                                                      [    OK   ]
 one                                                               [    OK   ]
 """)
 
+    def test_retry_banner(self):
+        """Test a retry is shown with the nodes it runs on"""
+        tmpdir = tempfile.mkdtemp(prefix='test-mlk-')
+        try:
+            marker = os.path.join(tmpdir, 'marker')
+            svc = Service('svc')
+            act = Action('start', target='n[1-2]',
+                         command='[ %%%%h = n1 -o -e %s ] || ! touch %s' %
+                                 (marker, marker))
+            act.remote = False
+            act.maxretry = 1
+            svc.add_action(act)
+            self.manager.add_service(svc)
+            self._output_check(['svc', 'start', '-v'], RC_OK,
+"""start svc on n[1-2]
+ > [ %%h = n1 -o -e %(marker)s ] || ! touch %(marker)s
+start svc on n2
+ > [ %%h = n1 -o -e %(marker)s ] || ! touch %(marker)s
+svc                                                               [    OK   ]
+""" % {'marker': marker})
+        finally:
+            shutil.rmtree(tmpdir)
+
     def test_overriding_defines(self):
         """Test command line with overriden variables"""
         tmpdir = tempfile.mkdtemp(prefix='test-mlk-')
@@ -988,6 +1057,29 @@ class CLIConfigDirTests(CLICommon):
             tmpfile.close()
             os.rmdir(tmpdir)
 
+    def test_invalid_property(self):
+        """Test an invalid property is a configuration error"""
+        try:
+            tmpdir = tempfile.mkdtemp(prefix='test-mlk-')
+            tmpfile = tempfile.NamedTemporaryFile(suffix='.yaml', dir=tmpdir)
+            tmpfile.write(textwrap.dedent("""
+                services:
+                  svc:
+                    actions:
+                      start:
+                        cmd: echo ok
+                        rolling: {batch: 0}
+                        """).encode())
+            tmpfile.flush()
+
+            self._output_check(['--config-dir', tmpdir, 'svc', 'start'],
+                               RC_EXCEPTION, '',
+                               "[00:00:00] ERROR    - Invalid rolling property:"
+                               " {'batch': 0}\n")
+        finally:
+            tmpfile.close()
+            os.rmdir(tmpdir)
+
 
 class MockInterTerminal(MilkCheck.UI.Cli.Terminal):
     '''Manage a fake terminal to test interactive mode'''
@@ -1314,9 +1406,23 @@ Options:
     -X EXCLUDED_SVC, --exclude-service=EXCLUDED_SVC
                         Skip the specified services
     --dry-run           Only simulate command execution
+    --simulate          Run nothing, print the waves in which actions would be
+                        started
+    --simulate-fail=NODES/ACTION
+                        Simulated commands of ACTION fail on NODES (default:
+                        all commands succeed)
+    -w WORKERS, --workers=WORKERS
+                        Run independent services in up to WORKERS processes
+    --estimate          Run nothing, predict the run duration from recorded
+                        durations
+    --percentile=PERCENTILE
+                        Percentile of recorded durations used as expected
+                        durations (default 50)
     -D DEFINES, --define=DEFINES, --var=DEFINES
                         Define custom variables
     --nodeps            Do not run dependencies
+    --fail-fast         Stop the run as soon as an action fails
+    --deadline=SECONDS  Stop the run after SECONDS seconds
     -t TAGS, --tags=TAGS
                         Run services matching these tags
 '''.format(prog=PROGNAME),
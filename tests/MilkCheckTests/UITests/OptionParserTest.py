@@ -103,6 +103,17 @@ class McOptionParserTest(unittest.TestCase):
         options, _ = self.mop.parse_args(['-t', 'tag1,tag2', '-t', 'tag3'])
         self.assertEqual(options.tags, set(['tag1', 'tag2', 'tag3']))
 
+    def test_option_simulate_fail(self):
+        """Test --simulate-fail option"""
+        options, _ = self.mop.parse_args(['--simulate-fail', 'foo[1-2]/*.start',
+                                          '--simulate-fail', '/svc.stop',
+                                          '--simulate-fail', 'bar1'])
+        self.assertEqual(options.simulate_fail,
+                         [(NodeSet('foo[1-2]'), '*.start'),
+                          (None, 'svc.stop'), (NodeSet('bar1'), None)])
+        self.assertRaises(InvalidOptionError, self.mop.parse_args,
+                          ['--simulate-fail', 'bad_node[set/svc.start'])
+
     def test_option_assume_yes(self):
         """Test --assumeyes option"""
         options, _ = self.mop.parse_args(['-y'])
@@ -8,6 +8,7 @@ Define common function for MilkCheck tests
 import tempfile
 import textwrap
 from ClusterShell.Task import task_self
+from MilkCheck.Engine.NodeHealth import NodeHealth
 
 def setup_sshconfig():
     """ Generate a custom ssh configuration for tests """
@@ -30,6 +31,8 @@ def setup_sshconfig():
     ssh_cfg.flush()
     task = task_self()
     task.set_info('ssh_options', '-F {0}'.format(ssh_cfg.name))
+    # Forget about nodes unreachable in previous tests
+    NodeHealth._instance = None
     return ssh_cfg
 
 
@@ -8,12 +8,15 @@
 import logging
 import optparse
 import os
+import shutil
 import tempfile
 import textwrap
 import unittest
+import yaml
 
-from MilkCheck.config import ConfigParser, ConfigError, load_from_stream, \
-                             load_from_dir
+from MilkCheck.config import ConfigParser, ConfigError, ConfigCache, \
+                             load_from_stream, load_from_dir, \
+                             load_from_files, PARALLEL_MIN_FILES
 
 def _mktmpfile(content, dir=None, suffix='.yaml'):
     tmpfile = tempfile.NamedTemporaryFile(suffix=suffix, dir=dir)
@@ -222,6 +225,62 @@ class LoadFromDirTest(unittest.TestCase):
             os.rmdir(subtmpdir)
             os.rmdir(tmpdir)
 
+    def test_load_from_files_parallel(self):
+        """load many YAML files in parallel"""
+        tmpdir = tempfile.mkdtemp(prefix='test-mlk-')
+        try:
+            filenames = []
+            for idx in range(PARALLEL_MIN_FILES + 1):
+                filename = os.path.join(tmpdir, '%02d.yaml' % idx)
+                with open(filename, 'w') as yamlfile:
+                    yamlfile.write("variables: {foo: %d}\n" % idx)
+                filenames.append(filename)
+            flow = load_from_files(filenames, workers=4)
+            self.assertEqual(flow, [{'variables': {'foo': idx}}
+                                    for idx in range(len(filenames))])
+
+            # Errors refer to the right file
+            with open(filenames[10], 'w') as yamlfile:
+                yamlfile.write("variables: [foo\n")
+            try:
+                load_from_files(filenames, workers=4)
+            except yaml.YAMLError as exc:
+                self.assertTrue(filenames[10] in str(exc))
+            else:
+                self.fail('No error raised')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_load_from_dir_cache(self):
+        """load a directory using the configuration cache"""
+        tmpdir = tempfile.mkdtemp(prefix='test-mlk-')
+        cachedir = os.path.join(tmpdir, 'cache')
+        try:
+            filename = os.path.join(tmpdir, 'svc.yaml')
+            with open(filename, 'w') as yamlfile:
+                yamlfile.write("variables: {foo: bar}\n")
+            stat = os.stat(filename)
+            flow = load_from_dir(tmpdir, cache_dir=cachedir)
+            self.assertEqual(flow, {'variables': {'foo': 'bar'}})
+            self.assertTrue(os.path.exists(os.path.join(cachedir,
+                                                        ConfigCache.CACHE_FILE)))
+
+            # Same mtime and size: file is not read again
+            with open(filename, 'w') as yamlfile:
+                yamlfile.write("variables: {foo: baz}\n")
+            os.utime(filename, (stat.st_atime, stat.st_mtime))
+            flow = load_from_dir(tmpdir, cache_dir=cachedir)
+            self.assertEqual(flow, {'variables': {'foo': 'bar'}})
+
+            # Modified file is parsed again
+            os.utime(filename, (stat.st_atime, stat.st_mtime + 10))
+            flow = load_from_dir(tmpdir, cache_dir=cachedir)
+            self.assertEqual(flow, {'variables': {'foo': 'baz'}})
+            self.assertEqual(load_from_dir(tmpdir),
+                             {'variables': {'foo': 'baz'}})
+        finally:
+            shutil.rmtree(tmpdir)
+
 
 class LoadFromStreamTest(unittest.TestCase):
     """Test for load_from_stream()"""